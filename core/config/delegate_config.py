@@ -81,4 +81,13 @@ class DelegateConfig:
         self.update_share = "Y" if other_settings.get('update_share', False) else "N"
         self.logger.debug(f"Other settings: custom={self.custom}, manual_pay={self.manual_pay}, update_share={self.update_share}")
         
+        # Load processing settings
+        self.logger.debug("Loading processing settings")
+        processing_settings = delegate_config.get('processing', {})
+        self.vectorize = "Y" if processing_settings.get('vectorize', False) else "N"
+        self.catchup_blocks = processing_settings.get('catchup_blocks', 10)
+        self.flush_blocks = processing_settings.get('flush_blocks', 50)
+        self.flush_seconds = processing_settings.get('flush_seconds', 60)
+        self.logger.debug(f"Processing settings: vectorize={self.vectorize}, catchup_blocks={self.catchup_blocks}, flush_blocks={self.flush_blocks}, flush_seconds={self.flush_seconds}")
+        
         self.logger.info(f"Successfully initialized configuration for delegate: {delegate_name}")
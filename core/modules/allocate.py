@@ -1,39 +1,119 @@
 from crypto.identity.address import address_from_public_key
+from modules.balance_index import BalanceIndex
+from modules.buffer import AllocationBuffer
+from modules.kernel import Kernel
+from utility.cache import Cache
 import logging
 
 class Allocate:
-    def __init__(self, database, config, sql):
+    def __init__(self, database, config, sql, cache=None):
         self.database = database
         self.config = config
         self.sql = sql
         self.atomic = self.config.atomic
 
+        # public key to address cache shared by all delegates on the network
+        self.cache = cache if cache is not None else Cache(config.network)
+
+        # share rates are cached for one processing cycle, rates changed by another process are picked up on the next
+        self.sql.clear_voter_shares()
+
+        # optional numpy allocation kernel
+        self.kernel = Kernel(config, sql)
+
+        # block rewards are written every few blocks
+        self.buffer = AllocationBuffer(config, sql)
+
         # Set up logging
         self.logger = logging.getLogger(f'allocate_{config.username}')
         self.logger.info(f"Initializing Allocate module for delegate: {config.username}")       
 
         
     def get_vote_transactions(self, timestamp):
-        """Get vote and unvote transactions for the delegate"""
-        self.logger.debug(f"Getting vote transactions since timestamp: {timestamp}")
-        self.database.open_connection()
-        vote, unvote = self.database.get_votes(timestamp)
-        self.database.close_connection()
+        """Get the latest vote and unvote transaction of each voter up to timestamp"""
+        self.logger.debug(f"Getting vote transactions up to timestamp: {timestamp}")
+        self.sql.open_connection()
+        synced = self.sql.get_votes_timestamp()
+
+        if synced is not None and timestamp >= synced:
+            # only fetch votes cast since the last sync and merge them into the stored votes
+            self.database.open_connection()
+            new_vote, new_unvote = self.database.get_votes(timestamp, synced)
+            self.database.close_connection()
+            self.sql.update_votes(new_vote, new_unvote, timestamp)
+            vote, unvote = self.sql.get_votes()
+            self.logger.debug(f"Merged {len(new_vote)} new votes and {len(new_unvote)} new unvotes since timestamp {synced}")
+        else:
+            self.database.open_connection()
+            vote, unvote = self.database.get_votes(timestamp)
+            self.database.close_connection()
+            if synced is None:
+                # first run, keep the full scan for the next block
+                self.sql.update_votes(vote, unvote, timestamp)
+            else:
+                # replaying a block older than the stored votes, leave them untouched
+                self.logger.debug(f"Block timestamp {timestamp} is before the stored votes at {synced}, using a full scan")
+
+        self.sql.close_connection()
         self.logger.debug(f"Retrieved {len(vote)} votes and {len(unvote)} unvotes")
         return vote, unvote    
 
     
+    def get_addresses(self, public_keys):
+        """Public key to address map, only addresses of public keys not seen before are derived"""
+        addresses = self.cache.get_addresses()
+        # the network version is passed explicitly, delegates of other networks may share the process
+        version = self.database.network.version
+        new_addresses = {i:address_from_public_key(i, version) for i in public_keys if i not in addresses}
+        if new_addresses:
+            self.cache.store_addresses(new_addresses)
+        return addresses
+
+
+    def get_ledger_roll(self, timestamp):
+        """
+        Get every voter whose balance may be needed for blocks up to timestamp
+
+        All public keys that voted up to timestamp are included regardless of unvotes,
+        so the voter roll of any block up to timestamp is a subset.
+
+        Args:
+            timestamp: Timestamp of the newest block to process
+
+        Returns:
+            Dictionary of address to (public_key, checkpoint timestamp)
+        """
+        self.sql.open_connection()
+        synced = self.sql.get_votes_timestamp()
+        self.database.open_connection()
+        if synced is not None and timestamp >= synced:
+            vote = self.sql.get_votes()[0] + self.database.get_votes(timestamp, synced)[0]
+        else:
+            vote = self.database.get_votes(timestamp)[0]
+        self.database.close_connection()
+        chkpoint_ts = {i[0]:i[2] for i in self.sql.get_voter_balance_checkpoints().fetchall()}
+        self.sql.close_connection()
+
+        public_keys = {i[0] for i in vote}
+        addresses = self.get_addresses(public_keys)
+        roll = {addresses[i]:(i, chkpoint_ts.get(addresses[i], 0)) for i in public_keys}
+        self.logger.debug(f"Ledger roll has {len(roll)} voters up to timestamp {timestamp}")
+        return roll
+
+
     def create_voter_roll(self, v, u):
         """Create a voter roll from vote and unvote transactions"""
         self.logger.debug("Creating voter roll")
         # create dictionary of unvotes
         unvotes = {i[0]:i[1] for i in u}
 
+        addresses = self.get_addresses(i[0] for i in v)
+
         roll = []
 
         for i in v:
             address = i[0]
-            val = [address_from_public_key(address), address]
+            val = [addresses[address], address]
             if address in unvotes.keys():
                 vote_ts = i[1]
                 unvote_ts =  unvotes[address]
@@ -46,42 +126,47 @@ class Allocate:
                 
         # add voters to database
         self.sql.open_connection()
-        self.sql.store_voters(roll, self.config.voter_share)
+        new_voters = self.sql.store_voters(roll, self.config.voter_share)
         self.sql.close_connection()
-        self.logger.info(f"Created voter roll with {len(roll)} voters")
+        self.logger.info(f"Created voter roll with {len(roll)} voters, {new_voters} new")
 
         return roll
     
        
-    def get_voter_balance(self, block, voter_roll):        
-        """Get the balance for each voter at the given block timestamp"""
+    def get_voter_balance(self, block, voter_roll, ledger=None):
+        """Get the balance for each voter at the given block timestamp, from the shared ledger when it covers the roll"""
         self.logger.debug(f"Getting voter balances for block at height {block[4]}")
-        vote_balance = {}
         block_timestamp = block[1]
 
         self.database.open_connection()
         self.sql.open_connection()
 
-        for i in voter_roll:
-            voter_balance_checkpoint = self.sql.get_voter_balance_checkpoint(i[0]).fetchall()
-            if voter_balance_checkpoint:
-                # Already voter
-                # Recheck transactions between chkpoint_ts and current block_timestamp
-                # Get checkpoint balance and add it to the transactions
-                chkpoint_ts = voter_balance_checkpoint[0][2]
-                chkpoint_balance = voter_balance_checkpoint[0][1]
-                self.logger.debug(f"Voter {i[0]} has checkpoint balance {chkpoint_balance} at timestamp {chkpoint_ts}")
-            else:
-                # New voter, recheck all previous transactions
-                chkpoint_ts = 0
-                chkpoint_balance = 0
-                self.logger.debug(f"New voter {i[0]}, starting with zero balance")
+        # Already voters recheck transactions between chkpoint_ts and current block_timestamp,
+        # new voters recheck all previous transactions
+        checkpoints = {i[0]:(i[1], i[2]) for i in self.sql.get_voter_balance_checkpoints().fetchall()}
+        self.logger.debug(f"Found {len(checkpoints)} voter balance checkpoints")
+
+        # replaying a block older than the checkpoints, start from the balance history at the block
+        replay = [i[0] for i in voter_roll if i[0] in checkpoints and checkpoints[i[0]][1] > block_timestamp]
+        if replay:
+            index = BalanceIndex(self.sql.get_balance_index(replay).fetchall())
+            for address in replay:
+                checkpoint = index.balance_at(address, block_timestamp)
+                if checkpoint is None:
+                    del checkpoints[address]
+                else:
+                    checkpoints[address] = checkpoint
+            self.logger.info(f"Replaying block at height {block[4]}, balances of {len(replay)} voters read from the balance history")
+        chkpoint_ts = {k:v[1] for k, v in checkpoints.items()}
 
-            debit = self.database.get_sum_outbound(i[1], block_timestamp, chkpoint_ts)
-            credit = self.database.get_sum_inbound(i[0], block_timestamp, chkpoint_ts)
-            block_reward = self.database.get_sum_block_rewards(i[1], block_timestamp, chkpoint_ts)
-            balance = chkpoint_balance + credit + block_reward - debit
-            vote_balance[i[0]] = balance
+        if ledger is not None and all(ledger.covers(i[0], chkpoint_ts.get(i[0], 0), block_timestamp) for i in voter_roll):
+            balance_change = {i[0]:ledger.delta(i[0], chkpoint_ts.get(i[0], 0), block_timestamp) for i in voter_roll}
+        else:
+            balance_change = self.database.get_sum_balances(voter_roll, block_timestamp, chkpoint_ts)
+        vote_balance = {}
+        for i in voter_roll:
+            chkpoint_balance = checkpoints[i[0]][0] if i[0] in checkpoints else 0
+            vote_balance[i[0]] = chkpoint_balance + balance_change[i[0]]
 
         # Store voter balance with given block_timestamp
         self.sql.update_voter_balance_checkpoint(vote_balance, block_timestamp)
@@ -92,51 +177,96 @@ class Allocate:
         self.logger.info(f"Retrieved balances for {len(vote_balance)} voters")
         return vote_balance
 
-        
-    def block_allocations(self, block, voters):
-        """Calculate reward allocations for a block"""
-        self.logger.info(f"Processing block allocations for block {block[4]}")
-        print("\n")
-        rewards_check = 0
-        voter_check = 0
-        delegate_check = 0
-        delegate_unpaid = {}
-        voter_unpaid = {}
 
-        # get total votes
-        total_delegate_vote_balance = sum(voters.values())
+    def is_stable(self, voter_roll, after, timestamp):
+        """
+        Check that no voter balance or vote changed between two block timestamps
 
-        # get block reward
+        Blocks in such a run have the voter roll and balances of the block at after,
+        only anti-dilution differs, so they are allocated without reading core again.
+
+        Args:
+            voter_roll: Voter roll of the block at after
+            after: Timestamp of the last processed block
+            timestamp: Timestamp of the last block of the run
+
+        Returns:
+            True if the run can reuse the balances of the block at after
+        """
+        self.database.open_connection()
+        active = self.database.has_voter_activity(voter_roll, after, timestamp)
+        self.database.close_connection()
+        self.logger.debug(f"Voter activity between timestamps {after} and {timestamp}: {active}")
+        return not active
+
+
+    def process_voter_options(self, voter_options, voter_balances, unpaid=None):
+        """
+        Run voter balances through whitelist/blacklist, voter cap, voter minimum and anti-dilution
+
+        Args:
+            voter_options: Voters instance
+            voter_balances: Dictionary of voter addresses and their balances
+            unpaid: Optional dictionary of voter unpaid balances, read from the database if omitted
+
+        Returns:
+            Dictionary of voter addresses with all voter options applied
+        """
+        if unpaid is None and self.buffer.heights:
+            # rewards of buffered blocks count towards anti-dilution
+            unpaid = self.buffer.unpaid()
+
+        if self.kernel.enabled:
+            return self.kernel.process_voters(voter_balances, unpaid)
+
+        if self.config.whitelist == 'Y':
+            voter_balances = voter_options.process_whitelist(voter_balances)
+        if self.config.whitelist == 'N' and self.config.blacklist =='Y':
+            voter_balances = voter_options.process_blacklist(voter_balances)
+
+        voter_balances = voter_options.process_voter_cap(voter_balances)
+        voter_balances = voter_options.process_voter_min(voter_balances)
+        return voter_options.process_anti_dilution(voter_balances, unpaid)
+
+        
+    def delegate_allocations(self, block):
+        """Calculate the delegate accounts' share of a block reward"""
+        delegate_unpaid = {}
         block_reward = block[2]
         fee_reward = block[3]
-        total_reward = block_reward+fee_reward
-        
-        # process delegate reward
+
         for count, i in enumerate(self.config.delegate_fee):
             # check if count is 0 for reserve account
             if count == 0:
                 rate = int(i) / 100
                 reward = int((rate * block_reward) + fee_reward)
-                delegate_check += reward
                 delegate_unpaid[self.config.delegate_fee_address[count]] = reward
                 self.logger.debug(f"Delegate reserve account {self.config.delegate_fee_address[count]} gets {reward/self.atomic} tokens")
             else:
                 rate = int(i) / 100
                 reward = int(rate * block_reward)
-                delegate_check += reward
                 delegate_unpaid[self.config.delegate_fee_address[count]] = reward
                 self.logger.debug(f"Delegate account {self.config.delegate_fee_address[count]} gets {reward/self.atomic} tokens")
-        
-        # process voter reward
+
+        return delegate_unpaid
+
+
+    def voter_allocations(self, block, voters, voter_shares, delegate_unpaid):
+        """Calculate each voter's share of a block reward, custom share remainders go to the reserve account"""
+        voter_unpaid = {}
+
+        # get total votes
+        total_delegate_vote_balance = sum(voters.values())
+        block_reward = block[2]
+
         config_voter_share = self.config.voter_share
-        self.sql.open_connection()
         for k, v in voters.items():
             # check to make sure to skip 0 balances
             if v > 0:
                 # get voter_weight
                 share_weight = v / total_delegate_vote_balance
                 # get voter share
-                db_share = self.sql.get_voter_share(k).fetchall()[0][0]
+                db_share = voter_shares[k]
                 if db_share == config_voter_share:
                     # standard share rate
                     # print("Standard Rate")
@@ -149,16 +279,52 @@ class Allocate:
                     standard_voter_share = (config_voter_share / 100) * block_reward
                     single_voter_reward = int(share_weight * custom_block_share)
                     remainder = int(share_weight * standard_voter_share) - single_voter_reward
-                    delegate_check += remainder
                     delegate_unpaid[self.config.delegate_fee_address[0]] += remainder
                     self.logger.debug(f"Voter {k} has custom share rate {db_share}%, remainder {remainder/self.atomic} goes to delegate")
             else:
                 single_voter_reward = 0
            
-            voter_check += 1
-            rewards_check += single_voter_reward
             print("Voter {} with balance of {} reward: {}".format(k, (v / self.atomic), (single_voter_reward / self.atomic)))
             voter_unpaid[k] = single_voter_reward
+
+        return voter_unpaid
+
+
+    def compute_allocations(self, block, voters, voter_shares):
+        """
+        Calculate reward allocations for a block without storing them
+
+        Returns:
+            Tuple of voter rewards and delegate rewards dictionaries
+        """
+        delegate_unpaid = self.delegate_allocations(block)
+        if self.kernel.accepts(voters):
+            voter_unpaid = self.kernel.voter_allocations(block, voters, voter_shares, delegate_unpaid)
+        else:
+            voter_unpaid = self.voter_allocations(block, voters, voter_shares, delegate_unpaid)
+        return voter_unpaid, delegate_unpaid
+
+
+    def block_allocations(self, block, voters):
+        """Calculate reward allocations for a block"""
+        self.logger.info(f"Processing block allocations for block {block[4]}")
+        print("\n")
+
+        # get total votes
+        total_delegate_vote_balance = sum(voters.values())
+
+        # get block reward
+        block_reward = block[2]
+        fee_reward = block[3]
+        total_reward = block_reward+fee_reward
+        
+        # process delegate and voter reward
+        self.sql.open_connection()
+        voter_shares = self.sql.get_voter_shares()
+        voter_unpaid, delegate_unpaid = self.compute_allocations(block, voters, voter_shares)
+        voter_check = len(voter_unpaid)
+        rewards_check = sum(voter_unpaid.values())
+        delegate_check = sum(delegate_unpaid.values())
         
         for k , v in delegate_unpaid.items():
             print("Delegate {} account reward: {}".format(k, (v / self.atomic)))
@@ -179,9 +345,5 @@ class Allocate:
 
         self.logger.info(f"Block {block[4]} processed: {voter_check} voters, {rewards_check/self.atomic} voter rewards, {delegate_check/self.atomic} delegate rewards")
         
-        # store delegate/voter rewards and mark block as processed mark block as processed
-        self.sql.open_connection()
-        self.sql.update_delegate_balance(delegate_unpaid)
-        self.sql.update_voter_balance(voter_unpaid)
-        self.sql.mark_processed(block[4])
-        self.sql.close_connection()
+        # buffer delegate/voter rewards, they are written with the processed marker of the block
+        self.buffer.add(block, voter_unpaid, delegate_unpaid)
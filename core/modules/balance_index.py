@@ -0,0 +1,48 @@
+from array import array
+from bisect import bisect_right
+import logging
+
+class BalanceIndex:
+    def __init__(self, rows):
+        """
+        Initialize the balance history of voters
+
+        The balance_index table keeps a row every time a voter's balance checkpoint
+        changes. Each address gets sorted timestamps and the balance from each of them
+        on, so the balance at any block timestamp is one bisection.
+
+        Args:
+            rows: (address, timestamp, balance) rows ordered by address and timestamp
+        """
+        self.timestamps = {}
+        self.balances = {}
+        for address, timestamp, balance in rows:
+            if address not in self.timestamps:
+                self.timestamps[address] = array('q')
+                self.balances[address] = array('q')
+            self.timestamps[address].append(timestamp)
+            self.balances[address].append(balance)
+
+        # Set up logging
+        self.logger = logging.getLogger('balance_index')
+        self.logger.debug(f"Loaded balance history of {len(self.timestamps)} voters")
+
+
+    def balance_at(self, address, timestamp):
+        """
+        Get the balance of a voter at a timestamp
+
+        Args:
+            address: Voter address
+            timestamp: Block timestamp
+
+        Returns:
+            Tuple of the balance and the timestamp it was checkpointed at, None if there is none up to timestamp
+        """
+        timestamps = self.timestamps.get(address)
+        if timestamps is None:
+            return None
+        position = bisect_right(timestamps, timestamp)
+        if position == 0:
+            return None
+        return self.balances[address][position - 1], timestamps[position - 1]
@@ -53,9 +53,9 @@ class Blocks:
             
         self.logger.debug(f"Storing {len(new_blocks)} new blocks")
         self.sql.open_connection()
-        self.sql.store_blocks(new_blocks)
+        count = self.sql.store_blocks(new_blocks)
         self.sql.close_connection()
-        self.logger.info(f"Stored {len(new_blocks)} new blocks")
+        self.logger.info(f"Stored {count} new blocks")
         
         
     def return_unprocessed_blocks(self):
@@ -77,10 +77,9 @@ class Blocks:
         """Count the number of processed blocks"""
         self.logger.debug("Counting processed blocks")
         self.sql.open_connection()
-        processed_blocks = self.sql.processed_blocks().fetchall()
+        count = self.sql.processed_block_count()
         self.sql.close_connection()
         
-        count = len(processed_blocks)
         self.logger.debug(f"Found {count} processed blocks")
         return count
        
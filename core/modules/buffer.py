@@ -0,0 +1,85 @@
+import logging
+import time
+
+class AllocationBuffer:
+    def __init__(self, config, sql):
+        """
+        Initialize the write-behind buffer of block allocations
+
+        Voter and delegate rewards of processed blocks are summed in memory and written
+        every flush_blocks blocks or flush_seconds seconds, and always before payments
+        are staged. Rewards and processed markers are written in one transaction, so a
+        crash loses both and the blocks are processed again.
+
+        Args:
+            config: DelegateConfig instance for the specific delegate
+            sql: SQL connection for TBW data
+        """
+        self.config = config
+        self.sql = sql
+        self.voter_unpaid = {}
+        self.delegate_unpaid = {}
+        self.heights = []
+        self.started = None
+
+        # Set up logging
+        self.logger = logging.getLogger(f'buffer_{config.username}')
+
+
+    def add(self, block, voter_unpaid, delegate_unpaid):
+        """
+        Buffer the rewards of a processed block
+
+        Args:
+            block: Processed block
+            voter_unpaid: Dictionary of voter rewards of the block
+            delegate_unpaid: Dictionary of delegate rewards of the block
+        """
+        if not self.heights:
+            self.started = time.monotonic()
+        for k, v in voter_unpaid.items():
+            self.voter_unpaid[k] = self.voter_unpaid.get(k, 0) + v
+        for k, v in delegate_unpaid.items():
+            self.delegate_unpaid[k] = self.delegate_unpaid.get(k, 0) + v
+        self.heights.append(block[4])
+
+
+    def due(self):
+        """Check if the buffer reached flush_blocks blocks or flush_seconds seconds"""
+        if not self.heights:
+            return False
+        return len(self.heights) >= self.config.flush_blocks or time.monotonic() - self.started >= self.config.flush_seconds
+
+
+    def unpaid(self):
+        """
+        Get the unpaid balance of every voter including buffered rewards
+
+        Returns:
+            Dictionary of voter addresses and their unpaid balances
+        """
+        self.sql.open_connection()
+        unpaid = {i[0]:i[2] for i in self.sql.all_voters().fetchall()}
+        self.sql.close_connection()
+        for k, v in self.voter_unpaid.items():
+            unpaid[k] += v
+        return unpaid
+
+
+    def flush(self):
+        """Write the buffered rewards and processed markers in one transaction"""
+        if not self.heights:
+            return
+
+        self.sql.open_connection()
+        with self.sql.transaction():
+            self.sql.update_delegate_balance(self.delegate_unpaid)
+            self.sql.update_voter_balance(self.voter_unpaid)
+            self.sql.mark_processed_blocks(self.heights)
+        self.sql.close_connection()
+
+        self.logger.info(f"Flushed rewards of {len(self.heights)} blocks up to height {self.heights[-1]}")
+        self.voter_unpaid = {}
+        self.delegate_unpaid = {}
+        self.heights = []
+        self.started = None
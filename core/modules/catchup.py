@@ -0,0 +1,198 @@
+from modules.ledger import Ledger
+import logging
+import time
+
+class CatchUp:
+    def __init__(self, config, database, sql, allocate):
+        """
+        Initialize catch-up processing of a backlog of unprocessed blocks
+
+        Votes and balance changes of the whole block range are read from core once and
+        replayed in memory block by block, in the same order as the block by block path
+        so anti-dilution sees the rewards of every earlier block. Rewards, balance
+        checkpoints, votes and processed markers of a run of blocks are written in
+        one transaction. Runs of blocks without voter activity are replayed the same
+        way from the stored balance checkpoints alone.
+
+        Args:
+            config: DelegateConfig instance for the specific delegate
+            database: Database connection for blockchain data
+            sql: SQL connection for TBW data
+            allocate: Allocate instance of the delegate
+        """
+        self.config = config
+        self.database = database
+        self.sql = sql
+        self.allocate = allocate
+        self.ledger = None
+        self.events = []
+        self.position = 0
+        self.vote_ts = {}
+        self.unvote_ts = {}
+        self.addresses = {}
+        self.checkpoints = {}
+
+        # Set up logging
+        self.logger = logging.getLogger(f'catchup_{config.username}')
+
+
+    def load(self, blocks, ledger=None):
+        """
+        Read the vote and balance changes of a block range from core
+
+        Args:
+            blocks: Unprocessed blocks ordered by height
+            ledger: Optional shared Ledger, used if it covers every voter of the range
+
+        Returns:
+            False if the range starts before the stored votes and has to be processed block by block
+        """
+        first_timestamp = blocks[0][1]
+        timestamp = blocks[-1][1]
+
+        synced = self.load_votes()
+        if synced is not None and first_timestamp < synced:
+            self.logger.info(f"Block timestamp {first_timestamp} is before the stored votes at {synced}, processing block by block")
+            return False
+
+        # all vote changes of the range in one ordered query
+        self.database.open_connection()
+        self.events = self.database.get_vote_events(timestamp, synced if synced is not None else -1)
+        self.database.close_connection()
+
+        # every public key that votes at some block of the range
+        public_keys = set(self.vote_ts) | {i[0] for i in self.events if i[2]}
+        self.addresses = self.allocate.get_addresses(public_keys)
+        roll = [[self.addresses[i], i] for i in public_keys]
+        starts = {i[0]:self.checkpoints[i[0]][1] if i[0] in self.checkpoints else 0 for i in roll}
+
+        if ledger is not None and all(ledger.covers(k, v, timestamp) for k, v in starts.items()):
+            self.ledger = ledger
+        else:
+            self.ledger = Ledger(self.config.network)
+            self.ledger.load(self.database, roll, timestamp, starts)
+
+        self.logger.info(f"Loaded {len(self.events)} vote changes for {len(roll)} voters over {len(blocks)} blocks")
+        return True
+
+
+    def load_stable(self, timestamp):
+        """
+        Prepare a run of blocks without vote or balance changes, see Allocate.is_stable
+
+        Args:
+            timestamp: Timestamp of the last block of the run
+        """
+        self.load_votes()
+        self.events = []
+        self.addresses = self.allocate.get_addresses(self.vote_ts)
+
+        # nothing to add to the balance checkpoints
+        self.ledger = Ledger(self.config.network)
+        self.ledger.timestamp = timestamp
+
+
+    def load_votes(self):
+        """
+        Read the stored votes and voter balance checkpoints
+
+        Returns:
+            Timestamp the stored votes are synced up to, None if they were never synced
+        """
+        self.sql.open_connection()
+        synced = self.sql.get_votes_timestamp()
+        vote, unvote = self.sql.get_votes()
+        self.checkpoints = {i[0]:(i[1], i[2]) for i in self.sql.get_voter_balance_checkpoints().fetchall()}
+        self.sql.close_connection()
+
+        self.position = 0
+        self.vote_ts = dict(vote)
+        self.unvote_ts = dict(unvote)
+        return synced
+
+
+    def voter_roll(self, timestamp):
+        """
+        Apply the vote changes up to timestamp
+
+        Returns:
+            Tuple of the voter roll as [address, public_key] pairs and the vote and unvote changes applied
+        """
+        vote, unvote = [], []
+        while self.position < len(self.events) and self.events[self.position][1] <= timestamp:
+            public_key, ts, is_vote, is_unvote = self.events[self.position]
+            if is_vote:
+                self.vote_ts[public_key] = ts
+                vote.append((public_key, ts))
+            if is_unvote:
+                self.unvote_ts[public_key] = ts
+                unvote.append((public_key, ts))
+            self.position += 1
+
+        # unvote prior to the vote keeps the voter on the roll
+        roll = [[self.addresses[k], k] for k, v in self.vote_ts.items() if k not in self.unvote_ts or v > self.unvote_ts[k]]
+        return roll, vote, unvote
+
+
+    def run(self, blocks, voter_options):
+        """
+        Allocate the rewards of a run of blocks in memory and write them in one transaction
+
+        Args:
+            blocks: Unprocessed blocks ordered by height, following the blocks of the previous run
+            voter_options: Voters instance
+        """
+        tic = time.perf_counter()
+        self.allocate.buffer.flush()
+        self.sql.open_connection()
+        unpaid = {i[0]:i[2] for i in self.sql.all_voters().fetchall()}
+        voter_shares = dict(self.sql.get_voter_shares())
+        self.sql.close_connection()
+
+        new_voters = []
+        voter_total = {}
+        delegate_total = {}
+        checkpoints = {}
+        votes, unvotes = [], []
+
+        for block in blocks:
+            block_timestamp = block[1]
+            voter_roll, vote, unvote = self.voter_roll(block_timestamp)
+            votes.extend(vote)
+            unvotes.extend(unvote)
+
+            voter_balances = {}
+            for address, public_key in voter_roll:
+                if address not in unpaid:
+                    new_voters.append([address, public_key])
+                    unpaid[address] = 0
+                    voter_shares[address] = self.config.voter_share
+                balance, chkpoint_ts = self.checkpoints.get(address, (0, 0))
+                voter_balances[address] = balance + self.ledger.delta(address, chkpoint_ts, block_timestamp)
+                self.checkpoints[address] = checkpoints[address] = (voter_balances[address], block_timestamp)
+
+            voter_balances = self.allocate.process_voter_options(voter_options, voter_balances, unpaid)
+            voter_unpaid, delegate_unpaid = self.allocate.compute_allocations(block, voter_balances, voter_shares)
+
+            # later blocks of the run see these rewards in anti-dilution
+            for k, v in voter_unpaid.items():
+                unpaid[k] += v
+                voter_total[k] = voter_total.get(k, 0) + v
+            for k, v in delegate_unpaid.items():
+                delegate_total[k] = delegate_total.get(k, 0) + v
+
+            self.logger.debug(f"Block {block[4]} allocated: {len(voter_unpaid)} voters, {sum(voter_unpaid.values())/self.config.atomic} voter rewards")
+
+        self.sql.open_connection()
+        with self.sql.transaction():
+            self.sql.store_voters(new_voters, self.config.voter_share)
+            self.sql.update_delegate_balance(delegate_total)
+            self.sql.update_voter_balance(voter_total)
+            self.sql.update_voter_balance_checkpoints(checkpoints)
+            self.sql.update_votes(votes, unvotes, blocks[-1][1])
+            self.sql.mark_processed_blocks([i[4] for i in blocks])
+        self.sql.close_connection()
+
+        toc = time.perf_counter()
+        print(f"Caught up blocks {blocks[0][4]} to {blocks[-1][4]} in {toc - tic:0.4f} seconds")
+        self.logger.info(f"Caught up {len(blocks)} blocks from height {blocks[0][4]} to {blocks[-1][4]}: {len(voter_total)} voters, {len(new_voters)} new, in {toc - tic:0.4f} seconds")
@@ -0,0 +1,182 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+
+import requests
+
+# webhook receivers are shared by every Events in the process, keyed by port
+receivers = {}
+receivers_lock = threading.Lock()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        """Hand block events posted by the core webhooks plugin to the subscribers"""
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+        except Exception:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        authorization = self.headers.get('Authorization')
+        for subscriber in list(self.server.subscribers):
+            subscriber.dispatch(payload, authorization)
+
+        self.send_response(200)
+        self.end_headers()
+
+
+    def log_message(self, format, *args):
+        logging.getLogger('webhooks').debug(format % args)
+
+
+def get_receiver(host, port):
+    """Get the webhook receiver listening on port, starting it on first use"""
+    with receivers_lock:
+        receiver = receivers.get(port)
+        if receiver is None:
+            try:
+                receiver = ThreadingHTTPServer((host, port), WebhookHandler)
+            except OSError as e:
+                # another process, e.g. the tbw.py of another delegate, holds the port, webhooks target any free port
+                receiver = ThreadingHTTPServer((host, 0), WebhookHandler)
+                logging.getLogger('webhooks').warning(f"Webhook port {port} is not available ({str(e)}), listening on port {receiver.server_address[1]} instead")
+                print(f"Webhook port {port} in use, listening on port {receiver.server_address[1]} instead")
+            receiver.daemon_threads = True
+            receiver.subscribers = []
+            threading.Thread(target=receiver.serve_forever, name=f"webhooks_{port}", daemon=True).start()
+            receivers[port] = receiver
+            logging.getLogger('webhooks').info(f"Webhook receiver listening on {host}:{receiver.server_address[1]}")
+        return receiver
+
+
+class Events:
+    # block events sent by the core webhooks plugin
+    block_events = ("block.applied", "block.forged")
+
+    def __init__(self, network, event=None):
+        """
+        Initialize block event notifications for a network
+
+        Wakes the processing loop as soon as a watched delegate forges a block,
+        either from core webhooks or from a NOTIFY trigger on the core blocks table.
+        Waiting always times out, so polling keeps working when no event arrives.
+
+        Args:
+            network: Network instance, its events setting is poll, webhook or notify
+            event: Optional threading.Event shared with the Events of other networks
+        """
+        self.network = network
+        self.mode = network.events
+        self.event = event if event is not None else threading.Event()
+        self.public_keys = set()
+        self.tokens = set()
+        self.receiver = None
+        self.listener = None
+
+        # Set up logging
+        self.logger = logging.getLogger(f'events_{network.network}')
+
+
+    def watch(self, public_key):
+        """Wake on blocks forged by public_key"""
+        self.public_keys.add(public_key)
+        if self.receiver is not None:
+            try:
+                self.register(public_key)
+            except Exception as e:
+                self.logger.warning(f"Could not register webhook for {public_key}, polling instead: {str(e)}")
+
+
+    def start(self, database):
+        """
+        Start receiving block events, failures fall back to polling
+
+        Args:
+            database: Database connection for blockchain data
+        """
+        try:
+            if self.mode == "webhook":
+                self.receiver = get_receiver(self.network.webhook_host, self.network.webhook_port)
+                self.receiver.subscribers.append(self)
+                for public_key in self.public_keys:
+                    self.register(public_key)
+            elif self.mode == "notify":
+                database.open_connection()
+                database.install_block_notify()
+                database.close_connection()
+                self.listener = threading.Thread(target=self.listen, args=(database,), name=f"notify_{self.network.network}", daemon=True)
+                self.listener.start()
+            else:
+                return
+            self.logger.info(f"Waiting for {self.mode} block events, polling as fallback")
+        except Exception as e:
+            self.logger.warning(f"Could not start {self.mode} block events, polling instead: {str(e)}")
+
+
+    def register(self, public_key):
+        """Register the receiver for blocks forged by public_key with the core webhooks plugin"""
+        url = f"http://{self.network.webhook_host}:{self.network.webhooks}/api/webhooks"
+        target = f"http://{self.network.webhook_host}:{self.receiver.server_address[1]}/"
+
+        # remove webhooks left over by a previous run, which may have listened on another port
+        for webhook in requests.get(url, timeout=5).json().get('data', []):
+            conditions = [i.get('value') for i in webhook.get('conditions', [])]
+            if webhook.get('target', '').startswith(f"http://{self.network.webhook_host}:") and public_key in conditions:
+                requests.delete(f"{url}/{webhook['id']}", timeout=5)
+
+        body = {
+            "event": "block.applied",
+            "target": target,
+            "enabled": True,
+            "conditions": [{"key": "generatorPublicKey", "condition": "eq", "value": public_key}]}
+        webhook = requests.post(url, json=body, timeout=5).json()['data']
+        # core sends the first half of the token with every event
+        self.tokens.add(webhook['token'][:32])
+        self.logger.info(f"Registered webhook {webhook['id']} for blocks forged by {public_key}")
+
+
+    def listen(self, database):
+        """Read block notifications until the process exits, reconnecting after errors"""
+        while True:
+            try:
+                connection = database.listen_blocks()
+                for notify in connection.notifies():
+                    if notify.payload in self.public_keys:
+                        self.logger.debug(f"Block notification for {notify.payload}")
+                        self.event.set()
+            except Exception as e:
+                self.logger.warning(f"Block notification listener stopped, reconnecting: {str(e)}")
+                time.sleep(30)
+
+
+    def dispatch(self, payload, authorization):
+        """
+        Wake the processing loop if a webhook payload is a block of a watched delegate
+
+        Args:
+            payload: Webhook body with event and data keys
+            authorization: Authorization header sent with the webhook
+        """
+        if authorization not in self.tokens or payload.get('event') not in self.block_events:
+            return
+        public_key = (payload.get('data') or {}).get('generatorPublicKey')
+        if public_key in self.public_keys:
+            self.logger.debug(f"Block event for {public_key} at height {payload['data'].get('height')}")
+            self.event.set()
+
+
+    def wait(self, timeout):
+        """
+        Wait for a block event or the polling timeout
+
+        Returns:
+            True if a block event arrived before the timeout
+        """
+        arrived = self.event.wait(timeout)
+        self.event.clear()
+        return arrived
@@ -54,20 +54,20 @@ class Initialize:
             
         print("Storing forged blocks in database")
         self.logger.info(f"Storing {len(total_blocks)} forged blocks in database")
-        self.sql.store_blocks(total_blocks)
+        stored_blocks = self.sql.store_blocks(total_blocks)
             
         print("Marking blocks processed up to starting block {}".format(self.config.start_block))
         self.logger.info(f"Marking blocks processed up to starting block {self.config.start_block}")
         self.sql.mark_processed(self.config.start_block, initial = "Y")
-        processed_blocks = self.sql.processed_blocks().fetchall()
+        processed_blocks = self.sql.processed_block_count()
         self.sql.close_connection()
             
-        print("Total blocks imported - {}".format(len(total_blocks)))
-        print("Total blocks marked as processed - {}".format(len(processed_blocks)))
+        print("Total blocks imported - {}".format(stored_blocks))
+        print("Total blocks marked as processed - {}".format(processed_blocks))
         print("Finished setting up database")
         
-        self.logger.info(f"Total blocks imported: {len(total_blocks)}")
-        self.logger.info(f"Total blocks marked as processed: {len(processed_blocks)}")
+        self.logger.info(f"Total blocks imported: {stored_blocks}")
+        self.logger.info(f"Total blocks marked as processed: {processed_blocks}")
         self.logger.info("Finished setting up database")
 
     
@@ -77,6 +77,6 @@ class Initialize:
         self.sql.open_connection()
         accounts = [i for i in self.config.delegate_fee_address]
         self.logger.debug(f"Storing delegate rewards for accounts: {accounts}")
-        self.sql.store_delegate_rewards(accounts)
+        count = self.sql.store_delegate_rewards(accounts)
         self.sql.close_connection()
-        self.logger.info("Delegate reward records updated")
+        self.logger.info(f"Delegate reward records updated, {count} new accounts")
@@ -0,0 +1,141 @@
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Kernel:
+    def __init__(self, config, sql):
+        """
+        Initialize the vectorized allocation kernel
+
+        Processes the voter options and splits block rewards with numpy arrays instead
+        of looping over dictionaries. Results match the Voters and Allocate dictionary
+        path exactly, the float operations are the same IEEE operations in the same order.
+
+        Args:
+            config: DelegateConfig instance for the specific delegate
+            sql: SQL connection for TBW data
+        """
+        self.config = config
+        self.sql = sql
+
+        # Set up logging
+        self.logger = logging.getLogger(f'kernel_{config.username}')
+
+        self.enabled = self.config.vectorize == "Y"
+        if self.enabled and np is None:
+            self.logger.warning("Vectorized allocation requested but numpy is not installed, using dictionary path")
+            self.enabled = False
+        if self.enabled:
+            self.logger.info(f"Vectorized allocation enabled for delegate: {config.username}")
+
+
+    def accepts(self, voters):
+        """
+        Check if the kernel can allocate rewards for the given voters bit-for-bit
+
+        Python divides integers with exact rounding, numpy converts both operands to
+        float64 first. Both agree as long as every balance fits the 53 bit mantissa.
+        A zero total is left to the dictionary path, which raises ZeroDivisionError
+        instead of handing out inf/nan rewards.
+
+        Args:
+            voters: Dictionary of voter addresses and their balances
+
+        Returns:
+            True if the vectorized path can be used
+        """
+        return self.enabled and sum(voters.values()) != 0 and sum(abs(v) for v in voters.values()) < 2 ** 53
+
+
+    def process_voters(self, voter_balances, unpaid=None):
+        """
+        Apply whitelist/blacklist, voter cap, voter minimum and anti-dilution in one pass
+
+        Args:
+            voter_balances: Dictionary of voter addresses and their balances
+            unpaid: Optional dictionary of voter unpaid balances, read from the database if omitted
+
+        Returns:
+            Dictionary of voter addresses with all voter options applied
+        """
+        self.logger.debug(f"Processing voter options for {len(voter_balances)} voters")
+        addresses = list(voter_balances.keys())
+        balances = np.fromiter(voter_balances.values(), dtype=np.int64, count=len(addresses))
+
+        # whitelist/blacklist masking
+        if self.config.whitelist == 'Y':
+            keep = np.fromiter((k in self.config.whitelist_address for k in addresses), dtype=bool, count=len(addresses))
+        elif self.config.whitelist == 'N' and self.config.blacklist == 'Y':
+            keep = np.fromiter((k not in self.config.blacklist_address for k in addresses), dtype=bool, count=len(addresses))
+        else:
+            keep = None
+        if keep is not None:
+            addresses = [k for k, m in zip(addresses, keep) if m]
+            balances = balances[keep]
+
+        # voter cap
+        if self.config.voter_cap != 0:
+            max_votes = int(self.config.voter_cap * self.config.atomic)
+            balances = np.minimum(balances, max_votes)
+
+        # voter minimum
+        if self.config.voter_min != 0:
+            min_votes = int(self.config.voter_min * self.config.atomic)
+            balances = np.where(balances > min_votes, balances, 0)
+
+        # anti-dilution
+        if unpaid is None:
+            self.sql.open_connection()
+            dilute = self.sql.all_voters().fetchall()
+            self.sql.close_connection()
+            unpaid = {i[0]:i[2] for i in dilute}
+        balances = balances + np.fromiter((unpaid[k] for k in addresses), dtype=np.int64, count=len(addresses))
+
+        self.logger.info(f"Voter options processed for {len(addresses)} voters")
+        return dict(zip(addresses, balances.tolist()))
+
+
+    def voter_allocations(self, block, voters, voter_shares, delegate_unpaid):
+        """
+        Split the voter share of a block reward by vote weight
+
+        Args:
+            block: Block row being allocated
+            voters: Dictionary of voter addresses and their processed balances
+            voter_shares: Dictionary of voter addresses and their share rates
+            delegate_unpaid: Dictionary of delegate rewards, custom share remainders are added to the reserve
+
+        Returns:
+            Dictionary of voter addresses and their block rewards
+        """
+        addresses = list(voters.keys())
+        count = len(addresses)
+        balances = np.fromiter(voters.values(), dtype=np.int64, count=count)
+        shares = np.fromiter((voter_shares[k] for k in addresses), dtype=np.float64, count=count)
+
+        block_reward = block[2]
+        config_voter_share = self.config.voter_share
+        total_delegate_vote_balance = int(balances.sum())
+
+        # skip 0 balances
+        paid = balances > 0
+        share_weight = np.zeros(count, dtype=np.float64)
+        share_weight[paid] = balances[paid].astype(np.float64) / float(total_delegate_vote_balance)
+
+        voter_block_share = (shares / 100) * block_reward
+        rewards = np.trunc(share_weight * voter_block_share).astype(np.int64)
+
+        # custom share rates hand the difference to the standard rate back to the reserve account
+        custom = paid & (shares != config_voter_share)
+        if custom.any():
+            standard_voter_share = (config_voter_share / 100) * block_reward
+            standard = np.trunc(share_weight[custom] * standard_voter_share).astype(np.int64)
+            remainder = int((standard - rewards[custom]).sum())
+            delegate_unpaid[self.config.delegate_fee_address[0]] += remainder
+            self.logger.debug(f"{int(custom.sum())} voters have custom share rates, remainder {remainder} goes to delegate")
+
+        return dict(zip(addresses, rewards.tolist()))
@@ -0,0 +1,75 @@
+from bisect import bisect_right
+from itertools import accumulate
+import logging
+
+class Ledger:
+    def __init__(self, network):
+        """
+        Initialize the shared balance ledger of a network
+
+        Holds every balance change of the voters of all delegates on the network for
+        a block range, read from core once per cycle and shared by each delegate's
+        allocation step instead of every delegate scanning core for every block.
+
+        Args:
+            network: Network identifier (e.g. "ark_mainnet")
+        """
+        self.network = network
+        self.timestamp = None
+        self.starts = {}
+        self.timestamps = {}
+        self.totals = {}
+
+        # Set up logging
+        self.logger = logging.getLogger(f'ledger_{network}')
+
+
+    def load(self, database, voter_roll, timestamp, chkpoint_timestamps):
+        """
+        Read the balance changes of every voter in the roll from core
+
+        Args:
+            database: Database connection for blockchain data
+            voter_roll: List of [address, public_key] pairs
+            timestamp: Timestamp to read balance changes up to
+            chkpoint_timestamps: Dictionary of address to the timestamp to read from, missing addresses start at 0
+        """
+        database.open_connection()
+        deltas = database.get_balance_deltas(voter_roll, timestamp, chkpoint_timestamps)
+        database.close_connection()
+
+        self.timestamp = timestamp
+        self.starts = {i[0]:chkpoint_timestamps.get(i[0], 0) for i in voter_roll}
+        self.timestamps = {}
+        amounts = {}
+        for address, ts, amount in deltas:
+            self.timestamps.setdefault(address, []).append(ts)
+            amounts.setdefault(address, []).append(amount)
+        # running totals so any range is two lookups
+        self.totals = {k:[0] + list(accumulate(v)) for k, v in amounts.items()}
+
+        self.logger.info(f"Loaded {len(deltas)} balance changes for {len(voter_roll)} voters up to timestamp {timestamp}")
+
+
+    def covers(self, address, after, upto):
+        """Check if the balance changes of address between after and upto were loaded"""
+        return address in self.starts and self.starts[address] <= after and upto <= self.timestamp
+
+
+    def delta(self, address, after, upto):
+        """
+        Get the balance change of an address
+
+        Args:
+            address: Voter address
+            after: Timestamp to sum from, exclusive
+            upto: Timestamp to sum up to, inclusive
+
+        Returns:
+            Sum of the balance changes of address after the first and up to the second timestamp
+        """
+        timestamps = self.timestamps.get(address)
+        if not timestamps:
+            return 0
+        totals = self.totals[address]
+        return totals[bisect_right(timestamps, upto)] - totals[bisect_right(timestamps, after)]
@@ -1,10 +1,60 @@
+from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from itertools import repeat
+from crypto.configuration.network import set_custom_network
+from crypto.identity.private_key import PrivateKey
+from crypto.identity.public_key import PublicKey
+from crypto.schnorr import schnorr
 from crypto.transactions.builder.transfer import Transfer
 from crypto.transactions.builder.multi_payment import MultiPayment
-import time
 import logging
 
+
+def derive_keys(passphrase, secondphrase):
+    """
+    Derive the keys of the delegate wallet once per payment run
+
+    Args:
+        passphrase: Delegate passphrase
+        secondphrase: Second passphrase or None
+
+    Returns:
+        Tuple of public key, secret and second secret or None
+    """
+    secret = unhexlify(PrivateKey.from_passphrase(passphrase).to_hex())
+    second_secret = unhexlify(PrivateKey.from_passphrase(secondphrase).to_hex()) if secondphrase is not None else None
+    return PublicKey.from_passphrase(passphrase), secret, second_secret
+
+
+def sign_transaction(transaction, network, keys):
+    """
+    Sign a built transaction with derived keys, runs in a signing process when one is shared
+
+    Same signatures as schnorr_sign and second_sign of the builder, without deriving
+    the keys from the passphrases for every transaction.
+
+    Args:
+        transaction: Transfer or MultiPayment builder with its nonce set
+        network: Epoch, version and wif of the network to sign for
+        keys: Public key, secret and second secret from derive_keys
+
+    Returns:
+        Transaction dictionary
+    """
+    set_custom_network(*network)
+    public_key, secret, second_secret = keys
+    tx = transaction.transaction
+    tx.senderPublicKey = public_key
+    tx.signature = hexlify(schnorr.bcrypto410_sign(sha256(tx.to_bytes(False, True, False)).digest(), secret))
+    if second_secret is not None:
+        tx.signSignature = hexlify(schnorr.bcrypto410_sign(sha256(tx.to_bytes(False, True, False)).digest(), second_secret))
+    tx.id = tx.get_id()
+    return transaction.to_dict()
+
+
 class Payments:
-    def __init__(self, config, sql, dynamic, utility, exchange):
+    def __init__(self, config, sql, dynamic, utility, exchange, executor=None):
         """
         Initialize the Payments module
         
@@ -14,44 +64,29 @@ class Payments:
             dynamic: Dynamic fee calculator
             utility: Utility instance for network operations
             exchange: Exchange processor for currency conversions
+            executor: Optional process pool to sign transactions in
         """
         self.config = config
         self.sql = sql
         self.dynamic = dynamic
         self.utility = utility
         self.exchange = exchange
+        self.executor = executor
         self.client = self.utility.get_client()
+        self.peers = self.utility.get_peer_clients()
         
         # Set up logging
         self.logger = logging.getLogger(f'payments_{config.username}')
         self.logger.info(f"Initializing Payments module for delegate: {config.username}")
 
-    
-    def non_accept_check(self, c, a):
-        """
-        Check for transactions that were not accepted by the network
-        
-        Args:
-            c: Dictionary of transaction IDs and values
-            a: List of accepted transaction IDs
-            
-        Returns:
-            List of transactions that were not accepted
-        """
-        self.logger.debug(f"Checking {len(c)} transactions for acceptance")
-        removal_check = []
-        for k, v in c.items():
-            if k not in a:
-                self.logger.warning(f"Transaction ID {k} not accepted by network")
-                print("Transaction ID Not Accepted")
-                removal_check.append(v)
-                self.sql.open_connection()
-                self.sql.delete_transaction_record(k)
-                self.sql.close_connection()
-                
-        self.logger.info(f"Found {len(removal_check)} transactions not accepted")
-        return removal_check
-    
+        # keys are derived once per payment run
+        sp = self.config.secondphrase
+        if sp == 'None':
+            sp = None
+        if sp is not None:
+            self.logger.debug("Second signature will be applied")
+        self.keys = derive_keys(self.config.passphrase, sp)
+
     
     def get_nonce(self):
         """Get the current nonce for the delegate wallet"""
@@ -61,8 +96,24 @@ class Payments:
         self.logger.debug(f"Current nonce: {nonce}")
         return nonce
 
+
+    def get_pending(self):
+        """Get the number of delegate wallet transactions waiting in the pool, 0 if the pool can not be read"""
+        try:
+            pending = int(self.client.transactions.all_unconfirmed(limit=1, senderPublicKey=self.keys[0])['meta']['totalCount'])
+        except Exception as e:
+            self.logger.warning(f"Could not read unconfirmed transactions: {str(e)}")
+            return 0
+        self.logger.debug(f"{pending} transactions waiting in the pool")
+        return pending
+
+
+    def get_pool_nonce(self):
+        """Get the nonce of the delegate wallet including its transactions waiting in the pool"""
+        return self.get_nonce() + self.get_pending()
+
     
-    def build_transfer_transaction(self, address, amount, vendor, fee, nonce):
+    def build_transfer_transaction(self, address, amount, vendor, fee, nonce, sign=True):
         """
         Build a transfer transaction
         
@@ -72,38 +123,33 @@ class Payments:
             vendor: Vendor field message
             fee: Transaction fee
             nonce: Current nonce value
+            sign: Sign the transaction, unsigned builders are signed together with sign_all
             
         Returns:
-            Transaction dictionary
+            Transaction dictionary, the unsigned builder if sign is False
         """
         self.logger.debug(f"Building transfer transaction to {address} for {amount} with nonce {nonce}")
         # python3 crypto version    
         transaction = Transfer(recipientId=address, amount=amount, vendorField=vendor, fee=fee)
         transaction.set_nonce(int(nonce))
-        transaction.schnorr_sign(self.config.passphrase)
-
-        sp = self.config.secondphrase
-        if sp == 'None':
-            sp = None
-        if sp is not None:
-            self.logger.debug("Applying second signature")
-            transaction.second_sign(sp)
-
-        transaction_dict = transaction.to_dict()
+        if not sign:
+            return transaction
+        transaction_dict = self.sign(transaction)
         self.logger.debug(f"Transaction built with ID: {transaction_dict['id']}")
         return transaction_dict
 
 
-    def build_multi_transaction(self, payments, nonce):
+    def build_multi_transaction(self, payments, nonce, sign=True):
         """
         Build a multi-payment transaction
         
         Args:
             payments: List of payment details
             nonce: Current nonce value
+            sign: Sign the transaction, unsigned builders are signed together with sign_all
             
         Returns:
-            Transaction dictionary
+            Transaction dictionary, the unsigned builder if sign is False
         """
         self.logger.debug(f"Building multi-payment transaction with {len(payments)} payments and nonce {nonce}")
         # f = int(self.config.multi_fee * self.config.atomic)
@@ -123,49 +169,141 @@ class Payments:
                 transaction.add_payment(i[2], i[1])
                 self.logger.debug(f"Added direct payment of {i[2]} to {i[1]}")
 
-        transaction.schnorr_sign(self.config.passphrase)
-        sp = self.config.secondphrase
-        if sp == 'None':
-            sp = None
-        if sp is not None:
-            self.logger.debug("Applying second signature")
-            transaction.second_sign(sp)
-        transaction_dict = transaction.to_dict()
+        if not sign:
+            return transaction
+        transaction_dict = self.sign(transaction)
         self.logger.debug(f"Multi-payment transaction built with ID: {transaction_dict['id']}")
         return transaction_dict
     
     
-    def broadcast_standard(self, tx):
+    def sign(self, transaction):
         """
-        Broadcast standard transfer transactions to the network
-        
+        Sign a transaction with the delegate keys
+
+        Args:
+            transaction: Transfer or MultiPayment builder
+
+        Returns:
+            Transaction dictionary
+        """
+        return self.sign_all([transaction])[0]
+
+
+    def sign_all(self, transactions):
+        """
+        Sign transactions with the delegate keys, across the signing processes if there are any
+
+        Nonces are set when the transactions are built, so the signed transactions are
+        the same however they are spread over the processes.
+
+        Args:
+            transactions: List of Transfer or MultiPayment builders
+
+        Returns:
+            List of transaction dictionaries in the same order
+        """
+        network = self.utility.get_network_settings()
+        if self.executor is None:
+            signed = [sign_transaction(i, network, self.keys) for i in transactions]
+        else:
+            signed = list(self.executor.map(sign_transaction, transactions, repeat(network), repeat(self.keys)))
+        self.logger.debug(f"Signed {len(signed)} transactions")
+        return signed
+    
+    
+    def relay(self, tx):
+        """
+        Post signed transactions to the node and its peers, safe to run while the next batch is built
+
+        Peers are posted to concurrently, a transaction accepted by any of them is accepted.
+
         Args:
             tx: List of transaction dictionaries
-            
+
         Returns:
             List of accepted transaction IDs
         """
-        self.logger.info(f"Broadcasting {len(tx)} standard transactions")
-        # broadcast to relay
-        try:
-            transaction = self.client.transactions.create(tx)
-            self.logger.debug(f"Broadcast response: {transaction}")
+        clients = [self.client] + self.peers
+        with ThreadPoolExecutor(max_workers=len(clients)) as relays:
+            futures = [relays.submit(i.transactions.create, tx) for i in clients]
+
+        accepted = {}
+        errors = []
+        for client, future in zip(clients, futures):
+            try:
+                transaction = future.result()
+            except Exception as e:
+                self.logger.warning(f"Error relaying transactions to {client.connection.hostname}: {str(e)}")
+                errors.append(e)
+                continue
+            self.logger.debug(f"Broadcast response from {client.connection.hostname}: {transaction}")
             print(transaction)
-            records = [[j['recipientId'], j['amount'], j['id']] for j in tx]
-            self.logger.info(f"Transactions created: {len(records)} records")
-            time.sleep(1)
-        except Exception as e:
+            accepted.update(dict.fromkeys(transaction['data']['accept']))
+
+        if len(errors) == len(clients):
             # error
-            self.logger.error(f"Error broadcasting transactions: {str(e)}")
-            print("Something went wrong", e)
+            self.logger.error(f"Error broadcasting transactions: {str(errors[0])}")
+            print("Something went wrong", errors[0])
             quit()
 
+        return list(accepted)
+
+
+    def record_standard(self, tx):
+        """
+        Store the payment records of broadcast standard transactions
+
+        Args:
+            tx: List of transaction dictionaries
+        """
+        records = [[j['recipientId'], j['amount'], j['id'], int(j['nonce'])] for j in tx]
+        self.logger.info(f"Transactions created: {len(records)} records")
+
         self.sql.open_connection()
-        self.sql.store_transactions(records)
+        stored = self.sql.store_transactions(records)
         self.sql.close_connection()
+
+        self.logger.info(f"Stored {stored} transaction records")
+
+
+    def record_multi(self, tx):
+        """
+        Store the payment records of broadcast multi-payment transactions
+
+        Args:
+            tx: List of multi-payment transaction dictionaries
+        """
+        records = []
+        for i in tx:
+            id = i['id']
+            self.logger.debug(f"Processing multi-payment transaction {id} with {len(i['asset']['payments'])} payments")
+            tx_records = [[j['recipientId'], j['amount'], id, int(i['nonce'])] for j in i['asset']['payments']]
+            records.extend(tx_records)
+
+        self.logger.info(f"Multi-payment transactions created: {len(records)} total payment records")
+
+        self.sql.open_connection()
+        stored = self.sql.store_transactions(records)
+        self.sql.close_connection()
+
+        self.logger.info(f"Stored {stored} transaction records")
+
+
+    def broadcast_standard(self, tx):
+        """
+        Broadcast standard transfer transactions to the network
         
-        self.logger.info(f"Stored {len(records)} transaction records")
-        return transaction['data']['accept']
+        Args:
+            tx: List of transaction dictionaries
+            
+        Returns:
+            List of accepted transaction IDs
+        """
+        self.logger.info(f"Broadcasting {len(tx)} standard transactions")
+        # broadcast to relay
+        accepted = self.relay(tx)
+        self.record_standard(tx)
+        return accepted
     
     
     def broadcast_multi(self, tx):    
@@ -180,29 +318,6 @@ class Payments:
         """
         self.logger.info(f"Broadcasting {len(tx)} multi-payment transactions")
         # broadcast to relay
-        try:
-            transaction = self.client.transactions.create(tx)
-            self.logger.debug(f"Broadcast response: {transaction}")
-            print(transaction)
-            
-            records = []
-            for i in tx:
-                id = i['id']
-                self.logger.debug(f"Processing multi-payment transaction {id} with {len(i['asset']['payments'])} payments")
-                tx_records = [[j['recipientId'], j['amount'], id] for j in i['asset']['payments']]
-                records.extend(tx_records)
-                
-            self.logger.info(f"Multi-payment transactions created: {len(records)} total payment records")
-            time.sleep(1)
-        except Exception as e:
-            # error
-            self.logger.error(f"Error broadcasting multi-payment transactions: {str(e)}")
-            print("Something went wrong", e)
-            quit()
-    
-        self.sql.open_connection()
-        self.sql.store_transactions(records)
-        self.sql.close_connection()
-        
-        self.logger.info(f"Stored {len(records)} transaction records")
-        return transaction['data']['accept']
+        accepted = self.relay(tx)
+        self.record_multi(tx)
+        return accepted
@@ -0,0 +1,95 @@
+import logging
+
+class NonceSequencer:
+    def __init__(self, config, sql, payments):
+        """
+        Initialize the nonce sequencer of the delegate wallet
+
+        Batches broadcast back to back take their nonces from the last nonce used,
+        kept in tbw.db, instead of asking the node for every batch. It is reconciled
+        with the node and its pool when a payment run starts and after rejections.
+
+        Args:
+            config: DelegateConfig instance for the specific delegate
+            sql: SQL connection for TBW data
+            payments: Payments instance to read the node nonce with
+        """
+        self.config = config
+        self.sql = sql
+        self.payments = payments
+
+        # Set up logging
+        self.logger = logging.getLogger(f'sequencer_{config.username}')
+
+
+    def reconcile(self, reset=False):
+        """
+        Bring the last used nonce up to the node nonce, counting transactions waiting in the pool
+
+        Args:
+            reset: Use the node nonce even if the stored one is ahead, after every transaction of a batch was rejected
+
+        Returns:
+            Last used nonce
+        """
+        node_nonce = self.payments.get_pool_nonce()
+        self.sql.open_connection()
+        nonce = self.sql.get_nonce(self.config.delegate)
+        if nonce is None or reset or node_nonce > nonce:
+            self.logger.info(f"Nonce reconciled with the node from {nonce} to {node_nonce}")
+            nonce = node_nonce
+            self.sql.update_nonce(self.config.delegate, nonce)
+        self.sql.close_connection()
+        return nonce
+
+
+    def reserve(self, count):
+        """
+        Reserve consecutive nonces for a batch
+
+        Args:
+            count: Number of transactions in the batch
+
+        Returns:
+            First nonce of the batch
+        """
+        self.sql.open_connection()
+        nonce = self.sql.get_nonce(self.config.delegate)
+        self.sql.update_nonce(self.config.delegate, nonce + count)
+        self.sql.close_connection()
+        self.logger.debug(f"Reserved nonces {nonce + 1} to {nonce + count}")
+        return nonce + 1
+
+
+    def release(self, rejected, accepted):
+        """
+        Return the nonces of rejected transactions after a broadcast
+
+        Args:
+            rejected: Nonces of the rejected transactions
+            accepted: Number of accepted transactions
+        """
+        if not rejected:
+            return
+        if not accepted:
+            # nothing of the batch reached the pool, the stored nonce may be stale
+            self.reconcile(reset=True)
+            return
+
+        # transactions after the first rejected nonce can not be forged
+        self.rewind(min(rejected))
+        self.logger.info(f"{len(rejected)} transactions rejected, next nonce is {min(rejected)}")
+        self.reconcile()
+
+
+    def rewind(self, nonce):
+        """
+        Give back the reserved nonces from nonce on, their transactions never reached the pool
+
+        Args:
+            nonce: First nonce to use again
+        """
+        self.sql.open_connection()
+        self.sql.update_nonce(self.config.delegate, nonce - 1)
+        self.sql.close_connection()
+        self.logger.debug(f"Released nonces from {nonce} on")
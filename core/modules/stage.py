@@ -124,8 +124,9 @@ class Stage:
         print("Delegate Payments\n", paid_delegate)
         
         self.sql.open_connection()
-        self.sql.update_delegate_paid_balance(paid_delegate)
-        self.sql.stage_payment(paid_delegate, msg = "Reward")
+        with self.sql.transaction():
+            self.sql.update_delegate_paid_balance(paid_delegate)
+            self.sql.stage_payment(paid_delegate, msg = "Reward")
         self.sql.close_connection()
         
         self.logger.info("Delegate payments staged successfully")
@@ -141,8 +142,9 @@ class Stage:
         self.logger.debug(f"Staging {len(non_zero_voters)} non-zero voter payments")
         
         self.sql.open_connection()
-        self.sql.update_voter_paid_balance(self.voters)
-        self.sql.stage_payment(non_zero_voters, msg = self.config.message)
+        with self.sql.transaction():
+            self.sql.update_voter_paid_balance(self.voters)
+            self.sql.stage_payment(non_zero_voters, msg = self.config.message)
         self.sql.close_connection()
         
         self.logger.info("Voter payments staged successfully")
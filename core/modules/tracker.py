@@ -0,0 +1,199 @@
+from client.exceptions import ArkHTTPException
+from datetime import datetime, timedelta
+from crypto.identity.public_key import PublicKey
+from utility.sql import Sql
+import logging
+import threading
+
+
+class ConfirmationTracker:
+    def __init__(self, config, utility, dynamic):
+        """
+        Initialize the confirmation tracker of broadcast payments
+
+        A background thread polls the node every block for the transactions that are
+        not confirmed yet, in bulk. Forged transactions get their confirmed_at set.
+        A transaction in the pool of any node it was broadcast to is never dropped.
+        Otherwise it is dropped, and its payments staged again for the next payment
+        run, once no node knows it or once the wallet nonce has passed its nonce
+        without forging it. Only when no pool can be read at all a transaction older
+        than the pool keeps transactions is dropped. The thread has its own SQLite
+        connection, so payment runs are never waiting for it.
+
+        Args:
+            config: DelegateConfig instance for the specific delegate
+            utility: Utility instance for network operations
+            dynamic: Dynamic instance to read the block time and pool expiry with
+        """
+        self.config = config
+        self.dynamic = dynamic
+        self.client = utility.get_client()
+        # every node a transaction was broadcast to
+        self.clients = [self.client] + utility.get_peer_clients()
+        self.public_key = PublicKey.from_passphrase(config.passphrase)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.restaged = threading.Event()
+
+        # Set up logging
+        self.logger = logging.getLogger(f'tracker_{config.username}')
+
+
+    def start(self):
+        """Start polling in the background"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=f"tracker_{self.config.username}", daemon=True)
+            self.thread.start()
+            self.logger.info("Started confirmation tracker")
+
+
+    def stop(self):
+        """Stop polling and wait for the thread to finish"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def take_restaged(self):
+        """Check if payments were staged again since the last check, their nonces have to be reused"""
+        restaged = self.restaged.is_set()
+        self.restaged.clear()
+        return restaged
+
+
+    def run(self):
+        sql = Sql(self.config.username)
+        while not self.stopped.wait(self.dynamic.get_blocktime()):
+            try:
+                self.poll(sql)
+            except Exception as e:
+                self.logger.error(f"Error tracking confirmations: {str(e)}")
+
+
+    def poll(self, sql):
+        """
+        Check the transactions broadcast at least two blocks ago that are not confirmed yet
+
+        Args:
+            sql: SQL connection of the tracker thread
+
+        Returns:
+            Tuple of the number of confirmed and dropped transactions
+        """
+        blocktime = self.dynamic.get_blocktime()
+        before = (datetime.now() - timedelta(seconds=2 * blocktime)).strftime('%Y-%m-%d %H:%M:%S')
+        expired = (datetime.now() - timedelta(seconds=self.dynamic.get_max_transaction_age() * blocktime)).strftime('%Y-%m-%d %H:%M:%S')
+        sql.open_connection()
+        rows = sql.unconfirmed_transactions(before).fetchall()
+        sql.close_connection()
+        if not rows:
+            return 0, 0
+        txids = [i[0] for i in rows]
+
+        # the pools and the wallet nonce are read before the forged transactions,
+        # a transaction forged in between is still found
+        pool, read = self.get_pools()
+        confirmed = self.get_confirmed_nonce()
+        forged = self.get_forged(txids)
+
+        # the node expires pool transactions by height, missed slots make the clock run ahead of it,
+        # so a payment is never staged again while a pool still holds its transaction
+        dropped = []
+        for txid, processed_at, nonce in rows:
+            if txid in forged or txid in pool:
+                continue
+            found = self.lookup(txid)
+            if found:
+                forged.append(txid)
+            elif confirmed is not None and nonce is not None and nonce <= confirmed:
+                # another transaction took its nonce, it can not be forged anymore
+                dropped.append(txid)
+            elif found is False and read == len(self.clients):
+                dropped.append(txid)
+            elif read == 0 and processed_at <= expired:
+                dropped.append(txid)
+
+        sql.open_connection()
+        sql.confirm_transactions(forged)
+        restaged = sql.restage_transactions(dropped) if dropped else 0
+        sql.close_connection()
+
+        self.logger.info(f"{len(forged)} of {len(txids)} transactions confirmed, {len(dropped)} dropped")
+        if dropped:
+            self.logger.warning(f"Transactions dropped from the pool, {restaged} payments staged again: {dropped}")
+            print(f"{len(dropped)} Transactions Dropped, Payments Staged Again")
+            self.restaged.set()
+        return len(forged), len(dropped)
+
+
+    def get_pools(self):
+        """
+        Get the IDs of the delegate wallet transactions waiting in the pool of any node
+
+        Returns:
+            Tuple of the transaction IDs and the number of nodes whose pool could be read
+        """
+        pool = set()
+        read = 0
+        for client in self.clients:
+            try:
+                pool.update(self.get_pool(client))
+                read += 1
+            except ArkHTTPException as e:
+                self.logger.warning(f"Could not read the pool of {client.connection.hostname}: {str(e)}")
+        return pool, read
+
+
+    def get_pool(self, client):
+        """Get the IDs of the delegate wallet transactions waiting in the pool of a node"""
+        pool = set()
+        while True:
+            page = client.transactions.all_unconfirmed(limit=100, offset=len(pool), senderPublicKey=self.public_key)
+            pool.update(i['id'] for i in page['data'])
+            if not page['data'] or len(pool) >= page['meta']['totalCount']:
+                return pool
+
+
+    def get_confirmed_nonce(self):
+        """Get the nonce of the last forged transaction of the delegate wallet, None if the node can not tell"""
+        try:
+            return int(self.client.wallets.get(self.config.delegate)['data']['nonce'])
+        except ArkHTTPException as e:
+            self.logger.warning(f"Could not read the wallet nonce: {str(e)}")
+            return None
+
+
+    def get_forged(self, txids):
+        """
+        Get the forged transactions among txids, 100 per request
+
+        Returns:
+            List of forged transaction IDs
+        """
+        forged = []
+        for i in range(0, len(txids), 100):
+            page = self.client.transactions.all(limit=100, id=txids[i:i+100])
+            forged.extend(j['id'] for j in page['data'] if j['id'] in txids and j.get('confirmations', 0) > 0)
+        return forged
+
+
+    def lookup(self, txid):
+        """
+        Look up a single transaction on every node
+
+        Returns:
+            True if it is forged, False if no node knows it, None if a node can not tell
+        """
+        found = False
+        for client in self.clients:
+            try:
+                if client.transactions.get(txid)['data'].get('confirmations', 0) > 0:
+                    return True
+                # known but not forged yet
+                found = None
+            except ArkHTTPException as e:
+                if e.response is None or e.response.status_code != 404:
+                    self.logger.warning(f"Could not look up transaction {txid} on {client.connection.hostname}: {str(e)}")
+                    found = None
+        return found
@@ -141,12 +141,13 @@ class Voters():
         return adjusted_voters
     
     
-    def process_anti_dilution(self, voter_balances):
+    def process_anti_dilution(self, voter_balances, unpaid=None):
         """
         Apply anti-dilution - include unpaid balances in vote weight
         
         Args:
             voter_balances: Dictionary of voter addresses and their balances
+            unpaid: Optional dictionary of voter unpaid balances, read from the database if omitted
             
         Returns:
             Dictionary of voter addresses with anti-dilution applied
@@ -154,11 +155,11 @@ class Voters():
         self.logger.debug(f"Processing anti-dilution with {len(voter_balances)} voters")
         adjusted_voters = {}
         
-        self.sql.open_connection()
-        dilute = self.sql.all_voters().fetchall()
-        self.sql.close_connection()
-        
-        unpaid = {i[0]:i[2] for i in dilute}
+        if unpaid is None:
+            self.sql.open_connection()
+            dilute = self.sql.all_voters().fetchall()
+            self.sql.close_connection()
+            unpaid = {i[0]:i[2] for i in dilute}
         self.logger.debug(f"Retrieved unpaid balances for {len(unpaid)} voters")
         
         for k, v in voter_balances.items():
@@ -38,3 +38,12 @@ class Network:
         self.database_host = c.get("network", "database_host", fallback="127.0.0.1")
         self.user = c.get("network", "user")
         self.password = c.get("network", "password")
+        self.pool_min = int(c.get("network", "pool_min", fallback=1))
+        self.pool_max = int(c.get("network", "pool_max", fallback=4))
+        self.pool_timeout = float(c.get("network", "pool_timeout", fallback=30))
+        self.events = c.get("network", "events", fallback="poll")
+        self.webhooks = int(c.get("network", "webhooks", fallback=4004))
+        self.webhook_host = c.get("network", "webhook_host", fallback="127.0.0.1")
+        self.webhook_port = int(c.get("network", "webhook_port", fallback=4104))
+        self.config_ttl = float(c.get("network", "config_ttl", fallback=300))
+        self.peers = [i.strip() for i in c.get("network", "peers", fallback="").split(",") if i.strip()]
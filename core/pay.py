@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 import argparse
 import logging
+import os
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 from config.delegate_config import DelegateConfig
@@ -9,6 +12,8 @@ from utility.delegate_manager import DelegateManager
 from network.network import Network
 from modules.exchange import Exchange
 from modules.payments import Payments
+from modules.sequencer import NonceSequencer
+from modules.tracker import ConfirmationTracker
 from utility.dynamic import Dynamic
 from utility.sql import Sql
 from utility.utility import Utility
@@ -33,6 +38,10 @@ def setup_logging(delegate_name):
     logger = logging.getLogger(f'pay_{delegate_name}')
     return logger
 
+# signed transactions of one broadcast, check maps transaction ids to their staging rowids
+Batch = namedtuple('Batch', ['multi', 'signed_tx', 'check', 'last_rowid'])
+
+
 def chunks(l, n):
     """Split a list into chunks of size n"""
     # For item i in a range that is a length of l
@@ -41,83 +50,63 @@ def chunks(l, n):
         yield l[i:i+n]
 
 
-def process_multi_payments(payment, unprocessed, dynamic, config, exchange, sql, logger):
-    """Process payments using multi-payment transactions"""
+def build_multi_batch(payment, sequencer, unprocessed, dynamic, config, exchange, logger):
+    """
+    Build and sign multi-payment transactions for a page of staged payments
+
+    Returns:
+        Batch of signed transactions, None if the page holds no multi-payment
+    """
     logger.info(f"Processing multi-payment for {len(unprocessed)} transactions")
     print("Multi Payment")
 
-    signed_tx = []
-    check = {} 
-    request_limit = dynamic.get_tx_request_limit()
     multi_limit = dynamic.get_multipay_limit()
+    logger.debug(f"Multi-payment limit: {multi_limit}")
 
-    logger.debug(f"Transaction request limit: {request_limit}, multi-payment limit: {multi_limit}")
-   
-    if len(unprocessed) == 1:
-        logger.info("Only one payment, using standard payment method")
-        process_standard_payments(payment, unprocessed, dynamic, config, exchange, sql)
-    else:
-        temp_multi_chunk = list(chunks(unprocessed, multi_limit))
-        # remove any items over request_tx_limit
-        multi_chunk = temp_multi_chunk[:request_limit]
-        logger.debug(f"Created {len(multi_chunk)} multi-payment chunks (max {request_limit} of {len(temp_multi_chunk)})")
-        nonce = payment.get_nonce() + 1
-        logger.debug(f"Starting nonce: {nonce}")
-        
-        for i in multi_chunk:
-            if len(i) > 1:
-                unique_rowid = [y[0] for y in i]
-                logger.debug(f"Building multi-payment transaction for {len(i)} payments with nonce {nonce}")
-                tx = payment.build_multi_transaction(i, str(nonce))
-                check[tx['id']] = unique_rowid
-                signed_tx.append(tx)
-                nonce += 1
-                logger.debug(f"Transaction {tx['id']} created with {len(i)} payments")
-        
-        if signed_tx:
-            logger.info(f"Broadcasting {len(signed_tx)} multi-payment transactions")
-            accepted = payment.broadcast_multi(signed_tx)
-            logger.debug(f"Accepted transaction IDs: {accepted}")
-            
-            #check for accepted and non-accepted transactions
-            for k, v in check.items():
-                if k in accepted:
-                    # mark all accepted records complete
-                    logger.info(f"Transaction {k} accepted, marking {len(v)} payments as processed")
-                    sql.open_connection()
-                    sql.process_staged_payment(v)
-                    sql.close_connection()
-                else:
-                    # delete all transaction records with relevant multipay txid
-                    logger.warning(f"Transaction {k} not accepted, deleting transaction record")
-                    print("Transaction ID Not Accepted")
-                    sql.open_connection()
-                    sql.delete_transaction_record(k)
-                    sql.close_connection()
-
-            # payment run complete
-            logger.info('Payment run completed!')
-            print('Payment Run Completed!')
-        else:
-            logger.warning("No transactions to broadcast")
+    if len(unprocessed) == 1 or multi_limit < 2:
+        logger.info("Only one payment per transaction, using standard payment method")
+        return build_standard_batch(payment, sequencer, unprocessed, dynamic, config, exchange, logger)
 
+    # a last chunk of one payment is left for the next page
+    multi_chunk = [i for i in chunks(unprocessed, multi_limit) if len(i) > 1]
+    logger.debug(f"Created {len(multi_chunk)} multi-payment chunks")
+    nonce = sequencer.reserve(len(multi_chunk))
+    logger.debug(f"Starting nonce: {nonce}")
+
+    # nonces are assigned in order before the transactions are signed together
+    built = []
+    for i in multi_chunk:
+        unique_rowid = [y[0] for y in i]
+        logger.debug(f"Building multi-payment transaction for {len(i)} payments with nonce {nonce}")
+        built.append((payment.build_multi_transaction(i, str(nonce), sign=False), unique_rowid))
+        nonce += 1
 
-def process_standard_payments(payment, unprocessed, dynamic, config, exchange, sql, logger):
-    """Process payments using standard transfer transactions"""
-    logger.info(f"Processing standard payments for {len(unprocessed)} transactions")
-    print("Standard Payment")
-    
-    signed_tx = []
     check = {}
+    signed_tx = []
+    for tx, (_, unique_rowid) in zip(payment.sign_all([i[0] for i in built]), built):
+        check[tx['id']] = unique_rowid
+        signed_tx.append(tx)
+        logger.debug(f"Transaction {tx['id']} created with {len(unique_rowid)} payments")
 
-    # process unpaid transactions
-    unique_rowid = [y[0] for y in unprocessed]
-    logger.debug(f"Processing {len(unique_rowid)} unique row IDs")
+    return Batch(True, signed_tx, check, multi_chunk[-1][-1][0])
 
-    temp_nonce = payment.get_nonce() + 1
+
+def build_standard_batch(payment, sequencer, unprocessed, dynamic, config, exchange, logger):
+    """
+    Build and sign standard transfer transactions for a page of staged payments
+
+    Returns:
+        Batch of signed transactions
+    """
+    logger.info(f"Processing standard payments for {len(unprocessed)} transactions")
+    print("Standard Payment")
+
+    temp_nonce = sequencer.reserve(len(unprocessed))
     transaction_fee = dynamic.get_dynamic_fee()
     logger.debug(f"Starting nonce: {temp_nonce}, transaction fee: {transaction_fee}")
         
+    # nonces are assigned in order before the transactions are signed together
+    built = []
     for i in unprocessed:
         # exchange processing
         if i[1] in config.convert_address and config.exchange == "Y":
@@ -125,42 +114,181 @@ def process_standard_payments(payment, unprocessed, dynamic, config, exchange, s
             logger.debug(f"Processing exchange for payment to {i[1]}")
             pay_in = exchange.exchange_select(index, i[1], i[2], config.provider[index])
             logger.debug(f"Exchange address: {pay_in}")
-            tx = payment.build_transfer_transaction(pay_in, (i[2]), i[3], transaction_fee, str(temp_nonce))
+            built.append(payment.build_transfer_transaction(pay_in, (i[2]), i[3], transaction_fee, str(temp_nonce), sign=False))
         # standard tx processing
         else:           
             logger.debug(f"Processing standard payment to {i[1]} for {i[2]}")
-            tx = payment.build_transfer_transaction(i[1], (i[2]), i[3], transaction_fee, str(temp_nonce))
-            
-        check[tx['id']] = i[0]
-        signed_tx.append(tx)
-        logger.debug(f"Transaction {tx['id']} created with nonce {temp_nonce}")
+            built.append(payment.build_transfer_transaction(i[1], (i[2]), i[3], transaction_fee, str(temp_nonce), sign=False))
         temp_nonce += 1
-    
-    if signed_tx:
-        logger.info(f"Broadcasting {len(signed_tx)} standard transactions")
-        accepted = payment.broadcast_standard(signed_tx)
-        logger.debug(f"Accepted transaction IDs: {accepted}")
-        
-        for_removal = payment.non_accept_check(check, accepted)
-                
-        # remove non-accepted transactions from being marked as completed
-        if len(for_removal) > 0:
-            logger.warning(f"{len(for_removal)} transactions were not accepted")
-            for i in for_removal:
-                logger.debug(f"Removing RowId: {i}")
-                print("Removing RowId: ", i)
-                unique_rowid.remove(i)
-                    
-        sql.open_connection()
-        sql.process_staged_payment(unique_rowid)
-        sql.close_connection()
-        logger.info(f"Marked {len(unique_rowid)} payments as processed")
-
-        # payment run complete
-        logger.info('Payment run completed!')
-        print('Payment Run Completed!')
+
+    check = {}
+    signed_tx = []
+    for i, tx in zip(unprocessed, payment.sign_all(built)):
+        check[tx['id']] = [i[0]]
+        signed_tx.append(tx)
+        logger.debug(f"Transaction {tx['id']} created with nonce {tx['nonce']}")
+
+    return Batch(False, signed_tx, check, unprocessed[-1][0])
+
+
+def settle_batch(payment, sequencer, batch, accepted, sql, logger):
+    """
+    Record a broadcast batch and mark its accepted payments processed
+
+    Returns:
+        Number of accepted transactions
+    """
+    logger.debug(f"Accepted transaction IDs: {accepted}")
+    if batch.multi:
+        payment.record_multi(batch.signed_tx)
     else:
-        logger.warning("No transactions to broadcast")
+        payment.record_standard(batch.signed_tx)
+    sequencer.release([int(i['nonce']) for i in batch.signed_tx if i['id'] not in accepted], len(accepted))
+
+    #check for accepted and non-accepted transactions
+    processed = []
+    txids = []
+    for k, v in batch.check.items():
+        if k in accepted:
+            processed.extend(v)
+            txids.extend([k] * len(v))
+        else:
+            # delete all transaction records with relevant txid
+            logger.warning(f"Transaction {k} not accepted, deleting transaction record")
+            print("Transaction ID Not Accepted")
+            sql.open_connection()
+            sql.delete_transaction_record(k)
+            sql.close_connection()
+
+    # mark all accepted records complete, the confirmation tracker follows them up
+    sql.open_connection()
+    sql.process_staged_payment(processed, txids)
+    sql.close_connection()
+    logger.info(f"Marked {len(processed)} payments as processed")
+    return len(accepted)
+
+
+def drain_payments(payment, sequencer, dynamic, config, exchange, sql, logger):
+    """
+    Broadcast staged payments in batches until staging is empty
+
+    The next batch is built and signed while the previous one is being broadcast.
+    Batches are kept within the request limit and the transactions the pool accepts
+    from one sender. When a batch is partly rejected the batch built behind it is
+    dropped, its nonces follow the rejected ones, and paging starts over so the
+    rejected payments are retried. A batch without accepted transactions ends the run,
+    and when no node can be reached the reserved nonces are given back before it stops.
+    """
+    request_limit = dynamic.get_tx_request_limit()
+    multi_limit = dynamic.get_multipay_limit() if config.multi == "Y" else 1
+    sender_limit = dynamic.get_sender_limit()
+    logger.debug(f"Transaction request limit: {request_limit}, multi-payment limit: {multi_limit}, sender limit: {sender_limit}")
+
+    after = 0
+    in_flight = None
+    stalled = 0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"broadcast_{config.username}") as broadcaster:
+        while True:
+            # transactions in flight are not in the pool yet
+            pending = payment.get_pending() + (len(in_flight[0].signed_tx) if in_flight else 0)
+            slots = min(request_limit, sender_limit - pending)
+            unprocessed = []
+            batch = None
+            if slots > 0:
+                sql.open_connection()
+                unprocessed = sql.get_staged_payment(slots * multi_limit, multi='N', after=after).fetchall()
+                sql.close_connection()
+                if unprocessed:
+                    if config.multi == "Y":
+                        batch = build_multi_batch(payment, sequencer, unprocessed, dynamic, config, exchange, logger)
+                    else:
+                        batch = build_standard_batch(payment, sequencer, unprocessed, dynamic, config, exchange, logger)
+                    after = batch.last_rowid
+
+            if in_flight is not None:
+                try:
+                    result = in_flight[1].result()
+                except SystemExit:
+                    # no node took the batch, its nonces and those of the batch built behind it are free again
+                    sequencer.rewind(min(int(i['nonce']) for i in in_flight[0].signed_tx))
+                    raise
+                accepted = settle_batch(payment, sequencer, in_flight[0], result, sql, logger)
+                rejected = accepted < len(in_flight[0].signed_tx)
+                in_flight = None
+                if not accepted:
+                    logger.warning("No transactions of the batch were accepted, remaining payments wait for the next cycle")
+                    break
+                if rejected:
+                    logger.info("Batch partly rejected, rebuilding the remaining payments")
+                    batch = None
+                    after = 0
+                    continue
+
+            if batch is not None:
+                stalled = 0
+                logger.info(f"Broadcasting {len(batch.signed_tx)} {'multi-payment' if batch.multi else 'standard'} transactions")
+                in_flight = (batch, broadcaster.submit(payment.relay, batch.signed_tx))
+            elif slots <= 0:
+                # the pool holds as many transactions of the delegate as it accepts, wait for them to be forged
+                stalled += 1
+                if stalled > 3:
+                    logger.warning(f"{pending} transactions are not being forged, remaining payments wait for the next cycle")
+                    break
+                logger.info(f"{pending} transactions waiting in the pool, waiting for the next block")
+                time.sleep(dynamic.get_blocktime())
+            elif not unprocessed:
+                break
+
+    # payment run complete
+    logger.info('Payment run completed!')
+    print('Payment Run Completed!')
+
+
+def load_payments(delegate_name, logger):
+    """Load a delegate's configuration and connect to its database"""
+    # get configuration for this delegate
+    config = DelegateConfig(delegate_name)
+    logger.info(f"Loaded configuration for delegate: {delegate_name}")
+    
+    # load network
+    network = Network(config.network)
+    logger.info(f"Loaded network configuration: {config.network}")
+    
+    # load utility and dynamic
+    utility = Utility(network)
+    dynamic = Dynamic(utility, config)
+    logger.info("Initialized utility and dynamic modules")
+      
+    # connect to tbw script database and exchange module
+    sql = Sql(delegate_name)
+    exchange = Exchange(sql, config)
+    logger.info("Connected to database and initialized exchange module")
+
+    return config, utility, dynamic, sql, exchange
+
+
+def pay_cycle(config, utility, dynamic, sql, exchange, logger, executor=None, tracker=None):
+    """Broadcast staged payments if there are any"""
+    sql.open_connection()
+    check = sql.unprocessed_staged_payments()
+    sql.close_connection()
+    logger.debug(f"Found {check} unprocessed staged payments")
+
+    if check > 0:
+        # staged payments detected
+        logger.info(f"Staged payments detected: {check} payments")
+        print("Staged Payments Detected.......Begin Payment Processing")
+        # one node configuration request for all fees and limits of the run
+        dynamic.refresh()
+        payments = Payments(config, sql, dynamic, utility, exchange, executor)
+        sequencer = NonceSequencer(config, sql, payments)
+        # nonces of dropped transactions are free again
+        sequencer.reconcile(reset=tracker is not None and tracker.take_restaged())
+        if config.multi == "Y":
+            logger.info("Using multi-payment transactions")
+        else:
+            logger.info("Using standard payment transactions")
+        drain_payments(payments, sequencer, dynamic, config, exchange, sql, logger)
 
 
 def process_delegate_payments(delegate_name):
@@ -169,52 +297,19 @@ def process_delegate_payments(delegate_name):
     logger.info(f"Starting payment process for delegate: {delegate_name}")
     
     try:
-        # get configuration for this delegate
-        config = DelegateConfig(delegate_name)
-        logger.info(f"Loaded configuration for delegate: {delegate_name}")
+        config, utility, dynamic, sql, exchange = load_payments(delegate_name, logger)
+        tracker = ConfirmationTracker(config, utility, dynamic)
+        tracker.start()
         
-        # load network
-        network = Network(config.network)
-        logger.info(f"Loaded network configuration: {config.network}")
-        
-        # load utility and dynamic
-        utility = Utility(network)
-        dynamic = Dynamic(utility, config)
-        logger.info("Initialized utility and dynamic modules")
-          
-        # connect to tbw script database and exchange module
-        sql = Sql(delegate_name)
-        exchange = Exchange(sql, config)
-        logger.info("Connected to database and initialized exchange module")
-        
-        # MAIN FUNCTION LOOP SHOULD START HERE
-        while True:
-            sql.open_connection()
-            check = sql.unprocessed_staged_payments()
-            sql.close_connection()
-            logger.debug(f"Found {check} unprocessed staged payments")
-        
-            if check > 0:
-                # staged payments detected
-                logger.info(f"Staged payments detected: {check} payments")
-                print("Staged Payments Detected.......Begin Payment Processing")
-                payments = Payments(config, sql, dynamic, utility, exchange)
-            
-                sql.open_connection()
-                if config.multi == "Y":
-                    logger.info("Using multi-payment transactions")
-                    unprocessed = sql.get_staged_payment(multi=config.multi).fetchall()
-                    sql.close_connection()
-                    process_multi_payments(payments, unprocessed, dynamic, config, exchange, sql, logger)
-                else:
-                    logger.info("Using standard payment transactions")
-                    unprocessed = sql.get_staged_payment(dynamic.get_tx_request_limit()).fetchall()
-                    sql.close_connection()
-                    process_standard_payments(payments, unprocessed, dynamic, config, exchange, sql, logger)
-     
-            logger.info("Completed payment cycle, sleeping before next check")
-            print("End Script - Looping")
-            time.sleep(1200)
+        # transactions of a payment run are signed in parallel
+        with ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as signer:
+            # MAIN FUNCTION LOOP SHOULD START HERE
+            while True:
+                pay_cycle(config, utility, dynamic, sql, exchange, logger, signer, tracker)
+         
+                logger.info("Completed payment cycle, sleeping before next check")
+                print("End Script - Looping")
+                time.sleep(1200)
             
     except Exception as e:
         logger.error(f"Error in payment process: {str(e)}", exc_info=True)
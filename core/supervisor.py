@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import pay
+import tbw
+from config.delegate_config import DelegateConfig
+from modules.allocate import Allocate
+from modules.events import Events
+from modules.tracker import ConfirmationTracker
+from utility.database import Database
+from utility.delegate_manager import DelegateManager
+
+
+class Worker:
+    def __init__(self, name):
+        """
+        Run the blocking steps of one task on its own thread
+
+        SQLite connections belong to the thread that opened them, so every step of
+        a delegate's tbw or pay loop runs on the same thread while the event loop
+        keeps the other delegates going.
+
+        Args:
+            name: Thread name prefix
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+
+    async def run(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+        except SystemExit as e:
+            # steps quit() on fatal errors, that must only stop this delegate and not the event loop
+            raise RuntimeError(f"Step exited with code {e.code}") from e
+
+
+async def run_tbw(network_name, delegate_names, logger):
+    """TBW loop of all delegates on a network, core is scanned once per cycle and each delegate is isolated"""
+    workers = {i:Worker(f"tbw_{i}") for i in delegate_names}
+    ledger_worker = Worker(f"ledger_{network_name}")
+    ledger_database = None
+    delegates = {}
+    events = None
+
+    while True:
+        # load delegates that are not loaded yet, a delegate that fails is retried on the next cycle
+        for delegate_name in delegate_names:
+            if delegate_name not in delegates:
+                try:
+                    delegates[delegate_name] = await workers[delegate_name].run(tbw.load_delegate, delegate_name, logging.getLogger(f'tbw_{delegate_name}'))
+                except Exception as e:
+                    logger.error(f"Error loading delegate {delegate_name}: {str(e)}")
+                    continue
+                database = delegates[delegate_name][2]
+                if events is None:
+                    events = Events(database.network)
+                    events.watch(database.publickey)
+                    await asyncio.to_thread(events.start, database)
+                else:
+                    await asyncio.to_thread(events.watch, database.publickey)
+
+        async def fetch(delegate_name):
+            config, dynamic, database, sql, cache = delegates[delegate_name]
+            unprocessed_blocks = await workers[delegate_name].run(tbw.fetch_blocks, config, database, sql, logging.getLogger(f'tbw_{delegate_name}'))
+            allocate = await workers[delegate_name].run(Allocate, database, config, sql, cache)
+            # the roll reads the delegate's tbw database, so it is read on the delegate's own thread
+            roll = await workers[delegate_name].run(tbw.ledger_roll, allocate, unprocessed_blocks)
+            return allocate, unprocessed_blocks, roll
+
+        loaded = [i for i in delegate_names if i in delegates]
+        results = await asyncio.gather(*[fetch(i) for i in loaded], return_exceptions=True)
+        pending = {}
+        for delegate_name, result in zip(loaded, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Error fetching blocks for {delegate_name}: {str(result)}")
+            else:
+                pending[delegate_name] = result
+
+        try:
+            if ledger_database is None and pending:
+                # the ledger thread reads core through a Database of its own
+                first = delegates[next(iter(pending))]
+                ledger_database = await ledger_worker.run(Database, first[0], first[2].network, False)
+            ledger = await ledger_worker.run(tbw.load_ledger, network_name, ledger_database, [i[2] for i in pending.values()])
+        except Exception as e:
+            # delegates fall back to their own balance queries
+            logger.error(f"Error loading shared ledger for {network_name}: {str(e)}")
+            ledger = None
+
+        async def process(delegate_name):
+            config, dynamic, database, sql, cache = delegates[delegate_name]
+            allocate, unprocessed_blocks, _ = pending[delegate_name]
+            if unprocessed_blocks:
+                await workers[delegate_name].run(tbw.process_blocks, config, dynamic, database, sql, allocate, unprocessed_blocks, logging.getLogger(f'tbw_{delegate_name}'), ledger)
+
+        names = [i for i in pending if pending[i][1]]
+        results = await asyncio.gather(*[process(i) for i in names], return_exceptions=True)
+        for delegate_name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Error processing blocks for {delegate_name}: {str(result)}")
+
+        logger.info(f"Completed processing cycle for {network_name}, waiting for the next block")
+        if events is not None:
+            await asyncio.to_thread(events.wait, 1200)
+        else:
+            await asyncio.sleep(1200)
+
+
+async def run_pay(delegate_name, signer, logger):
+    """Payment loop of one delegate, errors only pause this delegate"""
+    worker = Worker(f"pay_{delegate_name}")
+    delegate_logger = logging.getLogger(f'pay_{delegate_name}')
+    loaded = None
+    tracker = None
+
+    while True:
+        try:
+            if loaded is None:
+                loaded = await worker.run(pay.load_payments, delegate_name, delegate_logger)
+            if tracker is None:
+                # confirmations are tracked on a thread of their own
+                tracker = ConfirmationTracker(*loaded[:3])
+                tracker.start()
+            await worker.run(pay.pay_cycle, *loaded, delegate_logger, signer, tracker)
+            delegate_logger.info("Completed payment cycle, sleeping before next check")
+            await asyncio.sleep(1200)
+        except Exception as e:
+            logger.error(f"Error in payment loop for {delegate_name}: {str(e)}")
+            await asyncio.sleep(300)
+
+
+async def supervise(delegate_names, signers):
+    """Run the tbw and pay loops of all delegates as tasks in one process"""
+    logger = tbw.setup_logging("supervisor")
+    logger.info(f"Starting supervisor for delegates: {', '.join(delegate_names)}")
+
+    networks = {}
+    for delegate_name in delegate_names:
+        networks.setdefault(DelegateConfig(delegate_name).network, []).append(delegate_name)
+
+    # one process pool signs the transactions of every delegate
+    with ProcessPoolExecutor(max_workers=signers) as signer:
+        tasks = [run_tbw(k, v, logger) for k, v in networks.items()]
+        tasks += [run_pay(i, signer, logger) for i in delegate_names]
+        await asyncio.gather(*tasks)
+
+
+if __name__ == '__main__':
+    print("Start Script")
+
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='True Block Weight Supervisor')
+    parser.add_argument('--delegate', '-d', action='append', help='Delegate name to run, may be repeated', default=None)
+    parser.add_argument('--all', '-a', action='store_true', help='Run all delegates')
+    parser.add_argument('--signers', '-s', type=int, help='Processes to sign transactions in', default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    # Initialize delegate manager
+    delegate_manager = DelegateManager(None)
+
+    if args.all:
+        delegate_names = list(delegate_manager.get_delegate_names())
+    elif args.delegate:
+        delegate_names = args.delegate
+    else:
+        # No arguments provided, show help
+        parser.print_help()
+        delegate_names = []
+
+    if delegate_names:
+        print(f"Supervising {len(delegate_names)} delegates")
+        tbw.resolve_delegates(delegate_names)
+        asyncio.run(supervise(delegate_names, args.signers))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import argparse
 import logging
+import threading
 import time
 from pathlib import Path
 
@@ -9,9 +10,13 @@ from utility.delegate_manager import DelegateManager
 from network.network import Network
 from modules.allocate import Allocate
 from modules.blocks import Blocks
+from modules.catchup import CatchUp
+from modules.events import Events
 from modules.initialize import Initialize
+from modules.ledger import Ledger
 from modules.stage import Stage
 from modules.voters import Voters
+from utility.cache import Cache
 from utility.database import Database
 from utility.dynamic import Dynamic
 from utility.sql import Sql
@@ -139,11 +144,29 @@ def interval_check(block_count, interval, sql, manual="N", logger=None):
     return stage, voter_unpaid, delegate_unpaid
 
 
-def process_delegate(delegate_name):
-    """Process a single delegate's true block weight calculations"""
-    logger = setup_logging(delegate_name)
-    logger.info(f"Starting TBW process for delegate: {delegate_name}")
-    
+def resolve_delegates(delegate_names):
+    """Resolve the public keys of all delegates in one query per network before starting them"""
+    configs = {}
+    for delegate_name in delegate_names:
+        config = DelegateConfig(delegate_name)
+        configs.setdefault(config.network, []).append(config)
+
+    for network_name, network_configs in configs.items():
+        try:
+            database = Database(network_configs[0], Network(network_name), resolve=False)
+            unresolved = [i.delegate for i in network_configs if database.cache.get_publickey(i.delegate) is None]
+            if unresolved:
+                database.open_connection()
+                database.get_publickeys(unresolved)
+                database.close_connection()
+            # each delegate process opens its own pool
+            database.close()
+        except Exception as e:
+            print(f"Error resolving delegates on {network_name}: {str(e)}")
+
+
+def load_delegate(delegate_name, logger):
+    """Load a delegate's configuration and connect to its databases"""
     # get configuration for this delegate
     config = DelegateConfig(delegate_name)
     logger.info(f"Loaded configuration for delegate: {delegate_name}")
@@ -160,6 +183,7 @@ def process_delegate(delegate_name):
     # connect to core and tbw script database
     database = Database(config, network)
     sql = Sql(delegate_name)
+    cache = Cache(config.network)
     logger.info("Connected to databases")
     
     # check if initialized
@@ -179,99 +203,210 @@ def process_delegate(delegate_name):
     if config.custom == "Y":
         logger.info("Custom share flag is set, updating custom share")
         update_custom_share(sql, config)
+
+    return config, dynamic, database, sql, cache
+
+
+def fetch_blocks(config, database, sql, logger):
+    """Store new forged blocks and return the unprocessed ones, None if there is no last block yet"""
+    # get blocks
+    block = Blocks(config, database, sql)
+
+    # get last block to start
+    last_block = block.get_last_block()
+    if last_block:
+        logger.info(f"Last Block Height Retrieved: {last_block[0][1]}")
+        print("Last Block Height Retrieved: ", last_block[0][1])
+    else:
+        logger.warning("No last block found, waiting for next cycle")
+        return None
+
+    # use last block timestamp to get all new blocks
+    new_blocks = block.get_new_blocks(last_block)
+
+    # store all new blocks
+    block.store_new_blocks(new_blocks)
+
+    # get unprocessed blocks
+    return block.return_unprocessed_blocks()
+
+
+def process_blocks(config, dynamic, database, sql, allocate, unprocessed_blocks, logger, ledger=None):
+    """Allocate the rewards of unprocessed blocks and stage payments at each payout interval"""
+    block = Blocks(config, database, sql)
+    voter_options = Voters(config, sql)
+
+    # a backlog of blocks is replayed in memory and written once per payout interval
+    if config.catchup_blocks and len(unprocessed_blocks) >= config.catchup_blocks:
+        catch_up = CatchUp(config, database, sql, allocate)
+        if catch_up.load(unprocessed_blocks, ledger):
+            logger.info(f"Catching up {len(unprocessed_blocks)} unprocessed blocks")
+            print(f"\nCatching up {len(unprocessed_blocks)} unprocessed blocks")
+            block_count = block.block_counter()
+            run = []
+            for count, unprocessed in enumerate(unprocessed_blocks, 1):
+                run.append(unprocessed)
+                if (block_count + count) % config.interval != 0 and count < len(unprocessed_blocks):
+                    continue
+                catch_up.run(run, voter_options)
+                run = []
+                check_payout(config, dynamic, sql, block_count + count, logger)
+            return
+
+    stable = CatchUp(config, database, sql, allocate)
+    position = 0
+    while position < len(unprocessed_blocks):
+        unprocessed = unprocessed_blocks[position]
+        position += 1
+        tic_a = time.perf_counter()
+        logger.info(f"Processing unprocessed block at height {unprocessed[4]}")
+        print("\nUnprocessed Block Information\n", unprocessed)
+        
+        block_timestamp = unprocessed[1]
+        # get vote and unvote transactions
+        vote, unvote = allocate.get_vote_transactions(block_timestamp)
+        tic_b = time.perf_counter()
+        print(f"Get all Vote and Unvote transactions in {tic_b - tic_a:0.4f} seconds")
+        
+        # create voter_roll
+        voter_roll = allocate.create_voter_roll(vote, unvote)
+        tic_c = time.perf_counter()
+        print(f"Create voter rolls in {tic_c - tic_b:0.4f} seconds")
+        
+        # get voter_balances
+        voter_balances = allocate.get_voter_balance(unprocessed, voter_roll, ledger)
+        tic_d = time.perf_counter()
+        print(f"Get all voter balances in {tic_d - tic_c:0.4f} seconds")
+        
+        print("\noriginal voter_balances")
+        for k, v in voter_balances.items():
+            print(k, v / config.atomic)
+        
+        # run voters through various vote_options
+        voter_balances = allocate.process_voter_options(voter_options, voter_balances)
+        tic_e = time.perf_counter()
+        print(f"Process all voter options in {tic_e - tic_d:0.4f} seconds")
+        
+        # allocate block rewards
+        allocate.block_allocations(unprocessed, voter_balances)
+        tic_f = time.perf_counter()
+        print(f"Allocate block rewards in {tic_f - tic_e:0.4f} seconds")
+        
+        # get block count, including blocks buffered by block_allocations
+        block_count = block.block_counter() + len(allocate.buffer.heights)
+        print(f"\nCurrent block count : {block_count}")
+
+        # buffered rewards are always written before payments are staged
+        if block_count % config.interval == 0 or allocate.buffer.due():
+            allocate.buffer.flush()
+        
+        tic_g = time.perf_counter()
+        print(f"Processed block in {tic_g - tic_a:0.4f} seconds")
+        logger.info(f"Block {unprocessed[4]} processed in {tic_g - tic_a:0.4f} seconds")
+        check_payout(config, dynamic, sql, block_count, logger)
+
+        # following blocks without voter activity have the voter roll and balances of this block,
+        # runs up to the next payout interval are allocated in memory
+        while position < len(unprocessed_blocks):
+            run = unprocessed_blocks[position:position + config.interval - block_count % config.interval]
+            if not allocate.is_stable(voter_roll, block_timestamp, run[-1][1]):
+                break
+            logger.info(f"No voter activity up to height {run[-1][4]}, allocating {len(run)} blocks from the balances at height {unprocessed[4]}")
+            stable.load_stable(run[-1][1])
+            stable.run(run, voter_options)
+            position += len(run)
+            block_count += len(run)
+            block_timestamp = run[-1][1]
+            check_payout(config, dynamic, sql, block_count, logger)
+
+    allocate.buffer.flush()
+
+
+def check_payout(config, dynamic, sql, block_count, logger):
+    """Stage payments if the payout interval is reached after block_count processed blocks"""
+    # check interval for payout
+    stage, unpaid_voters, unpaid_delegate = interval_check(block_count, config.interval, sql, logger=logger)
+
+    # check if true to stage payments
+    if stage == True and sum(unpaid_voters.values()) > 0:
+        logger.info("Staging payments")
+        print("Staging payments")
+        # one node configuration request for all fees of the run
+        dynamic.refresh()
+        s = Stage(config, dynamic, sql, unpaid_voters, unpaid_delegate)
+
+
+def ledger_roll(allocate, unprocessed_blocks):
+    """
+    Get the voters of a delegate the shared ledger has to cover, runs on the thread that owns the delegate's tbw database
+
+    Returns:
+        Tuple of the newest unprocessed block timestamp and the ledger roll, None if there are no unprocessed blocks
+    """
+    if not unprocessed_blocks:
+        return None
+    timestamp = unprocessed_blocks[-1][1]
+    return timestamp, allocate.get_ledger_roll(timestamp)
+
+
+def load_ledger(network_name, database, rolls):
+    """
+    Read the balance changes of the voters of all delegates on a network with one query
+
+    Args:
+        network_name: Network identifier
+        database: Database connection for blockchain data, owned by the calling thread
+        rolls: List of ledger_roll results of the delegates on the network
+
+    Returns:
+        Ledger covering the newest unprocessed block of every delegate
+    """
+    rolls = [i for i in rolls if i]
+    if not rolls:
+        return None
+
+    timestamp = max(i[0] for i in rolls)
+    roll = {}
+    for _, delegate_roll in rolls:
+        for address, (public_key, chkpoint_ts) in delegate_roll.items():
+            # read from the oldest checkpoint of any delegate
+            if address in roll:
+                chkpoint_ts = min(chkpoint_ts, roll[address][1])
+            roll[address] = (public_key, chkpoint_ts)
+
+    ledger = Ledger(network_name)
+    ledger.load(database, [[k, v[0]] for k, v in roll.items()], timestamp, {k:v[1] for k, v in roll.items()})
+    return ledger
+
+
+def process_delegate(delegate_name):
+    """Process a single delegate's true block weight calculations"""
+    logger = setup_logging(delegate_name)
+    logger.info(f"Starting TBW process for delegate: {delegate_name}")
+    
+    config, dynamic, database, sql, cache = load_delegate(delegate_name, logger)
+
+    # wake up when the delegate forges, polling stays the fallback
+    events = Events(database.network)
+    events.watch(database.publickey)
+    events.start(database)
     
     # MAIN FUNCTION LOOP SHOULD START HERE
     logger.info("Starting main processing loop")
     while True:
         try:
-            # get blocks
-            block = Blocks(config, database, sql)
-        
-            # get last block to start
-            last_block = block.get_last_block()
-            if last_block:
-                logger.info(f"Last Block Height Retrieved: {last_block[0][1]}")
-                print("Last Block Height Retrieved: ", last_block[0][1])
-            else:
-                logger.warning("No last block found, waiting for next cycle")
-                time.sleep(1200)
+            unprocessed_blocks = fetch_blocks(config, database, sql, logger)
+            if unprocessed_blocks is None:
+                events.wait(1200)
                 continue
         
-            # use last block timestamp to get all new blocks
-            new_blocks = block.get_new_blocks(last_block)
-        
-            # store all new blocks
-            block.store_new_blocks(new_blocks)
-        
-            # get unprocessed blocks
-            unprocessed_blocks = block.return_unprocessed_blocks()
-        
             # allocate block rewards
-            allocate = Allocate(database, config, sql)
-            voter_options = Voters(config, sql)
-        
-            for unprocessed in unprocessed_blocks:
-                tic_a = time.perf_counter()
-                logger.info(f"Processing unprocessed block at height {unprocessed[4]}")
-                print("\nUnprocessed Block Information\n", unprocessed)
-                
-                block_timestamp = unprocessed[1]
-                # get vote and unvote transactions
-                vote, unvote = allocate.get_vote_transactions(block_timestamp)
-                tic_b = time.perf_counter()
-                print(f"Get all Vote and Unvote transactions in {tic_b - tic_a:0.4f} seconds")
-                
-                # create voter_roll
-                voter_roll = allocate.create_voter_roll(vote, unvote)
-                tic_c = time.perf_counter()
-                print(f"Create voter rolls in {tic_c - tic_b:0.4f} seconds")
-                
-                # get voter_balances
-                voter_balances = allocate.get_voter_balance(unprocessed, voter_roll)
-                tic_d = time.perf_counter()
-                print(f"Get all voter balances in {tic_d - tic_c:0.4f} seconds")
-                
-                print("\noriginal voter_balances")
-                for k, v in voter_balances.items():
-                    print(k, v / config.atomic)
-                
-                # run voters through various vote_options
-                if config.whitelist == 'Y':
-                    voter_balances = voter_options.process_whitelist(voter_balances)
-                if config.whitelist == 'N' and config.blacklist =='Y':
-                    voter_balances = voter_options.process_blacklist(voter_balances)
-                    
-                voter_balances = voter_options.process_voter_cap(voter_balances)
-                voter_balances = voter_options.process_voter_min(voter_balances)
-                voter_balances = voter_options.process_anti_dilution(voter_balances)
-                tic_e = time.perf_counter()
-                print(f"Process all voter options in {tic_e - tic_d:0.4f} seconds")
-                
-                # allocate block rewards
-                allocate.block_allocations(unprocessed, voter_balances)
-                tic_f = time.perf_counter()
-                print(f"Allocate block rewards in {tic_f - tic_e:0.4f} seconds")
-                
-                # get block count
-                block_count = block.block_counter()
-                print(f"\nCurrent block count : {block_count}")
-                
-                tic_g = time.perf_counter()
-                print(f"Processed block in {tic_g - tic_a:0.4f} seconds")
-                logger.info(f"Block {unprocessed[4]} processed in {tic_g - tic_a:0.4f} seconds")
-            
-                # check interval for payout
-                stage, unpaid_voters, unpaid_delegate = interval_check(block_count, config.interval, logger=logger)
+            allocate = Allocate(database, config, sql, cache)
+            process_blocks(config, dynamic, database, sql, allocate, unprocessed_blocks, logger)
             
-                # check if true to stage payments
-                if stage == True and sum(unpaid_voters.values()) > 0:
-                    logger.info("Staging payments")
-                    print("Staging payments")
-                    s = Stage(config, dynamic, sql, unpaid_voters, unpaid_delegate)
-            
-            logger.info("Completed processing cycle, sleeping before next check")
+            logger.info("Completed processing cycle, waiting for the next block")
             print("End Script - Looping")
-            time.sleep(1200)
+            events.wait(1200)
             
         except Exception as e:
             logger.error(f"Error in main processing loop: {str(e)}", exc_info=True)
@@ -279,6 +414,108 @@ def process_delegate(delegate_name):
             time.sleep(300)  # Sleep for 5 minutes on error
 
 
+def delegate_step(func, *args):
+    """Run a step of one delegate, quit() on fatal errors must only stop this delegate and not the others"""
+    try:
+        return func(*args)
+    except SystemExit as e:
+        raise RuntimeError(f"Step exited with code {e.code}") from e
+
+
+def delegate_log(delegate_name):
+    """Write the records of a delegate's loggers to its own log file when several delegates share a process"""
+    log_dir = Path.home() / "True-Block-Weight-ARK-V3-Core" / "logs"
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    handler = logging.FileHandler(log_dir / f"tbw_{delegate_name}.log")
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    # every module logs to '<module>_<username>'
+    handler.addFilter(lambda record: record.name.endswith(f"_{delegate_name}"))
+    logging.getLogger().addHandler(handler)
+
+
+def process_all(delegate_names):
+    """
+    Process all delegates in one process, core is scanned once per network and cycle
+
+    Every delegate stores its new blocks, then the balance changes of the voters of
+    all delegates on the network are read in one query and shared by their allocations.
+    A delegate that fails to load or fetch is left out of the cycle, the others go on.
+    """
+    logger = setup_logging("all")
+    logger.info(f"Starting TBW process for delegates: {', '.join(delegate_names)}")
+    for delegate_name in delegate_names:
+        delegate_log(delegate_name)
+
+    # a block of any delegate on any network wakes the loop, polling stays the fallback
+    wake = threading.Event()
+    events = {}
+    delegates = {}
+
+    logger.info("Starting main processing loop")
+    while True:
+        # load delegates that are not loaded yet, a delegate that fails is retried on the next cycle
+        for delegate_name in delegate_names:
+            if delegate_name in delegates:
+                continue
+            delegate_logger = logging.getLogger(f'tbw_{delegate_name}')
+            try:
+                delegates[delegate_name] = delegate_step(load_delegate, delegate_name, delegate_logger)
+            except Exception as e:
+                delegate_logger.error(f"Error loading delegate {delegate_name}: {str(e)}", exc_info=True)
+                print(f"Error: {str(e)}")
+                continue
+            config, database = delegates[delegate_name][0], delegates[delegate_name][2]
+            if config.network not in events:
+                events[config.network] = Events(database.network, wake)
+                events[config.network].watch(database.publickey)
+                events[config.network].start(database)
+            else:
+                events[config.network].watch(database.publickey)
+
+        networks = {}
+        for delegate_name, loaded in delegates.items():
+            networks.setdefault(loaded[0].network, []).append(delegate_name)
+
+        for network_name, network_delegates in networks.items():
+            pending = {}
+            for delegate_name in network_delegates:
+                config, dynamic, database, sql, cache = delegates[delegate_name]
+                delegate_logger = logging.getLogger(f'tbw_{delegate_name}')
+                try:
+                    unprocessed_blocks = delegate_step(fetch_blocks, config, database, sql, delegate_logger)
+                    allocate = Allocate(database, config, sql, cache)
+                    pending[delegate_name] = (allocate, unprocessed_blocks, ledger_roll(allocate, unprocessed_blocks))
+                except Exception as e:
+                    delegate_logger.error(f"Error fetching blocks: {str(e)}", exc_info=True)
+                    print(f"Error: {str(e)}")
+
+            try:
+                tic = time.perf_counter()
+                ledger = load_ledger(network_name, delegates[network_delegates[0]][2], [i[2] for i in pending.values()])
+                print(f"Loaded shared ledger for {network_name} in {time.perf_counter() - tic:0.4f} seconds")
+            except Exception as e:
+                # delegates fall back to their own balance queries
+                logger.error(f"Error loading shared ledger for {network_name}: {str(e)}", exc_info=True)
+                print(f"Error: {str(e)}")
+                ledger = None
+
+            for delegate_name, (allocate, unprocessed_blocks, _) in pending.items():
+                config, dynamic, database, sql, cache = delegates[delegate_name]
+                delegate_logger = logging.getLogger(f'tbw_{delegate_name}')
+                try:
+                    if unprocessed_blocks:
+                        delegate_step(process_blocks, config, dynamic, database, sql, allocate, unprocessed_blocks, delegate_logger, ledger)
+                except Exception as e:
+                    delegate_logger.error(f"Error in main processing loop: {str(e)}", exc_info=True)
+                    print(f"Error: {str(e)}")
+
+        logger.info("Completed processing cycle, waiting for the next block")
+        print("End Script - Looping")
+        wake.wait(1200)
+        wake.clear()
+
+
 if __name__ == '__main__':
     print("Start Script")
     
@@ -292,23 +529,11 @@ if __name__ == '__main__':
     delegate_manager = DelegateManager(None)
     
     if args.all:
-        # Process all delegates
+        # Process all delegates, sharing one scan of core per network
         delegate_names = list(delegate_manager.get_delegate_names())
         print(f"Processing all {len(delegate_names)} delegates")
-        
-        # Import multiprocessing here to avoid issues with Windows
-        import multiprocessing
-        
-        # Create a process for each delegate
-        processes = []
-        for delegate_name in delegate_names:
-            p = multiprocessing.Process(target=process_delegate, args=(delegate_name,))
-            processes.append(p)
-            p.start()
-            
-        # Wait for all processes to complete
-        for p in processes:
-            p.join()
+        resolve_delegates(delegate_names)
+        process_all(delegate_names)
             
     elif args.delegate:
         # Process a single delegate
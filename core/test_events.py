@@ -0,0 +1,130 @@
+import json
+import socket
+import threading
+import unittest
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from modules import events as events_module
+from modules.events import Events
+
+
+class FakeWebhooksApi(BaseHTTPRequestHandler):
+    """Stand-in for the core webhooks plugin API"""
+    def do_GET(self):
+        self.reply({"data": list(self.server.webhooks.values())})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        webhook = dict(body, id=str(len(self.server.webhooks) + 1), token=f"{len(self.server.webhooks):064d}")
+        self.server.webhooks[webhook['id']] = webhook
+        self.reply({"data": webhook})
+
+    def do_DELETE(self):
+        self.server.webhooks.pop(self.path.rsplit('/', 1)[1], None)
+        self.send_response(204)
+        self.end_headers()
+
+    def reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def send_block(webhook, public_key, event="block.applied", token=None):
+    """Post a block event the way the core webhooks plugin does"""
+    body = json.dumps({"timestamp": 0, "event": event, "data": {"height": 1, "generatorPublicKey": public_key}}).encode()
+    request = urllib.request.Request(webhook['target'], data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'Authorization': token if token is not None else webhook['token'][:32]})
+    urllib.request.urlopen(request, timeout=5).read()
+
+
+class TestWebhookEvents(unittest.TestCase):
+    def setUp(self):
+        self.api = ThreadingHTTPServer(("127.0.0.1", 0), FakeWebhooksApi)
+        self.api.webhooks = {}
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        self.network = SimpleNamespace(network="ark_devnet", events="webhook", webhooks=self.api.server_address[1],
+            webhook_host="127.0.0.1", webhook_port=0)
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.api.server_close()
+
+    def start(self, *public_keys):
+        events = Events(self.network)
+        for i in public_keys:
+            events.watch(i)
+        events.start(None)
+        return events
+
+    def webhook(self, public_key):
+        return next(i for i in self.api.webhooks.values() if i['conditions'][0]['value'] == public_key)
+
+    def test_registers_one_webhook_per_delegate(self):
+        events = self.start("02aa", "02bb")
+        self.assertEqual(sorted(self.webhook(i)['conditions'][0]['value'] for i in ("02aa", "02bb")), ["02aa", "02bb"])
+        events.receiver.subscribers.remove(events)
+
+    def test_replaces_webhooks_of_previous_runs(self):
+        first = self.start("02aa")
+        first.receiver.subscribers.remove(first)
+        second = self.start("02aa")
+        self.assertEqual(len(self.api.webhooks), 1)
+        second.receiver.subscribers.remove(second)
+
+    def test_block_of_watched_delegate_wakes(self):
+        events = self.start("02aa")
+        self.assertFalse(events.wait(0))
+        send_block(self.webhook("02aa"), "02aa")
+        self.assertTrue(events.wait(5))
+        # the event is consumed
+        self.assertFalse(events.wait(0))
+        events.receiver.subscribers.remove(events)
+
+    def test_other_blocks_are_ignored(self):
+        events = self.start("02aa")
+        webhook = self.webhook("02aa")
+        send_block(webhook, "02cc")
+        send_block(webhook, "02aa", event="transaction.applied")
+        send_block(webhook, "02aa", token="x" * 32)
+        self.assertFalse(events.wait(0.2))
+        events.receiver.subscribers.remove(events)
+
+    def test_port_in_use_falls_back_to_free_port(self):
+        # the receiver port is held by another process
+        taken = socket.socket()
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        self.network.webhook_port = taken.getsockname()[1]
+        with self.assertLogs('webhooks', level='WARNING'):
+            events = self.start("02aa")
+        self.assertNotEqual(events.receiver.server_address[1], taken.getsockname()[1])
+        send_block(self.webhook("02aa"), "02aa")
+        self.assertTrue(events.wait(5))
+        events_module.receivers.pop(taken.getsockname()[1]).shutdown()
+        events.receiver.server_close()
+        taken.close()
+
+    def test_unreachable_api_falls_back_to_polling(self):
+        self.network.webhooks = 1
+        events = self.start("02aa")
+        self.assertFalse(events.wait(0.1))
+        events.receiver.subscribers.remove(events)
+
+    def test_polling_mode(self):
+        self.network.events = "poll"
+        events = self.start("02aa")
+        self.assertIsNone(events.receiver)
+        self.assertFalse(events.wait(0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import io
+import random
+import unittest
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+from modules.allocate import Allocate
+from modules.kernel import Kernel, np
+from modules.voters import Voters
+
+
+class FakeSql:
+    """In-memory stand-in for the voters table"""
+    def __init__(self, unpaid, shares):
+        self.unpaid = unpaid
+        self.shares = shares
+
+    def open_connection(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def clear_voter_shares(self):
+        pass
+
+    def all_voters(self):
+        return SimpleNamespace(fetchall=lambda: [(k, None, v, 0, self.shares[k]) for k, v in self.unpaid.items()])
+
+
+def make_config(**kwargs):
+    config = dict(
+        username="delegate1", atomic=100000000, voter_share=90, voter_cap=0, voter_min=0,
+        whitelist='N', whitelist_address=[], blacklist='N', blacklist_address=[],
+        delegate_fee=[8, 2], delegate_fee_address=["reserve", "fee"], vectorize="Y")
+    config.update(kwargs)
+    return SimpleNamespace(**config)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestKernel(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(822)
+        self.addresses = [f"A{i:033d}" for i in range(2000)]
+        self.balances = {k: rng.choice([0, -rng.randrange(10 ** 8), rng.randrange(10 ** 12), rng.randrange(10 ** 9)]) for k in self.addresses}
+        self.unpaid = {k: rng.choice([0, rng.randrange(10 ** 10)]) for k in self.addresses}
+        self.shares = {k: rng.choice([90.0, 90.0, 90.0, 80.0, 95.5, 0.0]) for k in self.addresses}
+        self.blocks = [("id", 100, 200000000, rng.randrange(10 ** 8), 1), ("id", 100, 199999999, 0, 2)]
+
+    def dictionary_path(self, config, sql):
+        voter_options = Voters(config, sql)
+        voter_balances = dict(self.balances)
+        if config.whitelist == 'Y':
+            voter_balances = voter_options.process_whitelist(voter_balances)
+        if config.whitelist == 'N' and config.blacklist == 'Y':
+            voter_balances = voter_options.process_blacklist(voter_balances)
+        voter_balances = voter_options.process_voter_cap(voter_balances)
+        voter_balances = voter_options.process_voter_min(voter_balances)
+        return voter_options.process_anti_dilution(voter_balances)
+
+    def assert_golden(self, config):
+        sql = FakeSql(self.unpaid, self.shares)
+        allocate = Allocate(None, config, sql, cache=SimpleNamespace())
+
+        expected_voters = self.dictionary_path(config, sql)
+        voters = allocate.kernel.process_voters(dict(self.balances))
+        self.assertEqual(voters, expected_voters)
+        self.assertTrue(allocate.kernel.accepts(voters))
+
+        for block in self.blocks:
+            expected_delegate = allocate.delegate_allocations(block)
+            with redirect_stdout(io.StringIO()):
+                expected = allocate.voter_allocations(block, expected_voters, self.shares, expected_delegate)
+            delegate = allocate.delegate_allocations(block)
+            rewards = allocate.kernel.voter_allocations(block, voters, self.shares, delegate)
+            self.assertEqual(rewards, expected)
+            self.assertEqual(delegate, expected_delegate)
+
+    def test_plain(self):
+        self.assert_golden(make_config())
+
+    def test_cap_and_min(self):
+        self.assert_golden(make_config(voter_cap=250000, voter_min=5))
+
+    def test_whitelist(self):
+        self.assert_golden(make_config(whitelist='Y', whitelist_address=self.addresses[::3]))
+
+    def test_blacklist(self):
+        self.assert_golden(make_config(blacklist='Y', blacklist_address=self.addresses[::7], voter_cap=1000))
+
+    def test_disabled(self):
+        config = make_config(vectorize="N")
+        kernel = Kernel(config, FakeSql(self.unpaid, self.shares))
+        self.assertFalse(kernel.enabled)
+        self.assertFalse(kernel.accepts(self.balances))
+
+    def test_large_balances_use_dictionary_path(self):
+        kernel = Kernel(make_config(), FakeSql(self.unpaid, self.shares))
+        self.assertFalse(kernel.accepts({"a": 2 ** 52, "b": 2 ** 52}))
+
+    def test_zero_total_uses_dictionary_path(self):
+        kernel = Kernel(make_config(), FakeSql(self.unpaid, self.shares))
+        self.assertFalse(kernel.accepts({"a": 5, "b": -5}))
+        self.assertFalse(kernel.accepts({"a": 0}))
+
+
+if __name__ == '__main__':
+    unittest.main()
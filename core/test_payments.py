@@ -0,0 +1,533 @@
+import io
+import json
+import os
+import shutil
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+from client.exceptions import ArkHTTPException
+from crypto.identity.address import address_from_passphrase
+from crypto.transactions.builder.multi_payment import MultiPayment
+from crypto.transactions.builder.transfer import Transfer
+
+import pay
+from modules.payments import Payments
+from modules.sequencer import NonceSequencer
+from modules.tracker import ConfirmationTracker
+from utility.sql import Sql
+from utility.utility import Utility
+
+
+class FakeNodeApi(BaseHTTPRequestHandler):
+    """Stand-in for the transactions endpoint of a relay node"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.connections.add(self.client_address)
+        self.server.received.append([i['id'] for i in body['transactions']])
+        if self.server.fail:
+            self.reply(500, {"error": "Internal Server Error"})
+        else:
+            self.reply(200, {"data": {"accept": [i['id'] for i in body['transactions'] if i['id'] in self.server.accept]}})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeNodeClient:
+    """Stand-in for the client of a node, its pool accepts transactions in nonce order"""
+    def __init__(self, nonce, reject=(), fail_after=None):
+        self.nonce = nonce
+        self.pool = []
+        self.reject = set(reject)
+        self.fail_after = fail_after
+        self.received = []
+        self.connection = SimpleNamespace(hostname="fake")
+        self.wallets = SimpleNamespace(get=lambda address: {"data": {"nonce": str(self.nonce)}})
+        self.transactions = SimpleNamespace(create=self.create,
+            all_unconfirmed=lambda limit, senderPublicKey: {"meta": {"totalCount": len(self.pool)}})
+
+    def create(self, transactions):
+        if self.fail_after is not None and len(self.received) >= self.fail_after:
+            raise ConnectionError("node unreachable")
+        self.received.append([int(i['nonce']) for i in transactions])
+        accept = []
+        for i in transactions:
+            nonce = int(i['nonce'])
+            if nonce in self.reject:
+                # rejected once, accepted when it is sent again
+                self.reject.discard(nonce)
+            elif nonce == self.nonce + len(self.pool) + 1:
+                self.pool.append(i)
+                accept.append(i['id'])
+        return {"data": {"accept": accept}}
+
+    def forge(self, count):
+        count = min(count, len(self.pool))
+        self.nonce += count
+        del self.pool[:count]
+
+
+def fake_sign(transaction, network, keys):
+    """Sign without crypto, the ID of a transaction is its nonce"""
+    transaction = transaction.transaction
+    signed = {"id": f"tx{transaction.nonce}", "nonce": str(transaction.nonce), "fee": transaction.fee}
+    if getattr(transaction, "asset", None) and "payments" in transaction.asset:
+        signed["asset"] = {"payments": transaction.asset["payments"]}
+    else:
+        signed.update(recipientId=transaction.recipientId, amount=transaction.amount)
+    return signed
+
+
+class TestDrainPayments(unittest.TestCase):
+    delegate = "D" + "1" * 33
+
+    def setUp(self):
+        self.sql = Sql(f"test_drain_{os.getpid()}")
+        # Sql creates tables of an older layout that setup() does not replace
+        for table in ["blocks", "voters", "transactions", "staging"]:
+            self.sql.cursor.execute(f"DROP TABLE {table}")
+        self.sql.setup()
+        self.sleeps = []
+
+    def tearDown(self):
+        self.sql.close()
+        shutil.rmtree(os.path.dirname(self.sql.data_path))
+
+    def stage(self, count):
+        self.sql.open_connection()
+        self.sql.stage_payment({f"A{i:033d}": 1000 + i for i in range(count)}, "Reward")
+        self.sql.close_connection()
+
+    def left(self):
+        self.sql.open_connection()
+        left = self.sql.unprocessed_staged_payments()
+        self.sql.close_connection()
+        return left
+
+    def stored_nonce(self):
+        self.sql.open_connection()
+        nonce = self.sql.get_nonce(self.delegate)
+        self.sql.close_connection()
+        return nonce
+
+    def drain(self, node, multi="N", multi_limit=4, sender_limit=300, forge=0):
+        network = SimpleNamespace(epoch=["2017", "3", "21", "13", "00", "00"], version=30, wif=170, api="127.0.0.1:1", peers=[])
+        config = SimpleNamespace(username="drain", delegate=self.delegate, passphrase="drain test passphrase",
+            secondphrase="None", multi=multi, message="Reward", convert_address=[], exchange="N")
+        dynamic = SimpleNamespace(get_tx_request_limit=lambda: 20, get_multipay_limit=lambda: multi_limit,
+            get_sender_limit=lambda: sender_limit, get_blocktime=lambda: 8,
+            get_dynamic_fee=lambda: 10000000, get_dynamic_fee_multi=lambda count: 10000000 * count)
+        payments = Payments(config, self.sql, dynamic, Utility(network), None)
+        payments.client = node
+        sequencer = NonceSequencer(config, self.sql, payments)
+        sequencer.reconcile()
+
+        def sleep(seconds):
+            # a block is forged while waiting
+            self.sleeps.append(seconds)
+            node.forge(forge)
+        with mock.patch.object(pay.time, "sleep", sleep), mock.patch("modules.payments.sign_transaction", fake_sign), \
+                redirect_stdout(io.StringIO()):
+            pay.drain_payments(payments, sequencer, dynamic, config, None, self.sql, pay.logging.getLogger('pay_drain'))
+
+    def test_drains_until_empty(self):
+        self.stage(95)
+        node = FakeNodeClient(5)
+        self.drain(node)
+        self.assertEqual(self.left(), 0)
+        self.assertEqual([len(i) for i in node.received], [20, 20, 20, 20, 15])
+        self.assertEqual(self.stored_nonce(), 100)
+        # the tracker tells dropped transactions by their nonce
+        self.sql.open_connection()
+        self.assertEqual(self.sql.cursor.execute("SELECT MIN(nonce), MAX(nonce) FROM transactions").fetchone(), (6, 100))
+        self.sql.close_connection()
+
+    def test_multi_payments(self):
+        self.stage(95)
+        node = FakeNodeClient(5)
+        self.drain(node, multi="Y")
+        self.assertEqual(self.left(), 0)
+        # 23 multi-payments of four and the last payment on its own
+        self.assertEqual([len(i) for i in node.received], [20, 4])
+        self.assertEqual(self.stored_nonce(), 29)
+
+    def test_multi_payment_limit_of_one(self):
+        self.stage(25)
+        node = FakeNodeClient(5)
+        self.drain(node, multi="Y", multi_limit=1)
+        self.assertEqual(self.left(), 0)
+        self.assertEqual([len(i) for i in node.received], [20, 5])
+
+    def test_partly_rejected_batch_pages_again(self):
+        self.stage(95)
+        node = FakeNodeClient(5, reject=[35])
+        self.drain(node)
+        self.assertEqual(self.left(), 0)
+        # the batch built behind the partly rejected one is never sent, the rejected nonces are sent again
+        self.assertEqual([(i[0], i[-1]) for i in node.received], [(6, 25), (26, 45), (35, 54), (55, 74), (75, 94), (95, 100)])
+        self.assertEqual(self.stored_nonce(), 100)
+
+    def test_all_rejected_batch_ends_run(self):
+        self.stage(95)
+        node = FakeNodeClient(5, reject=range(6, 101))
+        self.drain(node)
+        self.assertEqual(self.left(), 95)
+        self.assertEqual(len(node.received), 1)
+        # the stored nonce is reset to the node
+        self.assertEqual(self.stored_nonce(), 5)
+
+    def test_waits_for_sender_limit(self):
+        self.stage(95)
+        node = FakeNodeClient(5)
+        self.drain(node, sender_limit=50, forge=30)
+        self.assertEqual(self.left(), 0)
+        self.assertTrue(self.sleeps)
+        self.assertEqual(self.stored_nonce(), 100)
+
+    def test_gives_up_when_pool_is_not_forged(self):
+        self.stage(95)
+        node = FakeNodeClient(5)
+        self.drain(node, sender_limit=50)
+        self.assertEqual(self.left(), 45)
+        self.assertEqual(self.sleeps, [8, 8, 8])
+        self.assertEqual(self.stored_nonce(), 55)
+
+    def test_unreachable_nodes_release_nonces(self):
+        self.stage(95)
+        node = FakeNodeClient(5, fail_after=1)
+        with self.assertRaises(SystemExit):
+            self.drain(node)
+        self.assertEqual(self.left(), 75)
+        # the failed batch and the one built behind it are reserved no more
+        self.assertEqual(self.stored_nonce(), 25)
+
+
+class TestSigning(unittest.TestCase):
+    """Transactions signed with derived keys are byte for byte those of the builder"""
+    network = SimpleNamespace(epoch=["2017", "3", "21", "13", "00", "00"], version=30, wif=170, api="127.0.0.1:1", peers=[])
+    recipients = [address_from_passphrase(f"recipient {i}", 30) for i in range(3)]
+
+    def builders(self):
+        transfer = Transfer(recipientId=self.recipients[0], amount=12345, vendorField="Reward", fee=10000000)
+        transfer.set_nonce(6)
+        multi = MultiPayment(vendorField="Reward", fee=30000000)
+        multi.set_nonce(7)
+        for i, address in enumerate(self.recipients):
+            multi.add_payment(1000 + i, address)
+        return [transfer, multi]
+
+    def expected(self, secondphrase):
+        expected = []
+        for transaction in self.builders():
+            transaction.schnorr_sign("signing test passphrase")
+            if secondphrase is not None:
+                transaction.second_sign(secondphrase)
+            expected.append(transaction.to_dict())
+        return expected
+
+    def sign_all(self, secondphrase, executor=None):
+        config = SimpleNamespace(username="signing", passphrase="signing test passphrase", secondphrase=secondphrase)
+        payments = Payments(config, None, None, Utility(self.network), None, executor)
+        return payments.sign_all(self.builders())
+
+    def test_single_signature(self):
+        expected = self.expected(None)
+        self.assertNotIn("signSignature", expected[0])
+        self.assertEqual(self.sign_all("None"), expected)
+
+    def test_second_signature(self):
+        expected = self.expected("signing test second passphrase")
+        self.assertIn("signSignature", expected[0])
+        self.assertEqual(self.sign_all("signing test second passphrase"), expected)
+
+    def test_signing_processes(self):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(self.sign_all("None", executor), self.expected(None))
+            self.assertEqual(self.sign_all("signing test second passphrase", executor), self.expected("signing test second passphrase"))
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        self.transactions = [{"id": i, "nonce": str(n)} for n, i in enumerate(["aa", "bb", "cc"], 1)]
+
+    def tearDown(self):
+        for i in self.nodes:
+            i.shutdown()
+            i.server_close()
+
+    def node(self, accept=(), fail=False):
+        node = ThreadingHTTPServer(("127.0.0.1", 0), FakeNodeApi)
+        node.accept, node.fail, node.received, node.connections = set(accept), fail, [], set()
+        threading.Thread(target=node.serve_forever, daemon=True).start()
+        self.nodes.append(node)
+        return node.server_address[1]
+
+    def payments(self, local, *peers):
+        """Payments of a delegate whose local node and peers are fake nodes on the given ports"""
+        network = SimpleNamespace(epoch=["2017", "3", "21", "13", "00", "00"], version=30, wif=170, api=local,
+            peers=[f"127.0.0.1:{i}" for i in peers])
+        utility = Utility(network)
+        config = SimpleNamespace(username="relay", passphrase="relay test passphrase", secondphrase="None")
+        return Payments(config, None, None, utility, None)
+
+    def relay(self, payments):
+        return payments.relay(self.transactions)
+
+    def test_clients_share_one_connection_pool(self):
+        payments = self.payments(self.node(), self.node())
+        self.assertIs(payments.utility.get_client(), payments.client)
+        self.assertIs(payments.client.connection.session.get_adapter("http://"), payments.peers[0].connection.session.get_adapter("http://"))
+
+    def test_keeps_connections_alive(self):
+        payments = self.payments(self.node(accept=["aa"]))
+        self.relay(payments)
+        self.relay(payments)
+        self.assertEqual(len(self.nodes[0].received), 2)
+        self.assertEqual(len(self.nodes[0].connections), 1)
+
+    def test_merges_acceptance_of_peers(self):
+        payments = self.payments(self.node(accept=["aa"]), self.node(accept=["bb"]), self.node(accept=["aa", "cc"]))
+        self.assertEqual(sorted(self.relay(payments)), ["aa", "bb", "cc"])
+        for i in self.nodes:
+            self.assertEqual(i.received, [["aa", "bb", "cc"]])
+
+    def test_failing_peer_is_skipped(self):
+        payments = self.payments(self.node(accept=["aa", "bb"]), self.node(fail=True))
+        self.assertEqual(sorted(self.relay(payments)), ["aa", "bb"])
+
+    def test_failing_local_node_is_covered_by_peers(self):
+        payments = self.payments(self.node(fail=True), self.node(accept=["cc"]))
+        self.assertEqual(self.relay(payments), ["cc"])
+
+    def test_quits_when_every_node_fails(self):
+        payments = self.payments(self.node(fail=True), self.node(fail=True))
+        with self.assertRaises(SystemExit):
+            self.relay(payments)
+
+
+
+class TestNonceSequencer(unittest.TestCase):
+    def setUp(self):
+        self.sql = Sql(f"test_sequencer_{os.getpid()}")
+        self.node_nonce = 7
+        config = SimpleNamespace(username="sequencer", delegate="D" + "1" * 33)
+        self.sequencer = NonceSequencer(config, self.sql, SimpleNamespace(get_pool_nonce=lambda: self.node_nonce))
+
+    def tearDown(self):
+        self.sql.close()
+        shutil.rmtree(os.path.dirname(self.sql.data_path))
+
+    def stored(self):
+        self.sql.open_connection()
+        nonce = self.sql.get_nonce(self.sequencer.config.delegate)
+        self.sql.close_connection()
+        return nonce
+
+    def test_first_run_starts_at_node_nonce(self):
+        self.assertIsNone(self.stored())
+        self.assertEqual(self.sequencer.reconcile(), 7)
+        self.assertEqual(self.sequencer.reserve(3), 8)
+        self.assertEqual(self.sequencer.reserve(2), 11)
+        self.assertEqual(self.stored(), 12)
+
+    def test_stored_nonce_ahead_of_node(self):
+        # transactions of the last run are not forged or in the pool the node reports yet
+        self.sequencer.reconcile()
+        self.sequencer.reserve(5)
+        self.assertEqual(self.sequencer.reconcile(), 12)
+        self.assertEqual(self.sequencer.reserve(1), 13)
+        # the node caught up and went past it
+        self.node_nonce = 20
+        self.assertEqual(self.sequencer.reconcile(), 20)
+
+    def test_partial_rejection(self):
+        self.sequencer.reconcile()
+        first = self.sequencer.reserve(5)
+        self.sequencer.release([first + 2, first + 4], 3)
+        # nonces after the first rejected one are reused
+        self.assertEqual(self.stored(), first + 1)
+        self.assertEqual(self.sequencer.reserve(1), first + 2)
+
+    def test_partial_rejection_behind_node(self):
+        self.sequencer.reconcile()
+        first = self.sequencer.reserve(5)
+        self.node_nonce = first + 3
+        self.sequencer.release([first + 1], 4)
+        self.assertEqual(self.stored(), first + 3)
+
+    def test_reset_after_fully_rejected_batch(self):
+        self.node_nonce = 30
+        self.sequencer.reconcile()
+        first = self.sequencer.reserve(4)
+        self.node_nonce = 25
+        self.sequencer.release(list(range(first, first + 4)), 0)
+        self.assertEqual(self.stored(), 25)
+
+    def test_nothing_rejected(self):
+        self.sequencer.reconcile()
+        self.sequencer.reserve(4)
+        self.node_nonce = 0
+        self.sequencer.release([], 4)
+        self.assertEqual(self.stored(), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class FakeTrackerClient:
+    """Stand-in for the client of a node the tracker polls"""
+    def __init__(self, pool=(), forged=(), known=(), nonce=5, fail=False):
+        self.pool = list(pool)
+        self.forged = set(forged)
+        self.known = set(known)
+        self.nonce = nonce
+        self.fail = fail
+        self.connection = SimpleNamespace(hostname="fake")
+        self.wallets = SimpleNamespace(get=self.wallet)
+        self.transactions = SimpleNamespace(all_unconfirmed=self.all_unconfirmed, all=self.all, get=self.get)
+
+    def wallet(self, address):
+        if self.fail:
+            raise ArkHTTPException("node unreachable")
+        return {"data": {"nonce": str(self.nonce)}}
+
+    def all_unconfirmed(self, limit, offset, senderPublicKey):
+        if self.fail:
+            raise ArkHTTPException("node unreachable")
+        return {"data": [{"id": i} for i in self.pool[offset:offset + limit]], "meta": {"totalCount": len(self.pool)}}
+
+    def all(self, limit, id):
+        return {"data": [{"id": i, "confirmations": 1} for i in id if i in self.forged]}
+
+    def get(self, txid):
+        if self.fail:
+            raise ArkHTTPException("node unreachable")
+        if txid in self.forged:
+            return {"data": {"id": txid, "confirmations": 1}}
+        if txid in self.known:
+            return {"data": {"id": txid, "confirmations": 0}}
+        raise ArkHTTPException("Transaction not found", response=SimpleNamespace(status_code=404))
+
+
+class TestConfirmationTracker(unittest.TestCase):
+    def setUp(self):
+        self.sql = Sql(f"test_tracker_{os.getpid()}")
+        for table in ["blocks", "voters", "transactions", "staging"]:
+            self.sql.cursor.execute(f"DROP TABLE {table}")
+        self.sql.setup()
+
+    def tearDown(self):
+        self.sql.close()
+        shutil.rmtree(os.path.dirname(self.sql.data_path))
+
+    def broadcast(self, txid, nonce, seconds_ago=60):
+        """Record a transaction paying one staged payment, broadcast seconds_ago"""
+        self.sql.open_connection()
+        self.sql.stage_payment({f"A{txid}": 1000}, "Reward")
+        rowid = self.sql.cursor.execute("SELECT MAX(rowid) FROM staging").fetchone()[0]
+        self.sql.process_staged_payment([rowid], [txid])
+        self.sql.store_transactions([(f"A{txid}", 1000, txid, nonce)])
+        processed_at = (datetime.now() - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%d %H:%M:%S')
+        self.sql.cursor.execute("UPDATE transactions SET processed_at = ? WHERE id = ?", (processed_at, txid))
+        self.sql.commit()
+        self.sql.close_connection()
+
+    def poll(self, client, peers=()):
+        config = SimpleNamespace(username="tracker", delegate="tracker", passphrase="tracker test passphrase")
+        utility = SimpleNamespace(get_client=lambda: client, get_peer_clients=lambda: list(peers))
+        dynamic = SimpleNamespace(get_blocktime=lambda: 8, get_max_transaction_age=lambda: 100)
+        self.tracker = ConfirmationTracker(config, utility, dynamic)
+        with redirect_stdout(io.StringIO()):
+            return self.tracker.poll(self.sql)
+
+    def state(self):
+        self.sql.open_connection()
+        confirmed = [i[0] for i in self.sql.cursor.execute("SELECT id FROM transactions WHERE confirmed_at IS NOT NULL ORDER BY id")]
+        staged = self.sql.unprocessed_staged_payments()
+        self.sql.close_connection()
+        return confirmed, staged
+
+    def test_confirmed(self):
+        self.broadcast("tx1", 6)
+        self.broadcast("tx2", 7)
+        self.assertEqual(self.poll(FakeTrackerClient(forged=["tx1"], pool=["tx2"])), (1, 0))
+        self.assertEqual(self.state(), (["tx1"], 0))
+        self.assertFalse(self.tracker.take_restaged())
+
+    def test_recent_transactions_wait(self):
+        self.broadcast("tx1", 6, seconds_ago=10)
+        self.assertEqual(self.poll(FakeTrackerClient()), (0, 0))
+        self.assertEqual(self.state(), ([], 0))
+
+    def test_still_in_pool(self):
+        self.broadcast("tx1", 6)
+        self.broadcast("tx2", 7)
+        # a transaction in the pool of any node it was broadcast to is kept
+        self.assertEqual(self.poll(FakeTrackerClient(pool=["tx1"]), [FakeTrackerClient(pool=["tx2"])]), (0, 0))
+        self.assertEqual(self.state(), ([], 0))
+
+    def test_dropped(self):
+        self.broadcast("tx1", 6)
+        self.broadcast("tx2", 7)
+        self.assertEqual(self.poll(FakeTrackerClient(pool=["tx1"]), [FakeTrackerClient()]), (0, 1))
+        self.assertEqual(self.state(), ([], 1))
+        self.assertTrue(self.tracker.take_restaged())
+        self.sql.open_connection()
+        self.assertEqual([i[0] for i in self.sql.cursor.execute("SELECT id FROM transactions")], ["tx1"])
+        self.sql.close_connection()
+
+    def test_forged_on_a_peer(self):
+        self.broadcast("tx1", 6)
+        self.assertEqual(self.poll(FakeTrackerClient(), [FakeTrackerClient(forged=["tx1"])]), (1, 0))
+        self.assertEqual(self.state(), (["tx1"], 0))
+
+    def test_lookup_error(self):
+        self.broadcast("tx1", 6)
+        self.broadcast("tx2", 7)
+        # a node that can not be read may still have the transaction
+        self.assertEqual(self.poll(FakeTrackerClient(), [FakeTrackerClient(fail=True)]), (0, 0))
+        self.assertEqual(self.poll(FakeTrackerClient(), [FakeTrackerClient(known=["tx2"])]), (0, 1))
+        self.assertEqual(self.state(), ([], 1))
+
+    def test_nonce_passed(self):
+        self.broadcast("tx1", 6)
+        self.broadcast("tx2", 7)
+        self.broadcast("tx3", 8)
+        # the wallet nonce passed tx1 and tx2 without forging them, a peer that can not tell does not keep them
+        # but the pool holding tx2 does
+        self.assertEqual(self.poll(FakeTrackerClient(pool=["tx2"], nonce=7), [FakeTrackerClient(fail=True)]), (0, 1))
+        self.sql.open_connection()
+        self.assertEqual([i[0] for i in self.sql.cursor.execute("SELECT id FROM transactions ORDER BY id")], ["tx2", "tx3"])
+        self.sql.close_connection()
+
+    def test_expired(self):
+        self.broadcast("tx1", 6, seconds_ago=801)
+        self.broadcast("tx2", 7, seconds_ago=799)
+        # the clock runs ahead of the height the pool expires by, a pool still holding a transaction keeps it
+        self.assertEqual(self.poll(FakeTrackerClient(pool=["tx1", "tx2"]), [FakeTrackerClient(fail=True)]), (0, 0))
+        # the peer that can not be read may hold it
+        self.assertEqual(self.poll(FakeTrackerClient(), [FakeTrackerClient(fail=True)]), (0, 0))
+        # past the pool expiry a transaction is only dropped when no pool can be read
+        self.assertEqual(self.poll(FakeTrackerClient(fail=True), [FakeTrackerClient(fail=True)]), (0, 1))
+        self.sql.open_connection()
+        self.assertEqual([i[0] for i in self.sql.cursor.execute("SELECT id FROM transactions")], ["tx2"])
+        self.sql.close_connection()
+
@@ -0,0 +1,403 @@
+import io
+import os
+import random
+import shutil
+import unittest
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from unittest import mock
+
+import tbw
+from modules.allocate import Allocate
+from modules.balance_index import BalanceIndex
+from modules.catchup import CatchUp
+from modules.ledger import Ledger
+from utility.sql import Sql
+
+
+class Chain:
+    """Votes and balance changes of a generated chain, what core returns for it"""
+    def __init__(self, seed, delegates, voters=12):
+        rng = random.Random(seed)
+        self.keys = [f"03{i:064x}" for i in range(voters)]
+        self.addresses = {k: f"V{i:033d}" for i, k in enumerate(self.keys)}
+
+        # no votes or balance changes around these timestamps, blocks there form stable runs
+        busy = [i for i in range(1, 2100) if not 1000 <= i < 1100 and not 1800 <= i < 1900]
+        self.votes = sorted(((rng.choice(self.keys), ts, rng.choice(delegates), rng.random() < 0.7) for ts in rng.sample(busy, 60)), key=lambda i: i[1])
+        self.deltas = [(self.addresses[k], rng.randrange(1, 300), rng.randrange(10 ** 11, 10 ** 13)) for k in self.keys]
+        self.deltas += [(self.addresses[rng.choice(self.keys)], ts, rng.randrange(-10 ** 10, 10 ** 11)) for ts in rng.sample(busy, 200)]
+
+        # stable runs of 15 blocks after some blocks with activity in between
+        timestamps = sorted(rng.sample(range(400, 1000), 10) + [1000 + i for i in range(15)] + [1800 + i for i in range(15)])
+        self.blocks = [(f"id{h}", ts, 200000000 + h, 1000 * h, h + 1) for h, ts in enumerate(timestamps)]
+
+
+class FakeDatabase:
+    """In-memory stand-in for the core database of one delegate"""
+    def __init__(self, chain, publickey):
+        self.chain = chain
+        self.publickey = publickey
+        self.network = SimpleNamespace(version=30)
+        self.calls = []
+
+    def open_connection(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def get_vote_events(self, timestamp, since=-1):
+        return [(k, ts, is_vote, not is_vote) for k, ts, delegate, is_vote in self.chain.votes
+            if delegate == self.publickey and since < ts <= timestamp]
+
+    def get_votes(self, timestamp, since=-1):
+        vote, unvote = {}, {}
+        for k, ts, is_vote, is_unvote in self.get_vote_events(timestamp, since):
+            (vote if is_vote else unvote)[k] = ts
+        return list(vote.items()), list(unvote.items())
+
+    def has_voter_activity(self, voter_roll, after, timestamp):
+        changes = self.ledger(voter_roll, timestamp, {i[0]: after for i in voter_roll})
+        return bool(changes) or bool(self.get_vote_events(timestamp, after))
+
+    def get_sum_balances(self, voter_roll, timestamp, chkpoint_timestamps):
+        self.calls.append("get_sum_balances")
+        balances = {i[0]: 0 for i in voter_roll}
+        for address, ts, amount in self.ledger(voter_roll, timestamp, chkpoint_timestamps):
+            balances[address] += amount
+        return balances
+
+    def get_balance_deltas(self, voter_roll, timestamp, chkpoint_timestamps):
+        self.calls.append("get_balance_deltas")
+        grouped = {}
+        for address, ts, amount in self.ledger(voter_roll, timestamp, chkpoint_timestamps):
+            grouped[(address, ts)] = grouped.get((address, ts), 0) + amount
+        return [(k[0], k[1], v) for k, v in sorted(grouped.items())]
+
+    def ledger(self, voter_roll, timestamp, chkpoint_timestamps):
+        addresses = {i[0] for i in voter_roll}
+        return [i for i in self.chain.deltas if i[0] in addresses and chkpoint_timestamps.get(i[0], 0) < i[1] <= timestamp]
+
+
+class FakeCache:
+    """Public key to address cache that never touches disk"""
+    def __init__(self, addresses):
+        self.addresses = dict(addresses)
+
+    def get_addresses(self):
+        return self.addresses
+
+    def store_addresses(self, addresses):
+        self.addresses.update(addresses)
+
+
+def make_config(**kwargs):
+    config = dict(
+        username="replay", delegate="replay", network="replay_test", atomic=100000000, voter_share=90,
+        voter_cap=0, voter_min=0.0001, whitelist='N', whitelist_address=[], blacklist='N', blacklist_address=[],
+        delegate_fee=['7', '3'], delegate_fee_address=["D" + "1" * 33, "D" + "2" * 33], donate='N', donate_address='',
+        donate_percent=0, message="Reward", multi='N', interval=7, vectorize="N", catchup_blocks=0,
+        flush_blocks=1, flush_seconds=60)
+    config.update(kwargs)
+    return SimpleNamespace(**config)
+
+
+class ReplayTest(unittest.TestCase):
+    """Runs delegates against a generated chain with a real tbw database each"""
+    delegates = ["02" + "a" * 64, "02" + "b" * 64]
+
+    def setUp(self):
+        self.chain = Chain(16, self.delegates)
+        self.cache = FakeCache(self.chain.addresses)
+        self.dynamic = SimpleNamespace(refresh=lambda: None, get_dynamic_fee=lambda: 1000,
+            get_multipay_limit=lambda: 50, get_dynamic_fee_multi=lambda n: 1000 * n)
+        self.logger = tbw.logging.getLogger('tbw_replay')
+        self.sqls = []
+
+    def tearDown(self):
+        for sql in self.sqls:
+            sql.close()
+            shutil.rmtree(os.path.dirname(sql.data_path))
+
+    def delegate(self, publickey=delegates[0], **kwargs):
+        """Config, database, tbw database and Allocate of a fresh delegate"""
+        config = make_config(**kwargs)
+        sql = Sql(f"test_replay_{os.getpid()}_{len(self.sqls)}")
+        self.sqls.append(sql)
+        # Sql creates tables of an older layout that setup() does not replace
+        for table in ["blocks", "voters", "transactions", "staging"]:
+            sql.cursor.execute(f"DROP TABLE {table}")
+        sql.setup()
+        sql.open_connection()
+        sql.store_delegate_rewards(config.delegate_fee_address)
+        sql.close_connection()
+        database = FakeDatabase(self.chain, publickey)
+        return config, database, sql, Allocate(database, config, sql, self.cache)
+
+    def store(self, sql, blocks):
+        """Store new blocks and return the unprocessed ones, as fetch_blocks does"""
+        sql.open_connection()
+        sql.store_blocks(blocks)
+        unprocessed_blocks = sql.unprocessed_blocks().fetchall()
+        sql.close_connection()
+        return unprocessed_blocks
+
+    def process(self, config, database, sql, allocate, unprocessed_blocks, ledger=None):
+        with redirect_stdout(io.StringIO()):
+            tbw.process_blocks(config, self.dynamic, database, sql, allocate, unprocessed_blocks, self.logger, ledger)
+
+    def run_cycles(self, cycles, **kwargs):
+        """Process the chain's blocks in cycles ending at the given block counts, returns the final state"""
+        config, database, sql, allocate = self.delegate(**kwargs)
+        self.database = database
+        start = 0
+        for end in cycles:
+            self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[start:end]))
+            start = end
+        return self.state(sql)
+
+    def state(self, sql):
+        """Everything the allocation writes, in a comparable form"""
+        sql.open_connection()
+        state = {
+            "voters": sorted(sql.cursor.execute("SELECT address, unpaid_bal, paid_bal, share FROM voters").fetchall()),
+            "delegate_rewards": sorted(sql.cursor.execute("SELECT * FROM delegate_rewards").fetchall()),
+            "checkpoints": sorted(sql.cursor.execute("SELECT * FROM voters_balance_checkpoint").fetchall()),
+            "votes": sorted(sql.cursor.execute("SELECT * FROM votes").fetchall()),
+            "unprocessed": sql.cursor.execute("SELECT height FROM blocks WHERE processed_at IS NULL").fetchall(),
+            "staging": sorted(i[:3] for i in sql.cursor.execute("SELECT * FROM staging").fetchall())}
+        sql.close_connection()
+        return state
+
+    def assertSameState(self, expected, actual):
+        for k in expected:
+            self.assertEqual(expected[k], actual[k], k)
+
+
+class TestLedger(ReplayTest):
+    def test_delta_matches_balance_query(self):
+        config, database, sql, allocate = self.delegate()
+        roll = [[v, k] for k, v in self.chain.addresses.items()]
+        starts = {address: i * 50 for i, (address, public_key) in enumerate(roll)}
+        ledger = Ledger(config.network)
+        ledger.load(database, roll, 1500, starts)
+
+        for upto in (300, 777, 1050, 1500):
+            expected = database.get_sum_balances(roll, upto, starts)
+            self.assertEqual({k: ledger.delta(k, starts[k], upto) for k, v in roll}, expected)
+        self.assertTrue(ledger.covers(roll[3][0], starts[roll[3][0]], 1500))
+        self.assertFalse(ledger.covers(roll[3][0], starts[roll[3][0]] - 1, 1500))
+        self.assertFalse(ledger.covers(roll[3][0], starts[roll[3][0]], 1501))
+        self.assertFalse(ledger.covers("V" + "9" * 33, 0, 1500))
+
+    def test_shared_ledger_matches_own_queries(self):
+        # two delegates with voters in common are a cycle apart, the shared ledger starts at the older checkpoints
+        own = [self.delegate(i, username=f"own{n}") for n, i in enumerate(self.delegates)]
+        shared = [self.delegate(i, username=f"shared{n}") for n, i in enumerate(self.delegates)]
+        for config, database, sql, allocate in (own[0], shared[0]):
+            self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[:6]))
+
+        pending = []
+        for config, database, sql, allocate in own + shared:
+            database.calls.clear()
+            pending.append((Allocate(database, config, sql, self.cache), self.store(sql, self.chain.blocks[:30])))
+
+        ledger_database = FakeDatabase(self.chain, None)
+        ledger = tbw.load_ledger(make_config().network, ledger_database, [tbw.ledger_roll(*i) for i in pending[2:]])
+        self.assertEqual(ledger.timestamp, self.chain.blocks[29][1])
+        self.assertEqual(ledger_database.calls, ["get_balance_deltas"])
+        for allocate, unprocessed_blocks in pending[2:]:
+            for address, (public_key, chkpoint_ts) in allocate.get_ledger_roll(ledger.timestamp).items():
+                self.assertTrue(ledger.covers(address, chkpoint_ts, ledger.timestamp))
+
+        for (config, database, sql, _), (allocate, unprocessed_blocks) in zip(own, pending[:2]):
+            self.process(config, database, sql, allocate, unprocessed_blocks)
+        for (config, database, sql, _), (allocate, unprocessed_blocks) in zip(shared, pending[2:]):
+            database.calls.clear()
+            self.process(config, database, sql, allocate, unprocessed_blocks, ledger)
+            self.assertNotIn("get_sum_balances", database.calls)
+        for a, b in zip(own, shared):
+            self.assertSameState(self.state(a[2]), self.state(b[2]))
+
+    def test_nothing_to_load(self):
+        config, database, sql, allocate = self.delegate()
+        self.assertIsNone(tbw.ledger_roll(allocate, []))
+        self.assertIsNone(tbw.load_ledger(config.network, database, [tbw.ledger_roll(allocate, [])]))
+        self.assertEqual(database.calls, [])
+
+
+
+class TestCatchUp(ReplayTest):
+    def assert_golden(self, cycles, **kwargs):
+        expected = self.run_cycles(cycles, catchup_blocks=0, **kwargs)
+        self.assertNotIn("get_balance_deltas", self.database.calls)
+        actual = self.run_cycles(cycles, catchup_blocks=5, **kwargs)
+        self.assertIn("get_balance_deltas", self.database.calls)
+        self.assertSameState(expected, actual)
+        self.assertTrue(expected["staging"])
+
+    def test_whole_backlog(self):
+        self.assert_golden([40])
+
+    def test_backlog_in_cycles(self):
+        # the middle cycle is short enough to be processed block by block
+        self.assert_golden([12, 15, 40])
+
+    def test_voter_cap(self):
+        self.assert_golden([3, 26, 40], voter_cap=20000)
+
+    def test_other_delegate(self):
+        self.assert_golden([12, 40], publickey=self.delegates[1])
+
+
+
+class TestStableRuns(ReplayTest):
+    def assert_golden(self, cycles, **kwargs):
+        with mock.patch.object(Allocate, "is_stable", lambda *args: False):
+            expected = self.run_cycles(cycles, **kwargs)
+
+        runs = []
+        run = CatchUp.run
+        def record(catch_up, blocks, voter_options):
+            runs.append([i[4] for i in blocks])
+            return run(catch_up, blocks, voter_options)
+        with mock.patch.object(CatchUp, "run", record):
+            actual = self.run_cycles(cycles, **kwargs)
+
+        self.assertSameState(expected, actual)
+        self.assertTrue(any(len(i) > 1 for i in runs))
+        interval = make_config(**kwargs).interval
+        for heights in runs:
+            # a run never crosses a payout interval and only stops short of one at the end of a cycle
+            self.assertEqual((heights[0] - 1) // interval, (heights[-1] - 1) // interval, heights)
+            self.assertTrue(heights[-1] % interval == 0 or heights[-1] in cycles, heights)
+        return runs
+
+    def test_runs_up_to_payout_interval(self):
+        runs = self.assert_golden([40])
+        # blocks 11 to 25 and 27 to 40 have no voter activity since the block before them, a run up to
+        # the next interval that spans both ranges is not stable, so blocks 22 to 26 are processed on their own
+        self.assertEqual(runs, [[11, 12, 13, 14], [15, 16, 17, 18, 19, 20, 21], [27, 28], [29, 30, 31, 32, 33, 34, 35], [36, 37, 38, 39, 40]])
+
+    def test_runs_end_with_cycle(self):
+        self.assert_golden([12, 30, 33, 40])
+
+    def test_other_interval(self):
+        self.assert_golden([20, 40], interval=5, voter_cap=20000)
+
+
+
+class TestBalanceIndex(ReplayTest):
+    def voter_balance(self, allocate, block):
+        with redirect_stdout(io.StringIO()):
+            voter_roll = allocate.create_voter_roll(*allocate.get_vote_transactions(block[1]))
+        return voter_roll, allocate.get_voter_balance(block, voter_roll)
+
+    def test_history_of_every_checkpoint(self):
+        config, database, sql, allocate = self.delegate()
+        self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[:30]))
+
+        sql.open_connection()
+        rows = sql.get_balance_index(list(self.chain.addresses.values())).fetchall()
+        sql.close_connection()
+        index = BalanceIndex(rows)
+        public_keys = {v: k for k, v in self.chain.addresses.items()}
+        self.assertTrue(rows)
+        for address, timestamp, balance in rows:
+            self.assertEqual(database.get_sum_balances([[address, public_keys[address]]], timestamp, {})[address], balance)
+            self.assertEqual(index.balance_at(address, timestamp), (balance, timestamp))
+            self.assertIsNone(index.balance_at(address, index.timestamps[address][0] - 1))
+
+    def test_replayed_block_matches_balances_from_scratch(self):
+        config, database, sql, allocate = self.delegate(username="replay")
+        self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[:40]))
+
+        # every replay stores checkpoints at the replayed block, the next one goes further back
+        for block in (self.chain.blocks[30], self.chain.blocks[17], self.chain.blocks[6], self.chain.blocks[0]):
+            expected = self.voter_balance(self.delegate(username="scratch")[3], block)
+            with self.assertLogs('allocate_replay', level='INFO') as logs:
+                actual = self.voter_balance(allocate, block)
+            self.assertTrue(any("Replaying block" in i for i in logs.output))
+            self.assertEqual(actual, expected)
+
+
+
+class TestAllocationBuffer(ReplayTest):
+    def test_flushed_before_payout_and_when_due(self):
+        payouts = []
+        check_payout = tbw.check_payout
+        def record(config, dynamic, sql, block_count, logger):
+            payouts.append((block_count, list(allocate.buffer.heights)))
+            return check_payout(config, dynamic, sql, block_count, logger)
+
+        config, database, sql, allocate = self.delegate(flush_blocks=3, flush_seconds=3600)
+        with mock.patch.object(Allocate, "is_stable", lambda *args: False), mock.patch.object(tbw, "check_payout", record):
+            self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[:40]))
+
+        self.assertEqual([i[0] for i in payouts], list(range(1, 41)))
+        for block_count, heights in payouts:
+            if block_count % config.interval == 0:
+                self.assertEqual(heights, [])
+            self.assertLess(len(heights), config.flush_blocks)
+        self.assertTrue(any(i[1] for i in payouts))
+        self.assertEqual(self.state(sql)["unprocessed"], [])
+
+    def test_flushed_before_catch_up(self):
+        entries = []
+        run = CatchUp.run
+        def record(catch_up, blocks, voter_options):
+            entries.append(list(catch_up.allocate.buffer.heights))
+            run(catch_up, blocks, voter_options)
+            self.assertEqual(catch_up.allocate.buffer.heights, [])
+
+        expected = self.run_cycles([12, 40])
+        with mock.patch.object(CatchUp, "run", record):
+            actual = self.run_cycles([12, 40], flush_blocks=100, flush_seconds=3600)
+        # stable runs follow blocks still in the buffer
+        self.assertTrue(any(entries))
+        self.assertSameState(expected, actual)
+
+    def test_unflushed_blocks_are_processed_again(self):
+        expected = self.run_cycles([40])
+
+        class Crash(Exception):
+            pass
+        def crash(config, dynamic, sql, block_count, logger):
+            if block_count == 10:
+                raise Crash()
+            return check_payout(config, dynamic, sql, block_count, logger)
+        check_payout = tbw.check_payout
+
+        config, database, sql, allocate = self.delegate(flush_blocks=100, flush_seconds=3600)
+        with mock.patch.object(tbw, "check_payout", crash), self.assertRaises(Crash):
+            self.process(config, database, sql, allocate, self.store(sql, self.chain.blocks[:40]))
+        # the rewards of blocks 8 to 10 were only in the buffer, the blocks are left unprocessed
+        self.assertEqual(allocate.buffer.heights, [8, 9, 10])
+        self.assertEqual(self.state(sql)["unprocessed"], [(i,) for i in range(8, 41)])
+
+        # the restarted process replays them from the balance history
+        allocate = Allocate(database, config, sql, self.cache)
+        self.process(config, database, sql, allocate, self.store(sql, []))
+        self.assertSameState(expected, self.state(sql))
+
+    def test_unpaid_includes_buffered_rewards(self):
+        config, database, sql, allocate = self.delegate(flush_blocks=100, flush_seconds=3600)
+        voters = list(self.chain.addresses.values())[:3]
+        sql.open_connection()
+        sql.store_voters([[i, None] for i in voters], config.voter_share)
+        sql.update_voter_balance({voters[0]: 100, voters[1]: 20})
+        sql.close_connection()
+
+        allocate.buffer.add(self.chain.blocks[0], {voters[0]: 5, voters[2]: 7}, {config.delegate_fee_address[0]: 1})
+        allocate.buffer.add(self.chain.blocks[1], {voters[0]: 5}, {config.delegate_fee_address[0]: 1})
+        self.assertEqual(allocate.buffer.unpaid(), {voters[0]: 110, voters[1]: 20, voters[2]: 7})
+        self.assertEqual(self.state(sql)["voters"][0][1], 100)
+
+        allocate.buffer.flush()
+        self.assertEqual(allocate.buffer.unpaid(), {voters[0]: 110, voters[1]: 20, voters[2]: 7})
+        self.assertEqual(allocate.buffer.heights, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
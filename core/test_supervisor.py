@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import supervisor
+
+
+class StopSupervisor(Exception):
+    """Raised by the fake events to end the otherwise endless loop"""
+
+
+class FakeEvents:
+    """Stand-in for the block events of a network, a cycle ends when it waits for the next block"""
+    def __init__(self, network, cycles):
+        self.watched = []
+        self.cycles = cycles
+
+    def watch(self, public_key):
+        self.watched.append(public_key)
+
+    def start(self, database):
+        pass
+
+    def wait(self, timeout):
+        self.cycles -= 1
+        if not self.cycles:
+            raise StopSupervisor()
+
+
+class TestRunTbw(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.rolls = []
+
+    def load_delegate(self, delegate_name, logger):
+        self.calls.append(("load", delegate_name))
+        if delegate_name == "load_fails":
+            quit()
+        database = SimpleNamespace(network=SimpleNamespace(network="fake"), publickey=f"key_{delegate_name}")
+        return SimpleNamespace(name=delegate_name), None, database, None, None
+
+    def fetch_blocks(self, config, database, sql, logger):
+        if config.name == "fetch_fails":
+            raise ValueError("core unreachable")
+        return [(f"block_{config.name}",)]
+
+    def load_ledger(self, network_name, database, rolls):
+        self.rolls.append(sorted(rolls))
+        return "ledger"
+
+    def process_blocks(self, config, dynamic, database, sql, allocate, unprocessed_blocks, logger, ledger):
+        self.calls.append(("process", config.name, ledger))
+        if config.name == "process_fails":
+            quit()
+
+    def run_tbw(self, delegate_names, cycles):
+        logger = mock.Mock()
+        with mock.patch.object(supervisor.tbw, "load_delegate", self.load_delegate), \
+                mock.patch.object(supervisor.tbw, "fetch_blocks", self.fetch_blocks), \
+                mock.patch.object(supervisor.tbw, "ledger_roll", lambda allocate, unprocessed_blocks: allocate), \
+                mock.patch.object(supervisor.tbw, "load_ledger", self.load_ledger), \
+                mock.patch.object(supervisor.tbw, "process_blocks", self.process_blocks), \
+                mock.patch.object(supervisor, "Allocate", lambda database, config, sql, cache: config.name), \
+                mock.patch.object(supervisor, "Database", lambda config, network, resolve: "ledger_database"), \
+                mock.patch.object(supervisor, "Events", lambda network: FakeEvents(network, cycles)):
+            with self.assertRaises(StopSupervisor):
+                asyncio.run(supervisor.run_tbw("fake", delegate_names, logger))
+        return [i.args[0] for i in logger.error.call_args_list]
+
+    def test_failing_delegates_are_isolated(self):
+        errors = self.run_tbw(["load_fails", "healthy", "fetch_fails", "process_fails"], 2)
+
+        # the healthy delegate is processed every cycle with the shared ledger
+        processed = [i for i in self.calls if i[0] == "process"]
+        self.assertEqual(processed.count(("process", "healthy", "ledger")), 2)
+        self.assertEqual(processed.count(("process", "process_fails", "ledger")), 2)
+        self.assertEqual(self.rolls, [["healthy", "process_fails"]] * 2)
+
+        # quit() becomes a logged error, a delegate that failed to load is retried
+        self.assertEqual(self.calls.count(("load", "load_fails")), 2)
+        self.assertEqual(errors.count("Error loading delegate load_fails: Step exited with code None"), 2)
+        self.assertEqual(errors.count("Error fetching blocks for fetch_fails: core unreachable"), 2)
+        self.assertEqual(errors.count("Error processing blocks for process_fails: Step exited with code None"), 2)
+        self.assertEqual(len(errors), 6)
+
+    def test_ledger_failure_falls_back(self):
+        def load_ledger(network_name, database, rolls):
+            raise ValueError("ledger query failed")
+        self.load_ledger = load_ledger
+        errors = self.run_tbw(["healthy"], 1)
+
+        # without the shared ledger the delegate uses its own balance queries
+        self.assertEqual([i for i in self.calls if i[0] == "process"], [("process", "healthy", None)])
+        self.assertEqual(errors, ["Error loading shared ledger for fake: ledger query failed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import logging
+
+from utility.sql import connect
+
+
+class Cache:
+    def __init__(self, network):
+        """
+        Initialize the lookup cache shared by every delegate on this installation
+
+        Keeps values that never change once derived, such as the address of a
+        public key, in pay_database/cache.db keyed by network.
+
+        Args:
+            network: Network identifier (e.g. "ark_mainnet")
+        """
+        self.project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+        self.network = network
+        self.addresses = None
+
+        # Set up logging
+        self.logger = logging.getLogger(f'cache_{network}')
+
+        data_dir = os.path.join(self.project_root, "pay_database")
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_path = os.path.join(data_dir, "cache.db")
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS addresses (network varchar(64), public_key varchar(66), address varchar(36), PRIMARY KEY (network, public_key) )")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS delegates (network varchar(64), username varchar(64), public_key varchar(66), PRIMARY KEY (network, username) )")
+        self.connection.commit()
+
+
+    @property
+    def connection(self):
+        """Connection of the calling thread"""
+        return connect(self.data_path)
+
+
+    def get_addresses(self):
+        """Public key to address map for this network, loaded once and kept in memory"""
+        if self.addresses is None:
+            rows = self.connection.execute("SELECT public_key, address FROM addresses WHERE network = ?", (self.network,)).fetchall()
+            self.addresses = {i[0]:i[1] for i in rows}
+            self.logger.debug(f"Loaded {len(self.addresses)} cached addresses")
+        return self.addresses
+
+
+    def store_addresses(self, addresses):
+        """
+        Add derived addresses to the cache
+
+        Args:
+            addresses: Dictionary of public keys and their addresses
+        """
+        self.get_addresses().update(addresses)
+        self.connection.executemany("INSERT OR IGNORE INTO addresses VALUES (?,?,?)", [(self.network, k, v) for k, v in addresses.items()])
+        self.connection.commit()
+        self.logger.debug(f"Cached {len(addresses)} new addresses")
+
+
+    def get_publickey(self, username):
+        """Public key of a registered delegate, None if it was never resolved"""
+        row = self.connection.execute("SELECT public_key FROM delegates WHERE network = ? AND username = ?", (self.network, username)).fetchone()
+        return row[0] if row else None
+
+
+    def store_publickeys(self, publickeys):
+        """
+        Add resolved delegate public keys to the cache
+
+        Args:
+            publickeys: Dictionary of delegate usernames and their public keys
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO delegates VALUES (?,?,?)", [(self.network, k, v) for k, v in publickeys.items()])
+        self.connection.commit()
+        self.logger.debug(f"Cached {len(publickeys)} delegate public keys")
@@ -1,20 +1,67 @@
+import json
 import psycopg
+from psycopg_pool import ConnectionPool
 import logging
+import threading
+
+from utility.cache import Cache
+
+# connection pools are shared by every Database in the process, keyed by connection string
+pools = {}
+pools_lock = threading.Lock()
+
+
+# balance changes of the voters in "roll" since their checkpoint, shared by the batched balance queries
+# every branch bounds "transactions" itself: a CTE referenced more than once is materialized without
+# indexes, and "since" is 0 as soon as one voter has no checkpoint, so it copied the whole table
+BOUNDS = """"t"."timestamp" <= %(timestamp)s AND "t"."timestamp" > %(since)s"""
+LEDGER = f"""WITH "roll" AS (SELECT * FROM unnest(%(addresses)s::text[],
+            %(public_keys)s::text[], %(checkpoints)s::bigint[]) AS "r"("address", "public_key", "checkpoint")),
+            "ledger" AS (
+                SELECT "r"."address", "t"."timestamp", "t"."amount" FROM "roll" "r" JOIN "transactions" "t" ON "t"."recipient_id" = "r"."address"
+                AND "t"."timestamp" > "r"."checkpoint" WHERE {BOUNDS} AND "t"."type" <> 6
+                UNION ALL
+                SELECT "r"."address", "t"."timestamp", ("p"->>'amount')::numeric FROM "transactions" "t"
+                CROSS JOIN LATERAL jsonb_array_elements("t"."asset"::jsonb->'payments') AS "p"
+                JOIN "roll" "r" ON "r"."address" = "p"->>'recipientId' AND "t"."timestamp" > "r"."checkpoint"
+                WHERE {BOUNDS} AND "t"."asset"::jsonb ? 'payments'
+                UNION ALL
+                SELECT "r"."address", "t"."timestamp", -(CASE WHEN "t"."asset" IS NULL THEN "t"."amount" ELSE 0 END + "t"."fee") FROM "roll" "r"
+                JOIN "transactions" "t" ON "t"."sender_public_key" = "r"."public_key" AND "t"."timestamp" > "r"."checkpoint"
+                WHERE {BOUNDS}
+                UNION ALL
+                SELECT "r"."address", "t"."timestamp", -("p"->>'amount')::numeric FROM "roll" "r"
+                JOIN "transactions" "t" ON "t"."sender_public_key" = "r"."public_key" AND "t"."timestamp" > "r"."checkpoint"
+                CROSS JOIN LATERAL jsonb_array_elements("t"."asset"::jsonb->'payments') AS "p"
+                WHERE {BOUNDS} AND "t"."asset" IS NOT NULL AND "t"."asset"::jsonb ? 'payments'
+                UNION ALL
+                SELECT "r"."address", "b"."timestamp", "b"."reward" + "b"."total_fee" FROM "roll" "r" JOIN "blocks" "b"
+                ON "b"."generator_public_key" = "r"."public_key" AND "b"."timestamp" > "r"."checkpoint"
+                WHERE "b"."timestamp" <= %(timestamp)s)"""
+
 
 class Database:
-    def __init__(self, config, network):
+    def __init__(self, config, network, resolve=True):
         self.logger = logging.getLogger(f'database_{config.username}')
 
+        self.network = network
         self.database = network.database
         self.database_host = network.database_host
         self.username = config.username
         self.password = network.password
         self.delegate = config.delegate
+        self.pool_min = network.pool_min
+        self.pool_max = network.pool_max
+        self.pool_timeout = network.pool_timeout
+        self.cache = Cache(config.network)
 
         try:
-            self.open_connection()
-            self.get_publickey()
-            self.close_connection()
+            self.pool = self.get_pool()
+            # resolve=False leaves the public key lookup to a batched get_publickeys
+            if resolve:
+                self.open_connection()
+                self.get_publickey()
+                self.close_connection()
         except Exception as e:
             self.logger.error(f"Error opening database connection for delegate: {self.delegate}")
             self.logger.error(f"Database error details: {str(e)}")
@@ -28,18 +75,45 @@ class Database:
             raise
 
     
+    def get_conninfo(self):
+        return psycopg.conninfo.make_conninfo(
+            dbname = self.database,
+            user = self.username,
+            password= self.password,
+            host=self.database_host,
+            port='5432')
+
+
+    def get_pool(self):
+        """Get the process wide connection pool for this database, creating it on first use"""
+        conninfo = self.get_conninfo()
+
+        # delegates running on separate threads share the pool, only one may create it
+        with pools_lock:
+            pool = pools.get(conninfo)
+            if pool is None or pool.closed:
+                self.logger.info(f"Connecting to database {self.database} at {self.database_host} as {self.username}")
+                # connections are health checked when borrowed and replaced in the background when lost
+                pool = ConnectionPool(
+                    conninfo,
+                    min_size=self.pool_min,
+                    max_size=self.pool_max,
+                    kwargs={"autocommit": True},
+                    check=ConnectionPool.check_connection,
+                    timeout=self.pool_timeout,
+                    name=f"tbw_{self.database}",
+                    open=True)
+                pool.wait(timeout=self.pool_timeout)
+                pools[conninfo] = pool
+                self.logger.info(f"Connection pool opened with {self.pool_min} to {self.pool_max} connections")
+        return pool
+
+
     def open_connection(self):
         try:
-            self.logger.info(f"Connecting to database {self.database} at {self.database_host} as {self.username}")
-            self.connection = psycopg.connect(
-                dbname = self.database,
-                user = self.username,
-                password= self.password,
-                host=self.database_host,
-                port='5432')
-                
+            self.connection = self.pool.getconn()
             self.cursor=self.connection.cursor()
-            self.logger.debug(f"Database connection opened for delegate: {self.delegate}")        
+            self.logger.debug(f"Database connection borrowed for delegate: {self.delegate}")        
      
         except Exception as e:
             self.logger.error(f"Error opening database connection for delegate: {self.delegate}")
@@ -48,35 +122,100 @@ class Database:
     def close_connection(self):
         try:
             self.cursor.close()
-            self.connection.close()
-            self.logger.debug(f"Database connection closed for delegate: {self.delegate}")
+            # broken connections are discarded by the pool and reconnected
+            self.pool.putconn(self.connection)
+            self.logger.debug(f"Database connection returned for delegate: {self.delegate}")
         except Exception as e:
             self.logger.error(f"Error closing database connection: {str(e)}")
+
+
+    def close(self):
+        """Close the connection pool, required before forking processes that use their own"""
+        self.pool.close()
+        self.logger.debug(f"Connection pool closed for delegate: {self.delegate}")
     
     
+    def install_block_notify(self):
+        """
+        Install a trigger on the core blocks table that notifies the tbw_blocks channel
+
+        The payload of every notification is the generator public key of the new block.
+        Needs trigger privileges on the core database. Installing is serialized by an
+        advisory lock, so processes starting at the same time do not race. The trigger
+        stays installed when tbw stops, see the README on how to remove it.
+        """
+        try:
+            with self.connection.transaction():
+                self.cursor.execute("SELECT pg_advisory_xact_lock(hashtext('tbw_notify_block'))")
+                self.cursor.execute("""CREATE OR REPLACE FUNCTION tbw_notify_block() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('tbw_blocks', NEW.generator_public_key);
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql""")
+                if self.connection.info.server_version >= 140000:
+                    self.cursor.execute("CREATE OR REPLACE TRIGGER tbw_notify_block AFTER INSERT ON blocks FOR EACH ROW EXECUTE PROCEDURE tbw_notify_block()")
+                else:
+                    # CREATE OR REPLACE TRIGGER needs PostgreSQL 14
+                    self.cursor.execute("DROP TRIGGER IF EXISTS tbw_notify_block ON blocks")
+                    self.cursor.execute("CREATE TRIGGER tbw_notify_block AFTER INSERT ON blocks FOR EACH ROW EXECUTE PROCEDURE tbw_notify_block()")
+            self.logger.info("Installed block notification trigger")
+        except Exception as e:
+            self.logger.error(f"Error installing block notification trigger: {str(e)}")
+            raise
+
+
+    def listen_blocks(self):
+        """
+        Open a dedicated connection listening for block notifications
+
+        The connection is held for as long as notifications are read, so it does not
+        come from the pool.
+
+        Returns:
+            Connection subscribed to the tbw_blocks channel
+        """
+        connection = psycopg.connect(self.get_conninfo(), autocommit=True)
+        connection.execute("LISTEN tbw_blocks")
+        return connection
+
+
     def get_publickey(self):
         try:
             self.logger.info(f"Retrieving public key for delegate: {self.delegate}")
-            universe = self.cursor.execute(f"""SELECT "sender_public_key", "asset" FROM transactions WHERE 
-            "type" = 2""").fetchall()
-            
-            found = False
-            for i in universe:
-                for k,v in i[1].items():
-                    if k == 'delegate' and v['username']==self.delegate:
-                        self.publickey = i[0]
-                        found = True
-                        self.logger.info(f"Found public key for delegate: {self.delegate}")
-                        break
-                if found:
-                    break
-                    
-            if not found:
+            publickey = self.cache.get_publickey(self.delegate)
+            if publickey is None:
+                publickey = self.get_publickeys([self.delegate]).get(self.delegate)
+
+            found = publickey is not None
+            if found:
+                self.publickey = publickey
+                self.logger.info(f"Found public key for delegate: {self.delegate}")
+            else:
                 self.logger.warning(f"Public key not found for delegate: {self.delegate}")
                 print(f"Warning: Public key not found for delegate: {self.delegate}")
         except Exception as e:
             self.logger.error(f"Error retrieving public key: {str(e)}")
             print(f"Error retrieving public key: {str(e)}")
+
+
+    def get_publickeys(self, usernames):
+        """
+        Resolve the public keys of several delegates in one query and cache them
+
+        Args:
+            usernames: List of delegate usernames
+
+        Returns:
+            Dictionary of usernames and public keys for the registered delegates
+        """
+        output = self.cursor.execute("""SELECT "asset"::jsonb->'delegate'->>'username', "sender_public_key" FROM transactions
+        WHERE "type" = 2 AND "type_group" = 1 AND "asset"::jsonb->'delegate'->>'username' = ANY(%s)""", (list(usernames),)).fetchall()
+        publickeys = {i[0]:i[1] for i in output}
+        if publickeys:
+            self.cache.store_publickeys(publickeys)
+        self.logger.debug(f"Resolved {len(publickeys)} of {len(usernames)} delegate public keys")
+        return publickeys
             
     
 # BLOCK OPERATIONS    
@@ -99,84 +238,155 @@ class Database:
             
 
 # VOTE OPERATIONS
-    def get_votes(self, timestamp):
+    def get_votes(self, timestamp, since=-1):
         try:
             v = "+" + self.publickey
             u = "-" + self.publickey
 
             # get all votes
             vote = self.cursor.execute("""SELECT "sender_public_key", MAX("timestamp") AS "timestamp" FROM (SELECT * FROM 
-            "transactions" WHERE "timestamp" <= %s AND "type" = 3 AND "type_group" = 1) AS "filtered" WHERE asset::jsonb @> '{
-            "votes": ["%s"]}'::jsonb GROUP BY "sender_public_key";""" % (timestamp, v)).fetchall()
+            "transactions" WHERE "timestamp" <= %s AND "timestamp" > %s AND "type" = 3 AND "type_group" = 1) AS "filtered" WHERE asset::jsonb @> '{
+            "votes": ["%s"]}'::jsonb GROUP BY "sender_public_key";""" % (timestamp, since, v)).fetchall()
 
             #get all unvotes
             unvote = self.cursor.execute("""SELECT "sender_public_key", MAX("timestamp") AS "timestamp" FROM (SELECT * FROM 
-            "transactions" WHERE "timestamp" <= %s AND "type" = 3 AND "type_group" = 1) AS "filtered" WHERE asset::jsonb @> '{
-            "votes": ["%s"]}'::jsonb GROUP BY "sender_public_key";""" % (timestamp, u)).fetchall()
+            "transactions" WHERE "timestamp" <= %s AND "timestamp" > %s AND "type" = 3 AND "type_group" = 1) AS "filtered" WHERE asset::jsonb @> '{
+            "votes": ["%s"]}'::jsonb GROUP BY "sender_public_key";""" % (timestamp, since, u)).fetchall()
 
             return vote, unvote
         except Exception as e:
             print(e)
 
 
-    # ACCOUNT OPERATIONS
-    def get_sum_inbound(self, account, timestamp, chkpoint_timestamp):
+    def get_vote_events(self, timestamp, since=-1):
+        """
+        Get every vote and unvote for the delegate in a timestamp range, oldest first
+
+        Args:
+            timestamp: Timestamp to read up to
+            since: Timestamp to read from, exclusive
+
+        Returns:
+            List of (public_key, timestamp, is_vote, is_unvote) rows
+        """
+        params = {
+            "vote": "+" + self.publickey,
+            "unvote": "-" + self.publickey,
+            "vote_asset": json.dumps({"votes": ["+" + self.publickey]}),
+            "unvote_asset": json.dumps({"votes": ["-" + self.publickey]}),
+            "timestamp": timestamp,
+            "since": since}
         try:
-            # get inbound non-multi transactions
-            output = self.cursor.execute(f"""SELECT SUM("amount") FROM (SELECT * FROM "transactions" WHERE "timestamp" <= {timestamp} AND "timestamp" > {chkpoint_timestamp}) AS
-            "filtered" WHERE "recipient_id" = '{account}' AND "type" <> {6}""").fetchall()
-            if output[0][0] == None:
-                non_multi = [0]
-            else:
-                non_multi = [int(i) for i in output[0]]
+            return self.cursor.execute("""SELECT "sender_public_key", "timestamp", asset::jsonb->'votes' ? %(vote)s, asset::jsonb->'votes' ? %(unvote)s
+            FROM (SELECT * FROM "transactions" WHERE "timestamp" <= %(timestamp)s AND "timestamp" > %(since)s AND "type" = 3 AND "type_group" = 1) AS "filtered"
+            WHERE asset::jsonb @> %(vote_asset)s::jsonb OR asset::jsonb @> %(unvote_asset)s::jsonb ORDER BY "timestamp";""", params).fetchall()
         except Exception as e:
-            print(e)
+            self.logger.error(f"Error retrieving vote events: {str(e)}")
+            raise
+
+
+    def has_voter_activity(self, voter_roll, after, timestamp):
+        """
+        Check for balance changes of the voters in the roll or votes for the delegate in a timestamp range with one query
+
+        Args:
+            voter_roll: List of [address, public_key] pairs
+            after: Timestamp to check from, exclusive
+            timestamp: Timestamp to check up to, inclusive
 
+        Returns:
+            True if any voter balance or vote changed
+        """
+        params = {
+            "addresses": [i[0] for i in voter_roll],
+            "public_keys": [i[1] for i in voter_roll],
+            "checkpoints": [after for i in voter_roll],
+            "vote_asset": json.dumps({"votes": ["+" + self.publickey]}),
+            "unvote_asset": json.dumps({"votes": ["-" + self.publickey]}),
+            "since": after,
+            "timestamp": timestamp}
         try:
-            # get inbound multi transactions
-            multi_universe = self.cursor.execute("""SELECT "timestamp", "fee", "sender_public_key", "asset", "id" FROM (SELECT * FROM 
-            "transactions" WHERE "timestamp" <= %s AND "timestamp" > %s) AS "filtered" WHERE asset::jsonb @> '{"payments": [{"recipientId":"%s"}]}'::jsonb;""" 
-            % (timestamp, chkpoint_timestamp, account)).fetchall()
-            # get amounts from multi transactions
-            multi_amount = []
-            for i in multi_universe:
-                for j in i[3]['payments']:
-                    if j['recipientId'] == account:
-                        multi_amount.append(int(j['amount']))
+            return self.cursor.execute(f"""{LEDGER}
+            SELECT EXISTS (SELECT 1 FROM "ledger") OR EXISTS (SELECT 1 FROM "transactions" "t" WHERE {BOUNDS} AND "type" = 3 AND "type_group" = 1
+            AND (asset::jsonb @> %(vote_asset)s::jsonb OR asset::jsonb @> %(unvote_asset)s::jsonb));""", params).fetchone()[0]
         except Exception as e:
-            print(e)
-                        
-        # append total non-multi to multi
-        total = multi_amount + non_multi
-        return sum(total)
+            self.logger.error(f"Error checking voter activity: {str(e)}")
+            raise
+
+
+    # ACCOUNT OPERATIONS
+    def get_sum_balances(self, voter_roll, timestamp, chkpoint_timestamps):
+        """
+        Get the balance change of every voter in the roll in a single round trip
+
+        Args:
+            voter_roll: List of [address, public_key] pairs
+            timestamp: Block timestamp to calculate balances up to
+            chkpoint_timestamps: Dictionary of address to checkpoint timestamp, missing addresses start at 0
+
+        Returns:
+            Dictionary of address to inbound + forged rewards - outbound since its checkpoint
+        """
+        if not voter_roll:
+            return {}
+
+        addresses = [i[0] for i in voter_roll]
+        public_keys = [i[1] for i in voter_roll]
+        checkpoints = [chkpoint_timestamps.get(i[0], 0) for i in voter_roll]
+        params = {
+            "addresses": addresses,
+            "public_keys": public_keys,
+            "checkpoints": checkpoints,
+            "since": min(checkpoints),
+            "timestamp": timestamp}
 
-            
-    def get_sum_outbound(self, account, timestamp, chkpoint_timestamp):
         try:
-            # Non multi transactions ( json asset is null )
-            output = self.cursor.execute(f"""SELECT SUM("amount") as amount, SUM("fee") as fee FROM (SELECT * FROM "transactions" WHERE 
-            "timestamp" <= {timestamp} AND "timestamp" > {chkpoint_timestamp}) AS "filtered" WHERE "sender_public_key" = '{account}' AND asset IS NULL""").fetchall()
-            if output[0][0] == None:
-                convert = [0,0]
-            else:
-                convert = [int(i) for i in output[0]]
-
-            # votes + multi transactions ( json asset is not null )
-            output = self.cursor.execute(f"""SELECT "fee" as fee, "asset" as asset FROM (SELECT * FROM "transactions" WHERE 
-            "timestamp" <= {timestamp} AND "timestamp" > {chkpoint_timestamp}) AS "filtered" WHERE "sender_public_key" = '{account}' AND asset IS NOT NULL""").fetchall()
-            if output:
-                for transaction in output:
-                    # fee
-                    convert.append(int(transaction[0]))
-                    # all payment in transaction
-                    if 'payments' in transaction[1].keys():
-                        for payment in transaction[1]['payments']:
-                            convert.append(int(payment['amount']))
-            return sum(convert)
+            output = self.cursor.execute(f"""{LEDGER}
+            SELECT "address", SUM("amount") FROM "ledger" GROUP BY "address";""", params).fetchall()
         except Exception as e:
-            print(e)
-    
-    
+            self.logger.error(f"Error retrieving voter balances: {str(e)}")
+            raise
+
+        balances = {i: 0 for i in addresses}
+        for address, amount in output:
+            balances[address] = int(amount)
+        return balances
+
+
+    def get_balance_deltas(self, voter_roll, timestamp, chkpoint_timestamps):
+        """
+        Get every balance change of the voters in the roll in a single round trip
+
+        Args:
+            voter_roll: List of [address, public_key] pairs
+            timestamp: Timestamp to read balance changes up to
+            chkpoint_timestamps: Dictionary of address to the timestamp to read from, missing addresses start at 0
+
+        Returns:
+            List of (address, timestamp, amount) rows ordered by address and timestamp
+        """
+        if not voter_roll:
+            return []
+
+        params = {
+            "addresses": [i[0] for i in voter_roll],
+            "public_keys": [i[1] for i in voter_roll],
+            "checkpoints": [chkpoint_timestamps.get(i[0], 0) for i in voter_roll],
+            "timestamp": timestamp}
+        params["since"] = min(params["checkpoints"])
+
+        try:
+            output = self.cursor.execute(f"""{LEDGER}
+            SELECT "address", "timestamp", SUM("amount") FROM "ledger" GROUP BY "address", "timestamp"
+            ORDER BY "address", "timestamp";""", params).fetchall()
+        except Exception as e:
+            self.logger.error(f"Error retrieving voter balance changes: {str(e)}")
+            raise
+
+        return [(i[0], i[1], int(i[2])) for i in output]
+
+
+
     def get_sum_block_rewards(self, account, timestamp, chkpoint_timestamp):
         try:
             output = self.cursor.execute(f"""SELECT SUM("reward") AS "reward", SUM("total_fee") AS "fee" FROM (SELECT * FROM "blocks" 
@@ -1,12 +1,72 @@
+import logging
+import threading
+import time
+
+# node configurations are shared by every delegate in the process, keyed by api url
+configurations = {}
+configurations_lock = threading.Lock()
+# api urls a configuration is being fetched from
+fetching = set()
+
+
 class Dynamic:
     def __init__(self, utility, config):
         self.client = utility.get_client()
+        self.url = utility.get_api_url()
+        self.ttl = utility.network.config_ttl
         self.config = config
-        
-    
+
+        # Set up logging
+        self.logger = logging.getLogger(f'dynamic_{config.username}')
+
+
+    def get_configuration(self, refresh=False):
+        """
+        Get the node configuration, fetched at most once per ttl seconds for every delegate using the api
+
+        Args:
+            refresh: Fetch the configuration even if the cached one is still fresh
+
+        Returns:
+            Node configuration data, the last fetched one if the node can not be reached, None if there is none
+        """
+        with configurations_lock:
+            cached = configurations.get(self.url)
+            if cached is not None and not refresh and (time.monotonic() - cached[0] < self.ttl or self.url in fetching):
+                # fresh, or another delegate is fetching it right now
+                return cached[1]
+            fetching.add(self.url)
+
+        # the node is asked outside the lock, so a slow node does not hold up delegates using other apis
+        try:
+            configuration = self.client.node.configuration()['data']
+        except Exception as e:
+            with configurations_lock:
+                fetching.discard(self.url)
+                cached = configurations.get(self.url)
+                if cached is None:
+                    self.logger.warning(f"Could not fetch node configuration, using default fees and limits: {str(e)}")
+                    return None
+                # keep using the last fetched configuration for another ttl instead of retrying on every call
+                self.logger.warning(f"Could not fetch node configuration, using the last fetched one: {str(e)}")
+                configurations[self.url] = (time.monotonic(), cached[1])
+                return cached[1]
+
+        with configurations_lock:
+            fetching.discard(self.url)
+            configurations[self.url] = (time.monotonic(), configuration)
+        self.logger.debug(f"Fetched node configuration from {self.url}")
+        return configuration
+
+
+    def refresh(self):
+        """Fetch the node configuration before a staging or payment run"""
+        self.get_configuration(refresh=True)
+
+
     def get_dynamic_fee(self):        
         try:
-            node_configs = self.client.node.configuration()['data']['transactionPool']['dynamicFees']
+            node_configs = self.get_configuration()['transactionPool']['dynamicFees']
             if node_configs['enabled'] == "False":
                 transaction_fee = int(0.1 * self.config.atomic)
             else:
@@ -25,7 +85,7 @@ class Dynamic:
     
     def get_dynamic_fee_multi(self, numtx):
          try:
-             node_configs = self.client.node.configuration()['data']['transactionPool']['dynamicFees']
+             node_configs = self.get_configuration()['transactionPool']['dynamicFees']
              if (node_configs['enabled'] == "False"):
                  transaction_fee = int(0.1 * self.config.atomic)
              else:
@@ -59,7 +119,7 @@ class Dynamic:
     
     def get_multipay_limit(self):
         try:
-            limit = int(self.client.node.configuration()['data']['constants']['multiPaymentLimit'])
+            limit = int(self.get_configuration()['constants']['multiPaymentLimit'])
         except:
             limit = 20
         return limit
@@ -67,8 +127,32 @@ class Dynamic:
     
     def get_tx_request_limit(self):
         try:
-            limit = self.client.node.configuration()['data']['transactionPool']['maxTransactionsPerRequest']
+            limit = self.get_configuration()['transactionPool']['maxTransactionsPerRequest']
         except:
             limit = 20
         return limit
     
+    
+    def get_sender_limit(self):
+        try:
+            limit = int(self.get_configuration()['transactionPool']['maxTransactionsPerSender'])
+        except:
+            limit = 300
+        return limit
+    
+    
+    def get_max_transaction_age(self):
+        # blocks a transaction is kept in the pool before it expires
+        try:
+            age = int(self.get_configuration()['transactionPool']['maxTransactionAge'])
+        except:
+            age = 2700
+        return age
+
+
+    def get_blocktime(self):
+        try:
+            blocktime = int(self.get_configuration()['constants']['blocktime'])
+        except:
+            blocktime = 8
+        return blocktime
@@ -1,7 +1,35 @@
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
 import os
 import logging
+import threading
+
+# long-lived connections shared by every Sql in the process, keyed by process id, thread and database path
+connections = {}
+
+
+def connect(data_path):
+    """
+    Get the long-lived connection for a database, opening it on first use
+
+    WAL journaling lets tbw.py and pay.py read and write the same database
+    concurrently, the busy timeout waits out the other process' commits.
+    SQLite connections can not be shared between threads, each thread gets its own.
+    """
+    key = (os.getpid(), threading.get_ident(), data_path)
+    connection = connections.get(key)
+    if connection is None:
+        logging.getLogger('sql').debug(f"Opening SQLite connection to {data_path}")
+        connection = sqlite3.connect(data_path, timeout=30)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA cache_size = -65536")
+        connection.execute("PRAGMA mmap_size = 268435456")
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("PRAGMA busy_timeout = 30000")
+        connections[key] = connection
+    return connection
 
 
 class Sql:
@@ -9,6 +37,8 @@ class Sql:
         # Get the project root directory (assuming the script is in core/utility)
         self.project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
         self.delegate_name = delegate_name
+        self.transaction_depth = 0
+        self.voter_shares = None
         
         # Set up logging
         self.logger = logging.getLogger(f'sql_{delegate_name}' if delegate_name else 'sql')
@@ -26,8 +56,7 @@ class Sql:
         self.logger.info(f"Using SQLite database at {self.data_path}")
         
         # Connect to database
-        self.connection = sqlite3.connect(self.data_path)
-        self.cursor = self.connection.cursor()
+        self.open_connection()
         
         # Initialize database tables
         self.initialize_database()
@@ -90,21 +119,52 @@ class Sql:
         
         # Commit changes
         self.connection.commit()
+        self.migrate()
         self.logger.debug("Database tables initialized successfully")
 
         
+    def connect(self):
+        return connect(self.data_path)
+
+
     def open_connection(self):
-        self.connection = sqlite3.connect(self.data_path)
+        self.connection = self.connect()
         self.cursor = self.connection.cursor()
     
     
     def close_connection(self):
+        # only the cursor is released, the connection stays open for the life of the process
         self.cursor.close()
-        self.connection.close()
+
+
+    def close(self):
+        """Commit pending work and close the long-lived connection"""
+        connection = connections.pop((os.getpid(), threading.get_ident(), self.data_path), None)
+        if connection is not None:
+            connection.commit()
+            connection.close()
+            self.logger.debug(f"Closed SQLite connection to {self.data_path}")
     
     
     def commit(self):
-        return self.connection.commit()
+        # commits inside a transaction block are deferred until the block ends
+        if self.transaction_depth == 0:
+            return self.connection.commit()
+
+
+    @contextmanager
+    def transaction(self):
+        """Run every write in the block as one transaction, rolled back if any of them fails"""
+        self.transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.rollback()
+            raise
+        self.transaction_depth -= 1
+        self.commit()
 
 
     def execute(self, query, args=[]):
@@ -139,6 +199,79 @@ class Sql:
         self.cursor.execute("CREATE TABLE IF NOT EXISTS voters_balance_checkpoint (address varchar(36) PRIMARY KEY, balance bigint, timestamp int )")
 
         self.connection.commit()
+        self.migrate()
+
+
+    def table_exists(self, table):
+        return self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+    def column_exists(self, table, column):
+        return self.cursor.execute("SELECT 1 FROM pragma_table_info(?) WHERE name = ?", (table, column)).fetchone() is not None
+
+
+    def migrate(self):
+        """Bring the schema of an existing database up to date, safe to run on every start"""
+        # conflict targets for the INSERT OR IGNORE bulk inserts
+        if self.table_exists("delegate_rewards"):
+            self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS delegate_rewards_address ON delegate_rewards (address)")
+        if self.table_exists("transactions"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS transactions_id ON transactions (id)")
+
+        # unprocessed block, staged payment and checkpoint lookups
+        if self.table_exists("blocks"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS blocks_processed_at ON blocks (processed_at, height)")
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS blocks_height ON blocks (height)")
+        if self.table_exists("staging"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS staging_processed_at ON staging (processed_at)")
+        if self.table_exists("voters_balance_checkpoint"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS voters_balance_checkpoint_timestamp ON voters_balance_checkpoint (timestamp)")
+
+        # history of every voter balance checkpoint change, seeded once from the current checkpoints
+        if self.table_exists("voters_balance_checkpoint"):
+            if not self.table_exists("balance_index"):
+                self.cursor.execute("CREATE TABLE balance_index (address varchar(36), timestamp int, balance bigint, PRIMARY KEY (address, timestamp)) WITHOUT ROWID")
+                self.cursor.execute("INSERT INTO balance_index SELECT address, timestamp, balance FROM voters_balance_checkpoint")
+            self.cursor.execute("""CREATE TRIGGER IF NOT EXISTS balance_index_insert AFTER INSERT ON voters_balance_checkpoint
+            WHEN NEW.balance IS NOT (SELECT balance FROM balance_index WHERE address = NEW.address AND timestamp <= NEW.timestamp ORDER BY timestamp DESC LIMIT 1)
+            BEGIN INSERT OR REPLACE INTO balance_index VALUES (NEW.address, NEW.timestamp, NEW.balance); END""")
+
+        # confirmation of broadcast payments, transactions recorded before are taken as confirmed
+        if self.table_exists("transactions") and not self.column_exists("transactions", "confirmed_at"):
+            self.cursor.execute("ALTER TABLE transactions ADD COLUMN confirmed_at varchar(64) null")
+            if self.column_exists("transactions", "processed_at"):
+                self.cursor.execute("UPDATE transactions SET confirmed_at = processed_at")
+        if self.table_exists("transactions"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS transactions_unconfirmed ON transactions (id) WHERE confirmed_at IS NULL")
+
+        # nonce of each broadcast transaction, once the wallet nonce passes it unforged it can not be forged anymore
+        if self.table_exists("transactions") and not self.column_exists("transactions", "nonce"):
+            self.cursor.execute("ALTER TABLE transactions ADD COLUMN nonce bigint null")
+
+        # transaction paying each staged payment, to stage it again if the transaction is dropped
+        if self.table_exists("staging") and not self.column_exists("staging", "txid"):
+            self.cursor.execute("ALTER TABLE staging ADD COLUMN txid varchar(64) null")
+        if self.table_exists("staging"):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS staging_txid ON staging (txid)")
+
+        # last nonce used by each delegate wallet, ahead of the node while transactions are in the pool
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS nonces (address varchar(36) PRIMARY KEY, nonce bigint )")
+
+        # latest vote and unvote of every wallet that ever voted for the delegate
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS votes (public_key varchar(66) PRIMARY KEY, vote_ts int, unvote_ts int )")
+
+        # processed block counter kept up to date by triggers, seeded once from the existing rows
+        if self.table_exists("blocks"):
+            self.cursor.execute("CREATE TABLE IF NOT EXISTS counters (name varchar(64) PRIMARY KEY, value bigint)")
+            self.cursor.execute("INSERT OR IGNORE INTO counters SELECT 'processed_blocks', COUNT(*) FROM blocks WHERE processed_at NOT NULL")
+            self.cursor.execute("""CREATE TRIGGER IF NOT EXISTS blocks_processed_insert AFTER INSERT ON blocks WHEN NEW.processed_at NOT NULL
+            BEGIN UPDATE counters SET value = value + 1 WHERE name = 'processed_blocks'; END""")
+            self.cursor.execute("""CREATE TRIGGER IF NOT EXISTS blocks_processed_update AFTER UPDATE OF processed_at ON blocks
+            BEGIN UPDATE counters SET value = value + (NEW.processed_at NOT NULL) - (OLD.processed_at NOT NULL) WHERE name = 'processed_blocks'; END""")
+            self.cursor.execute("""CREATE TRIGGER IF NOT EXISTS blocks_processed_delete AFTER DELETE ON blocks WHEN OLD.processed_at NOT NULL
+            BEGIN UPDATE counters SET value = value - 1 WHERE name = 'processed_blocks'; END""")
+
+        self.connection.commit()
 
 
     def store_exchange(self, i_address, pay_address, e_address, amount, exchangeid):
@@ -154,65 +287,48 @@ class Sql:
         for k, v in paid.items():
             staging.append((k, v, msg, None))
 
-        self.executemany("INSERT INTO staging VALUES (?,?,?,?)", staging)
+        self.executemany("INSERT INTO staging (address, payamt, msg, processed_at) VALUES (?,?,?,?)", staging)
         self.commit()
 
 
     def store_blocks(self, blocks):
-        newBlocks=[]
-
-        for block in blocks:
-            self.cursor.execute("SELECT id FROM blocks WHERE id = ?", (block[0],))
-
-            if self.cursor.fetchone() is None:
-                newBlocks.append((block[0], block[1], block[2], block[3], block[4], None))
-
-        self.executemany("INSERT INTO blocks VALUES (?,?,?,?,?,?)", newBlocks)
-
+        newBlocks = [(block[0], block[1], block[2], block[3], block[4], None) for block in blocks]
+        count = self.executemany("INSERT OR IGNORE INTO blocks VALUES (?,?,?,?,?,?)", newBlocks).rowcount
         self.commit()
+        return count
 
-    def store_voters(self, voters, share):
-        newVoters=[]
-
-        for voter in voters:
-            self.cursor.execute("SELECT address FROM voters WHERE address = ?", (voter[0],))
-
-            if self.cursor.fetchone() is None:
-                newVoters.append((voter[0], voter[1], 0, 0, share))
-
-        self.executemany("INSERT INTO voters VALUES (?,?,?,?,?)", newVoters)
 
+    def store_voters(self, voters, share):
+        newVoters = [(voter[0], voter[1], 0, 0, share) for voter in voters]
+        count = self.executemany("INSERT OR IGNORE INTO voters VALUES (?,?,?,?,?)", newVoters).rowcount
         self.commit()
+        if count:
+            self.clear_voter_shares()
+        return count
 
 
     def store_delegate_rewards(self, delegate):
-        newRewards=[]
-
-        for d in delegate:
-            self.cursor.execute("SELECT address FROM delegate_rewards WHERE address = ?", (d,))
-
-            if self.cursor.fetchone() is None:
-                newRewards.append((d, 0, 0))
-
-        self.executemany("INSERT INTO delegate_rewards VALUES (?,?,?)", newRewards)
-
+        newRewards = [(d, 0, 0) for d in delegate]
+        count = self.executemany("INSERT OR IGNORE INTO delegate_rewards VALUES (?,?,?)", newRewards).rowcount
         self.commit()
+        return count
 
 
     def store_transactions(self, tx):
-        newTransactions=[]
-        
         ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        for t in tx:
-            self.cursor.execute("SELECT id FROM transactions WHERE id = ?", (t[2],))
-            
-            if self.cursor.fetchone() is None:
-                newTransactions.append((t[0], t[1], t[2], ts))
-                
-        self.executemany("INSERT INTO transactions VALUES (?,?,?,?)", newTransactions)
+        newTransactions = [(t[0], t[1], t[2], ts, t[3]) for t in tx]
+
+        # transactions has no primary key, a multipayment stores one row per payment under the same id,
+        # so rows are staged and only ids not recorded yet are copied over
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS new_transactions (address varchar(36), amount varchar(64), id varchar(64), processed_at varchar(64), nonce bigint )")
+        self.cursor.execute("DELETE FROM new_transactions")
+        self.executemany("INSERT INTO new_transactions VALUES (?,?,?,?,?)", newTransactions)
+        count = self.cursor.execute("""INSERT INTO transactions (address, amount, id, processed_at, nonce) SELECT * FROM new_transactions
+        WHERE id NOT IN (SELECT id FROM transactions)""").rowcount
+        self.cursor.execute("DELETE FROM new_transactions")
         
         self.commit()
+        return count
 
 
     def mark_processed(self, block, initial="N"):
@@ -225,6 +341,12 @@ class Sql:
         self.commit()
 
 
+    def mark_processed_blocks(self, heights):
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.executemany("UPDATE blocks SET processed_at = ? WHERE height = ?", [(ts, i) for i in heights])
+        self.commit()
+
+
     def blocks(self):
         return self.cursor.execute("SELECT * FROM blocks")
 
@@ -237,6 +359,10 @@ class Sql:
         return self.cursor.execute("SELECT * FROM blocks WHERE processed_at NOT NULL")
 
 
+    def processed_block_count(self):
+        return self.cursor.execute("SELECT value FROM counters WHERE name = 'processed_blocks'").fetchall()[0][0]
+
+
     def unprocessed_blocks(self):
         return self.cursor.execute("SELECT * FROM blocks WHERE processed_at IS NULL ORDER BY height")
     
@@ -245,19 +371,40 @@ class Sql:
         return self.cursor.execute("SELECT COUNT(*) FROM staging WHERE processed_at is NULL").fetchall()[0][0]
 
 
-    def get_staged_payment(self, lim=40, multi='N'):
+    def get_staged_payment(self, lim=40, multi='N', after=0):
+        # rows are paged by rowid, after skips the rows of batches still in flight
         if multi == 'N':
-            return self.cursor.execute(f"SELECT rowid, * FROM staging WHERE processed_at IS NULL LIMIT {lim}")
+            return self.cursor.execute(f"SELECT rowid, * FROM staging WHERE processed_at IS NULL AND rowid > {after} ORDER BY rowid LIMIT {lim}")
         else:
-            return self.cursor.execute(f"SELECT rowid, * FROM staging WHERE processed_at IS NULL")
+            return self.cursor.execute(f"SELECT rowid, * FROM staging WHERE processed_at IS NULL AND rowid > {after} ORDER BY rowid")
             
 
-    def process_staged_payment(self, rows):
+    def process_staged_payment(self, rows, txids=None):
         ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')		
-        for i in rows:
-            self.cursor.execute(f"UPDATE staging SET processed_at = '{ts}' WHERE rowid = {i}")
+        if txids is None:
+            self.executemany("UPDATE staging SET processed_at = ? WHERE rowid = ?", [(ts, i) for i in rows])
+        else:
+            self.executemany("UPDATE staging SET processed_at = ?, txid = ? WHERE rowid = ?", [(ts, t, i) for i, t in zip(rows, txids)])
+        self.commit()
+
+
+    def unconfirmed_transactions(self, before):
+        return self.cursor.execute("SELECT id, MIN(processed_at), MAX(nonce) FROM transactions WHERE confirmed_at IS NULL AND processed_at <= ? GROUP BY id", (before,))
+
+
+    def confirm_transactions(self, txids):
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.executemany("UPDATE transactions SET confirmed_at = ? WHERE id = ? AND confirmed_at IS NULL", [(ts, i) for i in txids])
         self.commit()
 
+
+    def restage_transactions(self, txids):
+        """Stage the payments of dropped transactions again and delete their records"""
+        with self.transaction():
+            count = self.executemany("UPDATE staging SET processed_at = NULL, txid = NULL WHERE txid = ?", [(i,) for i in txids]).rowcount
+            self.executemany("DELETE FROM transactions WHERE id = ?", [(i,) for i in txids])
+        return count
+
     
     def delete_staged_payment(self):
         self.cursor.execute("DELETE FROM staging WHERE processed_at NOT NULL")     
@@ -291,42 +438,85 @@ class Sql:
 
     
     def update_voter_balance(self, voter_unpaid):
-        for k, v in voter_unpaid.items():
-            self.cursor.execute(f"UPDATE voters SET unpaid_bal = unpaid_bal + {v} WHERE address = '{k}'")
-            self.commit()
+        self.executemany("UPDATE voters SET unpaid_bal = unpaid_bal + ? WHERE address = ?", [(v, k) for k, v in voter_unpaid.items()])
+        self.commit()
 
 
     def update_delegate_balance(self, delegate_unpaid):
-        for k, v in delegate_unpaid.items():
-            self.cursor.execute(f"UPDATE delegate_rewards SET unpaid_bal = unpaid_bal + {v} WHERE address = '{k}'")
-            self.commit()
+        self.executemany("UPDATE delegate_rewards SET unpaid_bal = unpaid_bal + ? WHERE address = ?", [(v, k) for k, v in delegate_unpaid.items()])
+        self.commit()
 
 
     def update_voter_paid_balance (self, paid):
-        for k, v in paid.items():
-            self.cursor.execute(f"UPDATE voters SET paid_bal = paid_bal + {v} WHERE address = '{k}'")
-            self.cursor.execute(f"UPDATE voters SET unpaid_bal = unpaid_bal - {v} WHERE address = '{k}'")
-            self.commit()
+        self.executemany("UPDATE voters SET paid_bal = paid_bal + ?, unpaid_bal = unpaid_bal - ? WHERE address = ?", [(v, v, k) for k, v in paid.items()])
+        self.commit()
 
 
     def update_delegate_paid_balance (self, paid):
-        for k,v in paid.items():
-            self.cursor.execute(f"UPDATE delegate_rewards SET paid_bal = paid_bal + unpaid_bal WHERE address = '{k}'")
-            self.cursor.execute(f"UPDATE delegate_rewards SET unpaid_bal = unpaid_bal - unpaid_bal WHERE address = '{k}'")
-            self.commit()
+        self.executemany("UPDATE delegate_rewards SET paid_bal = paid_bal + unpaid_bal, unpaid_bal = 0 WHERE address = ?", [(k,) for k in paid.keys()])
+        self.commit()
 
     
     def update_voter_share(self, address, share):
         self.cursor.execute("UPDATE voters SET share = {0} WHERE address = '{1}'".format(share, address))
         self.commit()
+        self.clear_voter_shares()
 
 
     def get_voter_share(self, address):
         return self.cursor.execute("SELECT share FROM voters WHERE address = '{0}'".format(address))
 
+
+    def get_voter_shares(self):
+        """Share rate of every voter, loaded in one query and cached until a rate or the voter list changes"""
+        if self.voter_shares is None:
+            self.voter_shares = {i[0]:i[1] for i in self.cursor.execute("SELECT address, share FROM voters").fetchall()}
+            self.logger.debug(f"Loaded share rates for {len(self.voter_shares)} voters")
+        return self.voter_shares
+
+
+    def clear_voter_shares(self):
+        self.voter_shares = None
+
     
+    def get_votes_timestamp(self):
+        """Timestamp the stored votes are synced up to, None if they were never synced"""
+        row = self.cursor.execute("SELECT value FROM counters WHERE name = 'votes_timestamp'").fetchone()
+        return row[0] if row else None
+
+
+    def get_votes(self):
+        vote = self.cursor.execute("SELECT public_key, vote_ts FROM votes WHERE vote_ts NOT NULL").fetchall()
+        unvote = self.cursor.execute("SELECT public_key, unvote_ts FROM votes WHERE unvote_ts NOT NULL").fetchall()
+        return vote, unvote
+
+
+    def update_votes(self, vote, unvote, timestamp):
+        """Merge vote and unvote transactions up to timestamp into the stored votes"""
+        with self.transaction():
+            self.executemany("""INSERT INTO votes (public_key, vote_ts) VALUES (?,?) ON CONFLICT (public_key)
+            DO UPDATE SET vote_ts = MAX(IFNULL(vote_ts, 0), excluded.vote_ts)""", vote)
+            self.executemany("""INSERT INTO votes (public_key, unvote_ts) VALUES (?,?) ON CONFLICT (public_key)
+            DO UPDATE SET unvote_ts = MAX(IFNULL(unvote_ts, 0), excluded.unvote_ts)""", unvote)
+            self.cursor.execute("INSERT OR REPLACE INTO counters VALUES ('votes_timestamp', ?)", (timestamp,))
+
+
+    def get_nonce(self, address):
+        row = self.cursor.execute("SELECT nonce FROM nonces WHERE address = ?", (address,)).fetchone()
+        return row[0] if row else None
+
+
+    def update_nonce(self, address, nonce):
+        self.cursor.execute("INSERT OR REPLACE INTO nonces VALUES (?,?)", (address, nonce))
+        self.commit()
+
+
     def get_voter_balance_checkpoint(self, address):
         return self.cursor.execute(f"SELECT * FROM voters_balance_checkpoint WHERE address = '{address}'")
+
+
+    def get_voter_balance_checkpoints(self):
+        return self.cursor.execute("SELECT * FROM voters_balance_checkpoint")
     
     
     def get_all_voters_balance_checkpoint(self):
@@ -334,6 +524,17 @@ class Sql:
         return self.cursor.execute(f"SELECT balance FROM voters_balance_checkpoint WHERE timestamp = {ts}")
 
     
+    def get_balance_index(self, addresses):
+        """Balance history of addresses ordered by address and timestamp"""
+        return self.cursor.execute(f"SELECT address, timestamp, balance FROM balance_index WHERE address IN ({','.join('?' * len(addresses))}) ORDER BY address, timestamp", list(addresses))
+
+
     def update_voter_balance_checkpoint(self, vote_balance, block_timestamp):
         self.executemany("INSERT OR REPLACE INTO voters_balance_checkpoint(address,balance,timestamp) VALUES (?,?,?)", [(k,v,block_timestamp) for k,v in vote_balance.items()])
         self.commit()
+
+
+    def update_voter_balance_checkpoints(self, checkpoints):
+        """Store checkpoints of voters balanced at different timestamps, dictionary of address to (balance, timestamp)"""
+        self.executemany("INSERT OR REPLACE INTO voters_balance_checkpoint(address,balance,timestamp) VALUES (?,?,?)", [(k,v[0],v[1]) for k,v in checkpoints.items()])
+        self.commit()
@@ -1,6 +1,23 @@
 from client import ArkClient
 from crypto.configuration.network import set_custom_network
+from requests.adapters import HTTPAdapter
 import datetime
+import os
+import threading
+
+# api clients are shared by every delegate in the process, keyed by url, and send their requests
+# through one pool of keep-alive connections per process, keyed by process id
+clients = {}
+adapters = {}
+clients_lock = threading.Lock()
+
+
+def get_adapter():
+    """Get the keep-alive connection pool of this process, shared by the api clients of every url"""
+    pid = os.getpid()
+    if pid not in adapters:
+        adapters[pid] = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    return adapters[pid]
 
 
 class Utility:
@@ -9,11 +26,36 @@ class Utility:
         self.build_network()
     
     
+    def get_api_url(self, ip="localhost"):
+        # peers may listen on another api port
+        if ':' in ip:
+            return 'http://{0}/api'.format(ip)
+        return 'http://{0}:{1}/api'.format(ip, self.network.api)
+
+
     def get_client(self, ip="localhost"):
-        return ArkClient('http://{0}:{1}/api'.format(ip, self.network.api))
+        url = self.get_api_url(ip)
+        with clients_lock:
+            key = (os.getpid(), url)
+            if key not in clients:
+                client = ArkClient(url)
+                client.connection.session.mount('http://', get_adapter())
+                client.connection.session.mount('https://', get_adapter())
+                clients[key] = client
+            return clients[key]
+
+
+    def get_peer_clients(self):
+        """Api clients of the peers signed transactions are relayed to besides the local node"""
+        return [self.get_client(i) for i in self.network.peers]
     
     
     def build_network(self):
         t = [int(i) for i in self.network.epoch]
-        epoch = datetime.datetime(t[0], t[1], t[2], t[3], t[4], t[5])
-        set_custom_network(epoch, self.network.version, self.network.wif)
+        self.epoch = datetime.datetime(t[0], t[1], t[2], t[3], t[4], t[5])
+        set_custom_network(self.epoch, self.network.version, self.network.wif)
+
+
+    def get_network_settings(self):
+        """Epoch, version and wif to sign transactions for this network in another process"""
+        return self.epoch, self.network.version, self.network.wif